@@ -0,0 +1,271 @@
+'''[This module is a CPU opponent that plays an army's turn]
+
+The bot plays through the GameManager actions (unit_move, unit_attack,
+capture_tile, unit_create and army_end_turn) so the rules stay in the
+engine.  Each round it scores the best play of every unit that can still
+act: an attack from any tile it can reach, a capture, or a move towards
+the enemy.  The plays are carried out best first, those made stale by an
+earlier play are planned again in the next round.  When no unit can act or
+the time budget runs out it buys units at its free factories and ends the
+turn.
+
+Planning only reads the board, so with a process pool the units are split
+between the workers, each planning on its own copy of the board.
+'''
+
+import math
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+import codec
+from army import Army
+from config import rules
+from manager import GameManager, attack_ring
+from mapping import MapType, terrain_star
+from unit import UnitType
+
+# units planned in one process before the pool is worth its overhead
+POOL_MIN_UNITS = 8
+# units bought at a factory, the first affordable one is bought
+TROOPS = (UnitType.TANK, UnitType.ARTILLERY, UnitType.MECH, UnitType.INFANTRY)
+CAPTURERS = (UnitType.INFANTRY, UnitType.MECH)
+
+
+class Play(NamedTuple):
+    '''A unit's move from x,y to x2,y2 then the action on the target.'''
+    score: float
+    x: int
+    y: int
+    x2: int
+    y2: int
+    action: str
+    target: tuple = None
+
+
+def objectives(mngr: GameManager, army: Army) -> tuple:
+    '''Returns the coordinates of the enemy units and of the properties the
+       army does not own.'''
+    enemies = [pos for other, units in mngr.army_units.items()
+               if other != army for pos in
+               (mngr.unit_positions[id] for id in units)]
+    properties = [(tile.x, tile.y) for tile in mngr.board.grid
+                  if tile.mapTile.is_capturable()
+                  and tile.mapTile.army != army]
+    return enemies, properties
+
+
+def distance(x: int, y: int, targets: list) -> int:
+    '''Returns the Manhattan distance to the nearest target.'''
+    return min((abs(x - x2) + abs(y - y2) for x2, y2 in targets),
+               default=0)
+
+
+def attack_score(mngr: GameManager, unit, tile, target, target_tile) -> float:
+    '''Returns the funds worth of damage dealt less the damage taken.'''
+    attacker_hp, defender_hp = mngr.attack_exchange(unit, tile, target,
+                                                    target_tile)
+    dealt = (target.status.hp - defender_hp[2]) * target.status.cost
+    taken = (unit.status.hp - attacker_hp[2]) * unit.status.cost
+    score = (dealt - taken) / 100
+    if defender_hp[1] <= 0:
+        score += target.status.cost / 2
+    return score
+
+
+def capture_score(mngr: GameManager, unit, tile) -> float:
+    '''Returns the worth of capturing the property on the tile this turn.'''
+    progress = math.ceil(unit.status.hp / 10)
+    worth = 3 * mngr.config.income
+    if tile.mapTile.is_hq():
+        worth += 100000
+    if progress >= tile.capture_hp:
+        return worth
+    return worth * progress / 20
+
+
+def best_play(mngr: GameManager, unit, tile, enemies: list,
+              properties: list) -> Play:
+    '''Returns the highest scoring play of the unit on the tile.'''
+    army = unit.army
+    capturer = unit.type_can_capture()
+    targets = enemies + properties if capturer else enemies
+    start = distance(tile.x, tile.y, targets)
+    origins = {(tile.x, tile.y): 0}
+    if unit.can_move:
+        origins.update(mngr.unit_reachable(unit, tile))
+    ring = attack_ring(unit.status.rangemin, unit.status.rangemax)
+    armed = unit.can_attack and unit.has_weapon()
+    best = Play(0.0, tile.x, tile.y, tile.x, tile.y, 'wait')
+    for x2, y2 in origins:
+        origin = mngr.tile_at(x2, y2)
+        moved = (x2, y2) != (tile.x, tile.y)
+        # a little for closing in and for cover
+        base = ((start - distance(x2, y2, targets)) * 10
+                + terrain_star[origin.mapTile.type] * 5)
+        if moved and base > best.score:
+            best = Play(base, tile.x, tile.y, x2, y2, 'wait')
+        if armed and not (moved and unit.is_indirect()):
+            for dx, dy in ring:
+                x3, y3 = x2 + dx, y2 + dy
+                if not (mngr.coord_valid(x3, y3) and
+                        mngr.unit_can_attack(unit, x3, y3, origin)):
+                    continue
+                target_tile = mngr.tile_at(x3, y3)
+                score = base + attack_score(mngr, unit, origin,
+                                            target_tile.unit, target_tile)
+                if score > best.score:
+                    best = Play(score, tile.x, tile.y, x2, y2, 'attack',
+                                (x3, y3))
+        if (capturer and unit.can_attack and origin.mapTile.is_capturable()
+                and origin.mapTile.army != army):
+            score = base + capture_score(mngr, unit, origin)
+            if score > best.score:
+                best = Play(score, tile.x, tile.y, x2, y2, 'capture')
+    return best
+
+
+def plan_units(mngr: GameManager, army: Army, positions: list,
+               deadline: float) -> list:
+    '''Returns the best play of the army's units at the positions, as many
+       as there is time for.'''
+    enemies, properties = objectives(mngr, army)
+    plays = []
+    for x, y in positions:
+        if time.monotonic() >= deadline:
+            break
+        tile = mngr.tile_at(x, y)
+        plays.append(best_play(mngr, tile.unit, tile, enemies, properties))
+    return plays
+
+
+def plan_remote(data: dict, army: str, positions: list,
+                seconds: float) -> list:
+    '''plan_units on a copy of the encoded board, run in a pool worker.'''
+    deadline = time.monotonic() + seconds
+    mngr = GameManager(rules, codec.decode_board(data, rules))
+    return plan_units(mngr, Army[army], positions, deadline)
+
+
+def plan(mngr: GameManager, army: Army, positions: list, deadline: float,
+         pool: ProcessPoolExecutor = None) -> list:
+    '''Returns the best play of each unit, planned across the pool when
+       there are enough units.'''
+    if pool is None or len(positions) < POOL_MIN_UNITS:
+        return plan_units(mngr, army, positions, deadline)
+    data = codec.encode_board(mngr.board)
+    seconds = deadline - time.monotonic()
+    futures = [pool.submit(plan_remote, data, army.name,
+                           positions[i:i + POOL_MIN_UNITS], seconds)
+               for i in range(0, len(positions), POOL_MIN_UNITS)]
+    return [play for future in futures for play in future.result()]
+
+
+def carry_out(mngr: GameManager, play: Play, act) -> bool:
+    '''Makes the play if it is still legal.
+    :return: [False if an earlier play has made it illegal]'''
+    unit = mngr.unit_at(play.x, play.y)
+    dest = (play.x2, play.y2)
+    moved = dest != (play.x, play.y)
+    if moved and not (unit.can_move and dest in mngr.unit_reachable(unit)):
+        return False
+    origin = mngr.tile_at(*dest)
+    if play.action == 'attack':
+        if not (unit.can_attack and
+                mngr.unit_can_attack(unit, *play.target, origin)):
+            return False
+    elif play.action == 'capture':
+        if not unit.can_attack or origin.mapTile.army == unit.army:
+            return False
+    if moved:
+        act('unit_move', play.x, play.y, play.x2, play.y2, False)
+    if play.action == 'attack':
+        act('unit_attack', play.x2, play.y2, *play.target)
+    elif play.action == 'capture':
+        act('capture_tile', play.x2, play.y2)
+    elif moved:
+        # as a player's move then wait, so the unit can not act again
+        act('unit_wait', play.x2, play.y2)
+    return True
+
+
+def buy_units(mngr: GameManager, army: Army, act) -> int:
+    '''Buys a unit at each of the army's free factories, infantry while it
+       has few capturers.
+    :return: [number of units bought]'''
+    board = mngr.board
+    units = mngr.army_units[army].values()
+    capturers = sum(1 for unit in units if unit.type in CAPTURERS)
+    bought = 0
+    for tile in board.grid:
+        if (tile.mapTile.type != MapType.FACTORY or
+                tile.mapTile.army != army or tile.unit):
+            continue
+        funds = board.red_funds if army == Army.RED else board.blue_funds
+        troops = (UnitType.INFANTRY,) if capturers < 3 else TROOPS
+        for unit_type in troops:
+            if mngr.config.units[unit_type.name].cost <= funds:
+                act('unit_create', army.name, unit_type.name,
+                    tile.x, tile.y)
+                capturers += unit_type in CAPTURERS
+                bought += 1
+                break
+    return bought
+
+
+def play_turn(mngr: GameManager, army: str, budget_ms: int = 1000,
+              act=None, pool: ProcessPoolExecutor = None) -> dict:
+    '''Plays the army's turn within the time budget then ends it.  Each
+       action is made by act(method, *args), by default applied to the
+       game with a random seed.
+    :return: [{actions, bought, elapsed_ms}]'''
+    try:
+        army = Army[army.upper()]
+    except KeyError:
+        raise Exception('invalid "army" parameter')
+    board = mngr.board
+    if not board.game_active:
+        raise Exception('tried to play a turn but Game Over')
+    if board.current_turn != army:
+        raise Exception(f'is not the {army.name} turn')
+    start = time.monotonic()
+    deadline = start + budget_ms / 1000
+    actions = 0
+
+    def counted(method, *args):
+        nonlocal actions
+        actions += 1
+        if act is None:
+            return mngr.apply(method, list(args), random.getrandbits(31))
+        return act(method, *args)
+
+    done = set()
+    while mngr.board.game_active and time.monotonic() < deadline:
+        positions = sorted(
+            (mngr.unit_positions[id]
+             for id, unit in mngr.army_units[army].items()
+             if id not in done and (unit.can_move or unit.can_attack)),
+            key=lambda pos: (pos[1], pos[0]))
+        if not positions:
+            break
+        plays = plan(mngr, army, positions, deadline, pool)
+        made = False
+        for play in sorted(plays, key=lambda play: -play.score):
+            if not mngr.board.game_active:
+                break
+            unit = mngr.unit_at(play.x, play.y)
+            if unit is None or unit.army != army or unit.id in done:
+                continue
+            # a stale play is planned again next round
+            if carry_out(mngr, play, counted):
+                done.add(unit.id)
+                made = True
+        if not made:
+            break
+    bought = 0
+    if mngr.board.game_active:
+        bought = buy_units(mngr, army, counted)
+        counted('army_end_turn')
+    return {'actions': actions, 'bought': bought,
+            'elapsed_ms': round((time.monotonic() - start) * 1000, 1)}
@@ -3,25 +3,47 @@
 '''[This is a RPC game engine for Advance wars]'''
 
 import os
+import atexit
 import logging
-import datetime
+import functools
+import json
+import random
 import secrets
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
 
-from flask import redirect, render_template, abort, request
+from flask import Response, redirect, render_template, abort, request
 from flask_socketio import Namespace, join_room, leave_room
+from sqlalchemy.exc import IntegrityError
 import jsons
 
+import ai
+import codec
+from array_board import ArrayBoard
+from game_bus import connect as game_bus_connect
 from manager import GameManager
+from game_cache import GameCache
+from game_queue import GameQueue
 from gameboard import GameBoard
-from config import Config
+from config import rules
 from app_core import app, jsonrpc, db, socketio
-from models import Game
-from mapping import Map, MAP1
+from models import Game, GameAction, MapTerrain, schema_upgrade
+from mapping import MAP1
+from metrics import Metrics
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(filename='app.log', level=logging.INFO)
 
-config_game = Config()
+config_game = rules
+rules_checked = time.monotonic()
+
+# rpc phase timings and counters served on /metrics
+metrics = Metrics()
+metrics.counter('aw_board_read_bytes_total',
+                'Bytes of saved boards read from the database.')
+metrics.counter('aw_board_written_bytes_total',
+                'Bytes of boards written to the database.')
 
 #
 # Helper functions
@@ -35,41 +57,299 @@ def setup_logging(level):
 
 def game_load(token):
     '''Loads the game token specified'''
-    game = Game.from_token(db.session, token)
-    if game:
-        mngr = GameManager(config_game, jsons.loads(game.board, GameBoard))
+    rules_reload()
+    mngr = game_cache.get(token)
+    if mngr:
         return mngr
-    board = GameBoard.create(Map.parse(MAP1))
-    mngr = GameManager(config_game, board)
+    with metrics.phase('load'):
+        game = Game.from_token(db.session, token)
+    mngr, replayed = game_restore(token, game)
+    if game or replayed:
+        game_cache_add(token, mngr, game)
     return mngr
 
 
-def game_save(mngr, token):
-    '''Saves the current game state'''
+def rules_reload():
+    '''Compiles config.ini again if it changed, checking at most every
+       RULES_RELOAD seconds.'''
+    global rules_checked
+    interval = app.config['RULES_RELOAD']
+    if interval and time.monotonic() - rules_checked >= interval:
+        rules_checked = time.monotonic()
+        if config_game.reload():
+            logger.info('config.ini reloaded')
+
+
+def game_cache_add(token, mngr, game):
+    '''Caches the restored game.  A board saved in another format than
+       BOARD_FORMAT is queued to be saved again, converting it lazily.'''
+    game_cache.put(token, mngr)
+    binary = app.config['BOARD_FORMAT'] == 'zlib'
+    if game and (game.board_bin is not None) != binary:
+        game_cache.mark_dirty(token, (mngr.board.version,
+                                      board_encode(mngr.board)))
+
+
+def board_encode(board):
+    '''Returns the board encoded in the BOARD_FORMAT storage format.'''
+    if app.config['BOARD_FORMAT'] == 'zlib':
+        return codec.dumpb(board, terrain_store)
+    return codec.dumps(board, terrain_store)
+
+
+def game_restore(token, game):
+    '''Restores the game from its last saved board, or a new board if
+       it has none, by replaying the logged actions made since.
+    :return: [game manager, number of actions replayed]'''
+    with metrics.phase('decode'):
+        if game:
+            metrics.count('aw_board_read_bytes_total', len(game.data))
+            board = codec.loads(game.data, config_game, terrain_store)
+        else:
+            board = GameBoard.from_map(MAP1)
+        if app.config['GAME_BOARD_LAYOUT'] == 'arrays':
+            board = ArrayBoard.from_board(board)
+    mngr = GameManager(config_game, board)
+    with metrics.phase('load'):
+        actions = GameAction.after(db.session, token, board.version)
+    with metrics.phase('engine'):
+        for action in actions:
+            mngr.apply(action.method, json.loads(action.args), action.seed)
+            board.version = action.seq
+    return mngr, len(actions)
+
+
+def game_action(mngr, token, method, *args):
+    '''Applies the action to the game and saves it.'''
+    args = list(args)
+    seed = random.getrandbits(31)
+    mngr.changed.clear()
+    try:
+        with metrics.phase('engine'):
+            result = mngr.apply(method, args, seed)
+    except Exception:
+        # a failed action may have partly changed the cached game,
+        # drop it so the next load restores it from the action log
+        game_cache.evict(token, flush=False)
+        raise
+    game_save(mngr, token, (method, args, seed))
+    return result
+
+
+def game_save(mngr, token, action=None):
+    '''Saves the current game state.  An action (method, args, seed) is
+       appended to the action log and the whole board is only written every
+       GAME_SNAPSHOT_INTERVAL actions and at the end of each turn.'''
+    mngr.board.version += 1
+    if token not in game_cache:
+        game_cache.put(token, mngr)
+    if action:
+        method, args, seed = action
+        db.session.add(GameAction(token, mngr.board.version, method, args,
+                                  seed))
+        try:
+            with metrics.phase('commit'):
+                db.session.commit()
+        except IntegrityError:
+            # another worker logged this version first, our copy is stale
+            db.session.rollback()
+            game_cache.evict(token, flush=False)
+            raise Exception(f'game {token} was changed by another request')
+        game_publish(token, mngr.board.version)
+        if (method != 'army_end_turn' and
+                mngr.board.version % app.config['GAME_SNAPSHOT_INTERVAL']):
+            return
+    with metrics.phase('encode'):
+        snapshot = (mngr.board.version, board_encode(mngr.board))
+    if not game_cache.mark_dirty(token, snapshot):
+        game_write(token, snapshot)
+    game_cache.start(socketio.start_background_task)
+
+
+def game_write(token, snapshot):
+    '''Writes a (version, board) snapshot of the game to the database.
+    :return: [number of bytes written]'''
+    version, board = snapshot
+    with app.app_context(), metrics.phase('commit'):
+        if not Game.save_board(db.session, token, board, version):
+            if Game.from_token(db.session, token):
+                logger.warning(f'game {token} not saved, version {version} '
+                               'is older than the saved board')
+            else:
+                db.session.add(Game(board, token, version))
+                db.session.commit()
+        metrics.count('aw_board_written_bytes_total', len(board))
+        return len(board)
+
+
+def terrain_load(key):
+    '''Loads map terrain for the terrain store.
+    :return: [(width, height, terrain) or None]'''
+    with app.app_context():
+        row = MapTerrain.from_id(db.session, key)
+        if row:
+            return (row.width, row.height,
+                    codec.rle_decode(json.loads(row.terrain)))
+
+
+def terrain_save(key, width, height, terrain):
+    '''Saves map terrain for the terrain store.'''
+    with app.app_context():
+        if MapTerrain.from_id(db.session, key):
+            return
+        db.session.add(MapTerrain(key, width, height,
+                                  json.dumps(codec.rle_encode(terrain))))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # saved by another worker at the same time
+            db.session.rollback()
+
+
+terrain_store = codec.TerrainStore(terrain_load, terrain_save)
+
+
+def board_storage(token, mngr):
+    '''Returns the bytes saved for the game, and the size and encode and
+       decode times of its board in each storage format.'''
     game = Game.from_token(db.session, token)
-    if not game:
-        game = Game(mngr.board, token)
-    else:
-        game.update = datetime.datetime.now()
-        game.board = jsons.dumps(mngr.board)
-    db.session.add(game)
-    db.session.commit()
+    result = {'format': app.config['BOARD_FORMAT'],
+              'stored_bytes': len(game.data) if game else 0}
+    for name, dump in (('json', codec.dumps), ('zlib', codec.dumpb)):
+        start = time.perf_counter()
+        data = dump(mngr.board, terrain_store)
+        encoded = time.perf_counter()
+        codec.loads(data, config_game, terrain_store)
+        decoded = time.perf_counter()
+        result[name] = {'bytes': len(data),
+                        'encode_ms': (encoded - start) * 1000,
+                        'decode_ms': (decoded - encoded) * 1000}
+    return result
 
 
 def game_delete(token):
     '''Deletes the game token specified.'''
+    game_cache.evict(token, flush=False)
+    GameAction.delete_all(db.session, token)
     game = Game.from_token(db.session, token)
     if game:
         db.session.delete(game)
+    with metrics.phase('commit'):
         db.session.commit()
+    game_publish(token)
 
 
 def game_create(token):
     '''Creates a new game with token specified'''
     mngr = game_load(token)
-    game = Game(mngr.board, token)
+    with metrics.phase('encode'):
+        game = Game(board_encode(mngr.board), token, mngr.board.version)
     db.session.add(game)
-    db.session.commit()
+    with metrics.phase('commit'):
+        db.session.commit()
+    metrics.count('aw_board_written_bytes_total', len(game.data))
+    game_cache.put(token, mngr)
+
+
+def game_cache_prewarm(count):
+    '''Loads the most recently updated games into the cache.'''
+    games = db.session.query(Game).order_by(
+        Game.updated.desc()).limit(count).all()
+    for game in reversed(games):
+        if game.token not in game_cache:
+            mngr, _ = game_restore(game.token, game)
+            game_cache_add(game.token, mngr, game)
+    logger.info(f'prewarmed {len(games)} games')
+
+
+game_cache = GameCache(game_write,
+                       app.config['GAME_CACHE_SIZE'],
+                       app.config['GAME_CACHE_MAX_MB'] * 1024 * 1024,
+                       app.config['GAME_SAVE_INTERVAL'],
+                       GameManager.memory_estimate)
+atexit.register(game_cache.close)
+
+game_queue = GameQueue()
+
+
+def game_serial(fn):
+    '''Runs the rpc through the game queue so calls on the same game token
+       run one at a time while other games run in parallel.'''
+    @functools.wraps(fn)
+    def wrapper(token, *args, **kwargs):
+        return game_queue.run(token, fn, token, *args, **kwargs)
+    return wrapper
+
+
+worker_id = secrets.token_hex(8)
+game_bus = game_bus_connect(app.config['GAME_BUS_URL'])
+
+ai_pool = None
+
+
+def ai_pool_get():
+    '''Returns the process pool the CPU opponent plans with, None when
+       AI_WORKERS is 0.'''
+    global ai_pool
+    if ai_pool is None and app.config['AI_WORKERS']:
+        ai_pool = ProcessPoolExecutor(app.config['AI_WORKERS'])
+        atexit.register(ai_pool.shutdown)
+    return ai_pool
+
+
+def ai_action(mngr, token, method, *args):
+    '''Applies and saves an action of the CPU opponent and sends it to
+       the clients.'''
+    result = game_action(mngr, token, method, *args)
+    ws_board_update(token, mngr)
+    return result
+
+
+def game_publish(token, version=None):
+    '''Tells the other workers the game changed, version None if it was
+       deleted.'''
+    try:
+        with metrics.phase('broadcast'):
+            game_bus.publish({'worker': worker_id, 'token': token,
+                              'version': version})
+    except Exception as ex:
+        logger.error(f'game bus publish failed: {ex}')
+
+
+def game_invalidate(message):
+    '''Drops the cached game if another worker has changed it since.  It
+       runs on the bus listener thread, which has no app context, so it
+       takes the game's turn and an app context of its own.'''
+    if message['worker'] == worker_id:
+        return
+    token = message['token']
+    with game_queue.hold(token), app.app_context():
+        game_invalidate_cached(token, message['version'])
+
+
+def game_invalidate_cached(token, version):
+    mngr = game_cache.peek(token)
+    if mngr and (version is None or mngr.board.version < version):
+        logger.info(f'game {token} changed by another worker')
+        game_cache.evict(token, flush=version is not None)
+
+
+def rpc_dump(obj):
+    '''Returns the rpc result dumped by jsons, timed as the encode phase.'''
+    with metrics.phase('encode'):
+        return jsons.dump(obj)
+
+
+def game_threat_map(mngr, army):
+    '''Returns the threat map for the army, cached on the game manager per
+       board version so it is dropped with the cached game.'''
+    key = army.upper()
+    cached = mngr.threat_maps.get(key)
+    if cached and cached[0] == mngr.board.version:
+        return cached[1]
+    result = mngr.threat_map(army)
+    mngr.threat_maps[key] = (mngr.board.version, result)
+    return result
 
 
 #
@@ -86,6 +366,12 @@ def index():
 def game(token: str):
     return render_template('render.html', token=token)
 
+
+@app.route('/metrics')
+def metrics_scrape():
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 #
 # Websocket
 #
@@ -94,8 +380,25 @@ def game(token: str):
 ws_games = {}
 
 
-def ws_board_update(token):
-    socketio.emit('update', 'room', room=token)
+# board fields sent with every delta
+DELTA_FIELDS = ('current_turn', 'game_active', 'total_red_troops',
+                'total_red_properties', 'red_funds', 'total_blue_troops',
+                'total_blue_properties', 'blue_funds', 'days', 'selected')
+
+
+def board_delta(mngr):
+    '''Returns the tiles and board fields changed by the last action,
+       tagged with the board version they bring the client up to.'''
+    board = mngr.board
+    delta = {field: getattr(board, field) for field in DELTA_FIELDS}
+    delta['version'] = board.version
+    delta['tiles'] = mngr.pop_changes()
+    return jsons.dump(delta)
+
+
+def ws_board_update(token, mngr):
+    with metrics.phase('broadcast'):
+        socketio.emit('delta', board_delta(mngr), room=token)
 
 
 def ws_msg(token, msg):
@@ -129,14 +432,16 @@ socketio.on_namespace(SocketIoNamespace('/'))
 
 
 @jsonrpc.method('troop_info')
+@metrics.timed
 def troop_info() -> dict:
     '''Returns the unit config info
     :return: [Unit configs]'''
     logger.info('troop_info')
-    return jsons.dump(config_game.units)
+    return rpc_dump(config_game.units)
 
 
 @jsonrpc.method('message')
+@metrics.timed
 def message(token: str, msg: str) -> str:
     '''rpc chat.
     :return: [ok]
@@ -147,6 +452,8 @@ def message(token: str, msg: str) -> str:
 
 
 @jsonrpc.method('game_delete')
+@game_serial
+@metrics.timed
 def game_delete_rpc(token: str) -> str:
     '''rpc delete game.
     :return: [ok]
@@ -157,6 +464,8 @@ def game_delete_rpc(token: str) -> str:
 
 
 @jsonrpc.method('game_create')
+@game_serial
+@metrics.timed
 def game_create_rpc(token: str) -> str:
     '''rpc-create game.
     :return: [ok]
@@ -167,34 +476,51 @@ def game_create_rpc(token: str) -> str:
 
 
 @jsonrpc.method('game_board')
+@game_serial
+@metrics.timed
 def game_board_rpc(token: str) -> dict:
     '''rpc return game board.
     :return: [gameboard]
     '''
     logger.info(f'game_board token={token}')
     mngr = game_load(token)
-    return jsons.dump(mngr.board)
+    return rpc_dump(mngr.board)
+
+
+@jsonrpc.method('board_storage')
+@game_serial
+@metrics.timed
+def board_storage_rpc(token: str) -> dict:
+    '''rpc storage size and codec times of the game board.
+    :return: [bytes saved, bytes and encode/decode ms per format]
+    '''
+    logger.info(f'board_storage token={token}')
+    mngr = game_load(token)
+    return board_storage(token, mngr)
 
 
 @jsonrpc.method('army_end_turn')
+@game_serial
+@metrics.timed
 def army_end_turn_rpc(token: str) -> str:
     '''rpc end current turn.
     :return: [ok]
     '''
     mngr = game_load(token)
     try:
-        mngr.army_end_turn()
-        game_save(mngr, token)
-        ws_board_update(token)
+        game_action(mngr, token, 'army_end_turn')
+        ws_board_update(token, mngr)
         turn = mngr.check_turn()
         logger.info(f'army_end_turn={turn.name}')
-        return jsons.dump(turn)
+        return rpc_dump(turn)
     except Exception as ex:
         return abort(400, ex)
         
 
 
 @jsonrpc.method('end_game')
+@game_serial
+@metrics.timed
 def end_game_rpc(token: str) -> str:
     '''rpc end game.
     :return: [ok]
@@ -202,19 +528,20 @@ def end_game_rpc(token: str) -> str:
     logger.info(f'end game token={token}')
     mngr = game_load(token)
     try:
-        mngr.end_game()
-        game_save(mngr, token)
-        ws_board_update(token)
+        game_action(mngr, token, 'end_game')
+        ws_board_update(token, mngr)
         turn = mngr.check_turn()
         text = turn.name + ' is the winner!'
         logger.info(f'{turn.name} is the winner')
-        return jsons.dump(text)
+        return rpc_dump(text)
     except Exception as ex:
         return abort(400, ex)
 
 
 # return the game tile for the coord(x, y)
 @jsonrpc.method('tile')
+@game_serial
+@metrics.timed
 def tile_rpc(token: str, x: int, y: int) -> dict:
     '''rpc return tile at coordinates
     :return: [tile at coordinates given]
@@ -222,12 +549,14 @@ def tile_rpc(token: str, x: int, y: int) -> dict:
     logger.info(f'tile token={token}, x={x}, y={y}')
     mngr = game_load(token)
     try:
-        return jsons.dump(mngr.tile_get(x, y))
+        return rpc_dump(mngr.tile_get(x, y))
     except Exception as ex:
         return abort(400, ex)
 
 
 @jsonrpc.method('capture_tile')
+@game_serial
+@metrics.timed
 def capture_tile_rpc(token: str, x: int, y: int) -> dict:
     '''rpc capture tile
     :return: [tile at coordinates given]
@@ -235,15 +564,16 @@ def capture_tile_rpc(token: str, x: int, y: int) -> dict:
     logger.info(f'capture_city token={token}, x={x}, y={y}')
     mngr = game_load(token)
     try:
-        mngr.capture_tile(x, y)
-        game_save(mngr, token)
-        ws_board_update(token)
-        return jsons.dump(mngr.tile_get(x, y))
+        game_action(mngr, token, 'capture_tile', x, y)
+        ws_board_update(token, mngr)
+        return rpc_dump(mngr.tile_get(x, y))
     except Exception as ex:
         return abort(400, ex)
 
 
 @jsonrpc.method('unit_wait')
+@game_serial
+@metrics.timed
 def unit_wait_rpc(token: str, x: int, y: int) -> dict:
     '''rpc unit wait
     :return: [tile at coordinates given]
@@ -251,15 +581,16 @@ def unit_wait_rpc(token: str, x: int, y: int) -> dict:
     logger.info(f'unit wait token={token}, x={x}, y={y}')
     mngr = game_load(token)
     try:
-        mngr.unit_wait(x, y)
-        game_save(mngr, token)
-        ws_board_update(token)
-        return jsons.dump(mngr.unit_at(x, y))
+        game_action(mngr, token, 'unit_wait', x, y)
+        ws_board_update(token, mngr)
+        return rpc_dump(mngr.unit_at(x, y))
     except Exception as ex:
         return abort(400, ex)
 
 
 @jsonrpc.method('unit_select')
+@game_serial
+@metrics.timed
 def unit_select_rpc(token: str, x: int, y: int) -> dict:
     '''rpc select unit at coordinate.
     :return: [gameboard]
@@ -267,15 +598,33 @@ def unit_select_rpc(token: str, x: int, y: int) -> dict:
     logger.info(f'unit_select token={token}, x={x}, y={y}')
     mngr = game_load(token)
     try:
-        unit = mngr.unit_select(x, y)
-        game_save(mngr, token)
-        ws_board_update(token)
-        return jsons.dump(mngr.unit_at(x, y))
+        game_action(mngr, token, 'unit_select', x, y)
+        ws_board_update(token, mngr)
+        return rpc_dump(mngr.unit_at(x, y))
+    except Exception as ex:
+        return abort(400, ex)
+
+
+@jsonrpc.method('reachable_tiles')
+@game_serial
+@metrics.timed
+def reachable_tiles_rpc(token: str, x: int, y: int) -> list:
+    '''rpc tiles the unit at coordinate can move to.
+    :return: [list of {x, y, cost}]
+    '''
+    logger.info(f'reachable_tiles token={token}, x={x}, y={y}')
+    mngr = game_load(token)
+    try:
+        with metrics.phase('engine'):
+            tiles = mngr.reachable_tiles(x, y)
+        return rpc_dump(tiles)
     except Exception as ex:
         return abort(400, ex)
 
 
 @jsonrpc.method('unit_move')
+@game_serial
+@metrics.timed
 def unit_move_rpc(token: str, x: int, y: int, x2: int, y2: int) -> dict:
     '''rpc move unit from / to coordinates
     :return: [tile at destination coordinates]
@@ -283,31 +632,54 @@ def unit_move_rpc(token: str, x: int, y: int, x2: int, y2: int) -> dict:
     logger.info(f'unit_move token={token}, x={x}, y={y}, x2={x2}, y2={y2}')
     mngr = game_load(token)
     try:
-        mngr.unit_move(x, y, x2, y2)
-        game_save(mngr, token)
-        ws_board_update(token)
-        return jsons.dump(mngr.tile_get(x2, y2))
+        game_action(mngr, token, 'unit_move', x, y, x2, y2)
+        ws_board_update(token, mngr)
+        return rpc_dump(mngr.tile_get(x2, y2))
+    except Exception as ex:
+        return abort(400, ex)
+
+
+@jsonrpc.method('unit_command')
+@game_serial
+@metrics.timed
+def unit_command_rpc(token: str, x: int, y: int, path_or_dest: list,
+                     action: str, target: Optional[list] = None) -> dict:
+    '''rpc move the unit at x,y then wait, attack, capture, load or join.
+    :return: [tile the unit ends on]
+    '''
+    logger.info(f'unit_command token={token}, x={x}, y={y}, '
+                f'path_or_dest={path_or_dest}, action={action}, '
+                f'target={target}')
+    mngr = game_load(token)
+    try:
+        tile = game_action(mngr, token, 'unit_command', x, y, path_or_dest,
+                           action, target)
+        ws_board_update(token, mngr)
+        return rpc_dump(tile)
     except Exception as ex:
         return abort(400, ex)
 
 
 @jsonrpc.method('unit_move2')
-def unit_move2_rpc(token: str, id: str, x: int, y: int) -> dict:
+@game_serial
+@metrics.timed
+def unit_move2_rpc(token: str, id: int, x: int, y: int) -> dict:
     '''rpc move unit for given ID to the coordinates.
     :return: [tile at coordinates]
     '''
     logger.info(f'unit_move2 token={token}, id={id}, x={x}, y={y}')
     mngr = game_load(token)
     try:
-        mngr.unit_move2(id, x, y)
-        game_save(mngr, token)
-        ws_board_update(token)
-        return jsons.dump(mngr.tile_get(x, y))
+        game_action(mngr, token, 'unit_move2', id, x, y)
+        ws_board_update(token, mngr)
+        return rpc_dump(mngr.tile_get(x, y))
     except Exception as ex:
         return abort(400, ex)
 
 
 @jsonrpc.method('unit_create')
+@game_serial
+@metrics.timed
 def unit_create_rpc(token: str, army: str, unit_type: str, x: int, y: int) -> dict:
     '''rpc create a unit at the coordinates given
     :return: [tile at coordinates]
@@ -315,16 +687,34 @@ def unit_create_rpc(token: str, army: str, unit_type: str, x: int, y: int) -> di
     logger.info(f'unit_create token={token}, army={army}, x={x}, y={y}')
     mngr = game_load(token)
     try:
-        mngr.unit_create(army, unit_type, x, y)
-        game_save(mngr, token)
-        ws_board_update(token)
-        return jsons.dump(mngr.tile_get(x, y))
+        game_action(mngr, token, 'unit_create', army, unit_type, x, y)
+        ws_board_update(token, mngr)
+        return rpc_dump(mngr.tile_get(x, y))
+    except Exception as ex:
+        return abort(400, ex)
+
+
+@jsonrpc.method('threat_map')
+@game_serial
+@metrics.timed
+def threat_map_rpc(token: str, army: str) -> list:
+    '''rpc tiles the army can attack next turn.
+    :return: [list of {x, y, threat, damage}]
+    '''
+    logger.info(f'threat_map token={token}, army={army}')
+    mngr = game_load(token)
+    try:
+        with metrics.phase('engine'):
+            threats = game_threat_map(mngr, army)
+        return rpc_dump(threats)
     except Exception as ex:
         return abort(400, ex)
 
 
 # need to return both attacker and defender
 @jsonrpc.method('damage_estimate')
+@game_serial
+@metrics.timed
 def damage_estimate_rpc(token: str, x: int, y: int, x2: int, y2: int) -> list:
     '''rpc estimates the damage for attacker and defender.
     :return: [tuple (attacker hp, defender hp) ]
@@ -332,14 +722,54 @@ def damage_estimate_rpc(token: str, x: int, y: int, x2: int, y2: int) -> list:
     logger.info(f'damage_estimate token={token}, x={x}, y={y}, x2={x2}, y2={y2}')
     mngr = game_load(token)
     try:
-        tup = mngr.damage_estimate(x, y, x2, y2)
-        return jsons.dump(tup)
+        with metrics.phase('engine'):
+            tup = mngr.damage_estimate(x, y, x2, y2)
+        return rpc_dump(tup)
+    except Exception as ex:
+        return abort(400, ex)
+
+
+@jsonrpc.method('attack_forecast')
+@game_serial
+@metrics.timed
+def attack_forecast_rpc(token: str, x: int, y: int) -> list:
+    '''rpc forecasts an attack on every unit the unit at x,y can attack.
+    :return: [list of {x, y, attacker, defender} with the {min, max,
+              expected} hp of each unit after the attack]
+    '''
+    logger.info(f'attack_forecast token={token}, x={x}, y={y}')
+    mngr = game_load(token)
+    try:
+        with metrics.phase('engine'):
+            return mngr.attack_forecast(x, y)
+    except Exception as ex:
+        return abort(400, ex)
+
+
+@jsonrpc.method('ai_play_turn')
+@game_serial
+@metrics.timed
+def ai_play_turn_rpc(token: str, army: str, budget_ms: int = 1000) -> dict:
+    '''rpc plays the army's turn with the CPU opponent and ends it.
+    :return: [{actions, bought, elapsed_ms}]
+    '''
+    logger.info(f'ai_play_turn token={token}, army={army}, '
+                f'budget_ms={budget_ms}')
+    mngr = game_load(token)
+    try:
+        budget_ms = max(0, min(budget_ms, app.config['AI_MAX_BUDGET_MS']))
+        with metrics.phase('engine'):
+            return ai.play_turn(mngr, army, budget_ms,
+                                functools.partial(ai_action, mngr, token),
+                                ai_pool_get())
     except Exception as ex:
         return abort(400, ex)
 
 
 # need to return both attacker and defender
 @jsonrpc.method('unit_attack')
+@game_serial
+@metrics.timed
 def unit_attack_rpc(token: str, x: int, y: int, x2: int, y2: int) -> dict:
     '''rpc attacks the unit from x,y to x2,y2
     :return: [tile at given coordinate]
@@ -347,15 +777,16 @@ def unit_attack_rpc(token: str, x: int, y: int, x2: int, y2: int) -> dict:
     logger.info(f'unit_attack token={token}, x={x}, y={y}, x2={x2}, y2={y2}')
     mngr = game_load(token)
     try:
-        mngr.unit_attack(x, y, x2, y2)
-        game_save(mngr, token)
-        ws_board_update(token)
-        return jsons.dump(mngr.tile_get(x2, y2))
+        game_action(mngr, token, 'unit_attack', x, y, x2, y2)
+        ws_board_update(token, mngr)
+        return rpc_dump(mngr.tile_get(x2, y2))
     except Exception as ex:
         return abort(400, ex)
 
 
 @jsonrpc.method('unit_delete')
+@game_serial
+@metrics.timed
 def unit_delete_rpc(token: str, x: int, y: int) -> dict:
     '''rpc deletes unit at given coordinate.
     :return: [tile at coordinates]
@@ -363,15 +794,16 @@ def unit_delete_rpc(token: str, x: int, y: int) -> dict:
     logger.info(f'unit_delete token={token}, x={x}, y={y}')
     mngr = game_load(token)
     try:
-        mngr.unit_delete(x, y)
-        game_save(mngr, token)
-        ws_board_update(token)
-        return jsons.dump(mngr.tile_get(x, y))
+        game_action(mngr, token, 'unit_delete', x, y)
+        ws_board_update(token, mngr)
+        return rpc_dump(mngr.tile_get(x, y))
     except Exception as ex:
         return abort(400, ex)
 
 
 @jsonrpc.method('check_turn')
+@game_serial
+@metrics.timed
 def check_turn_rpc(token: str) -> str:
     '''rpc checks the current army turn.
     :return: [The current turn]
@@ -380,12 +812,14 @@ def check_turn_rpc(token: str) -> str:
     mngr = game_load(token)
     try:
         turn = mngr.check_turn()
-        return jsons.dump(turn)
+        return rpc_dump(turn)
     except Exception as ex:
         return abort(400, ex)
 
 
 @jsonrpc.method('unit_join')
+@game_serial
+@metrics.timed
 def unit_join_rpc(token: str, x: int, y: int, x2: int, y2: int) -> dict:
     '''rpc joins the unit from x,y to x2,y2.
     :return: [Tile at x2,y2]
@@ -393,15 +827,16 @@ def unit_join_rpc(token: str, x: int, y: int, x2: int, y2: int) -> dict:
     logger.info(f'unit_join token={token}, x={x}, y={y}, x2={x2}, y2={y2}')
     mngr = game_load(token)
     try:
-        mngr.unit_join(x, y, x2, y2)
-        game_save(mngr, token)
-        ws_board_update(token)
-        return jsons.dump(mngr.tile_get(x2, y2))
+        game_action(mngr, token, 'unit_join', x, y, x2, y2)
+        ws_board_update(token, mngr)
+        return rpc_dump(mngr.tile_get(x2, y2))
     except Exception as ex:
         return abort(400, ex)
 
 
 @jsonrpc.method('unit_load')
+@game_serial
+@metrics.timed
 def unit_load_rpc(token: str, x: int, y: int, x2: int, y2: int) -> dict:
     '''rpc loads the unit from x,y to x2,y2.
     :return: [Tile at x2,y2]
@@ -409,15 +844,16 @@ def unit_load_rpc(token: str, x: int, y: int, x2: int, y2: int) -> dict:
     logger.info(f'unit_load token={token}, x={x}, y={y}, x2={x2}, y2={y2}')
     mngr = game_load(token)
     try:
-        mngr.unit_load(x, y, x2, y2)
-        game_save(mngr, token)
-        ws_board_update(token)
-        return jsons.dump(mngr.tile_get(x2, y2))
+        game_action(mngr, token, 'unit_load', x, y, x2, y2)
+        ws_board_update(token, mngr)
+        return rpc_dump(mngr.tile_get(x2, y2))
     except Exception as ex:
         return abort(400, ex)
 
 
 @jsonrpc.method('unit_unload')
+@game_serial
+@metrics.timed
 def unit_unload_rpc(token: str, x: int, y: int, x2: int, y2: int, index: int) -> dict:
     '''rpc umloads the unit from x,y to x2,y2.
     :return: [Tile at x2,y2]
@@ -426,15 +862,16 @@ def unit_unload_rpc(token: str, x: int, y: int, x2: int, y2: int, index: int) ->
         f'unit_unload token={token}, x={x}, y={y}, x2={x2}, y2={y2}, index={index}')
     mngr = game_load(token)
     try:
-        mngr.unit_unload(x, y, x2, y2, index)
-        game_save(mngr, token)
-        ws_board_update(token)
-        return jsons.dump(mngr.tile_get(x2, y2))
+        game_action(mngr, token, 'unit_unload', x, y, x2, y2, index)
+        ws_board_update(token, mngr)
+        return rpc_dump(mngr.tile_get(x2, y2))
     except Exception as ex:
         return abort(400, ex)
 
 
 @jsonrpc.method('launch_missile')
+@game_serial
+@metrics.timed
 def launch_missile_rpc(token: str, x: int, y: int, x2: int, y2: int) -> dict:
     '''launches missile from x,y to x2,y2.
     :return: [tile at destination coordinate]
@@ -443,15 +880,16 @@ def launch_missile_rpc(token: str, x: int, y: int, x2: int, y2: int) -> dict:
         f'launch missile token={token}, x={x}, y={y}, x2={x2}, y2={y2}')
     mngr = game_load(token)
     try:
-        mngr.launch_missile(x, y, x2, y2)
-        game_save(mngr, token)
-        ws_board_update(token)
-        return jsons.dump(mngr.tile_get(x, y))
+        game_action(mngr, token, 'launch_missile', x, y, x2, y2)
+        ws_board_update(token, mngr)
+        return rpc_dump(mngr.tile_get(x, y))
     except Exception as ex:
         return abort(400, ex)
 
 
 @jsonrpc.method('unit_resupply')
+@game_serial
+@metrics.timed
 def unit_resupply_rpc(token: str, x: int, y: int, x2: int, y2: int) -> dict:
     '''rpc resupply unit from x,y to x2,y2.
     :return: [tile at destination coordinates]
@@ -459,20 +897,38 @@ def unit_resupply_rpc(token: str, x: int, y: int, x2: int, y2: int) -> dict:
     logger.info(f'resupply token={token}, x={x}, y={y}, x2={x2}, y2={y2}')
     mngr = game_load(token)
     try:
-        mngr.unit_resupply(x, y, x2, y2)
-        game_save(mngr, token)
-        ws_board_update(token)
-        return jsons.dump(mngr.tile_get(x2, y2))
+        game_action(mngr, token, 'unit_resupply', x, y, x2, y2)
+        ws_board_update(token, mngr)
+        return rpc_dump(mngr.tile_get(x2, y2))
     except Exception as ex:
         return abort(400, ex)
 
 
+metrics.collect('aw_game_cache_hits_total', 'counter',
+                'Games loaded from the game cache.', lambda: game_cache.hits)
+metrics.collect('aw_game_cache_misses_total', 'counter',
+                'Games restored from the database.',
+                lambda: game_cache.misses)
+metrics.collect('aw_game_cache_games', 'gauge', 'Games in the game cache.',
+                lambda: len(game_cache))
+metrics.collect('aw_active_rooms', 'gauge',
+                'Games with a Socket.IO client connected.',
+                lambda: len(set(ws_games.values())))
+
+
+def app_startup():
+    '''Creates or upgrades the tables, prewarms the game cache and listens
+       for games changed by other workers.'''
+    with app.app_context():
+        for column in schema_upgrade(db.engine):
+            logger.info(f'added column {column}')
+        game_cache_prewarm(app.config['GAME_CACHE_PREWARM'])
+    game_bus.subscribe(game_invalidate, socketio.start_background_task)
+
+
 if __name__ == '__main__':
     setup_logging(logging.DEBUG)
-    # create tables
-    with app.app_context():
-        db.create_all()
-        db.session.commit()
+    app_startup()
     # Bind to PORT if defined, otherwise default to 5000.
     port = int(os.environ.get('PORT', 5000))
     logging.info(f'binding to port: {port}')
@@ -1,16 +1,28 @@
 '''[This module sets up the Database using SQLAlchemy]'''
 
 import os
+import sqlite3
 
 from flask import Flask
 from flask_jsonrpc.app import JSONRPC
 from flask_sqlalchemy import SQLAlchemy
 from flask_socketio import SocketIO
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 jsonrpc = JSONRPC(app, '/api', enable_web_browsable_api=True)
-socketio = SocketIO(app)
+
+# multi worker mode: socket.io rooms and game changes are shared between
+# workers through a message queue such as redis://localhost:6379/0
+app.config['SOCKETIO_MESSAGE_QUEUE'] = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+app.config['GAME_BUS_URL'] = os.getenv(
+    'GAME_BUS_URL', app.config['SOCKETIO_MESSAGE_QUEUE'] or 'memory://')
+# threading, eventlet or gevent, see server.py
+app.config['WORKER_MODE'] = os.getenv('WORKER_MODE', 'threading')
+socketio = SocketIO(app, message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'],
+                    async_mode=app.config['WORKER_MODE'])
 
 if os.getenv('DATABASE_URL'):
     url = os.getenv('DATABASE_URL')
@@ -19,4 +31,62 @@ if os.getenv('DATABASE_URL'):
     app.config['SQLALCHEMY_DATABASE_URI'] = url
 else:
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///aw-rpc.db'
+
+
+def engine_options(url: str) -> dict:
+    '''Returns the engine options for the database url: a connection pool
+       per worker whose pre ping drops connections the server closed.  The
+       pool is only sized for servers; SQLite keeps the pool SQLAlchemy picks
+       for it, and the StaticPool of an in-memory database takes no size.'''
+    options = {
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', '1') == '1',
+        # compiled statements cached per engine
+        'query_cache_size': int(os.getenv('DB_QUERY_CACHE_SIZE', 500)),
+    }
+    if make_url(url).get_backend_name() != 'sqlite':
+        options['pool_size'] = int(os.getenv('DB_POOL_SIZE', 10))
+        options['max_overflow'] = int(os.getenv('DB_MAX_OVERFLOW', 20))
+        options['pool_timeout'] = int(os.getenv('DB_POOL_TIMEOUT', 30))
+    return options
+
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+    app.config['SQLALCHEMY_DATABASE_URI'])
 db = SQLAlchemy(app)
+
+
+@event.listens_for(Engine, 'connect')
+def sqlite_pragmas(connection, record):
+    '''Tunes SQLite connections: the write ahead log lets readers run
+       alongside a writer and synchronous=NORMAL only syncs at checkpoints.'''
+    if not isinstance(connection, sqlite3.Connection):
+        return
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f'PRAGMA busy_timeout={os.getenv("DB_BUSY_TIMEOUT", 5000)}')
+    cursor.close()
+
+# in-memory game cache, see game_cache.py
+app.config['GAME_CACHE_SIZE'] = int(os.getenv('GAME_CACHE_SIZE', 256))
+app.config['GAME_CACHE_MAX_MB'] = int(os.getenv('GAME_CACHE_MAX_MB', 64))
+# seconds between coalesced saves, 0 saves on every action
+app.config['GAME_SAVE_INTERVAL'] = float(os.getenv('GAME_SAVE_INTERVAL', 2))
+app.config['GAME_CACHE_PREWARM'] = int(os.getenv('GAME_CACHE_PREWARM', 50))
+# actions logged between full board saves, see models.GameAction
+app.config['GAME_SNAPSHOT_INTERVAL'] = int(
+    os.getenv('GAME_SNAPSHOT_INTERVAL', 20))
+# objects keeps cached boards as GameBoards, arrays as the smaller
+# ArrayBoard, see array_board.py
+app.config['GAME_BOARD_LAYOUT'] = os.getenv('GAME_BOARD_LAYOUT', 'objects')
+# json saves boards as text, zlib packed and compressed in board_bin
+app.config['BOARD_FORMAT'] = os.getenv('BOARD_FORMAT', 'json')
+if app.config['BOARD_FORMAT'] not in ('json', 'zlib'):
+    raise Exception(f'unknown BOARD_FORMAT {app.config["BOARD_FORMAT"]}')
+# seconds between checks for a changed config.ini, 0 never reloads it
+app.config['RULES_RELOAD'] = float(os.getenv('RULES_RELOAD', 0))
+# processes the CPU opponent plans large turns with, 0 plans in the worker
+app.config['AI_WORKERS'] = int(os.getenv('AI_WORKERS', 0))
+# longest time budget an ai_play_turn call may ask for
+app.config['AI_MAX_BUDGET_MS'] = int(os.getenv('AI_MAX_BUDGET_MS', 5000))
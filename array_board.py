@@ -0,0 +1,235 @@
+'''[This module defines a struct of arrays game board]
+
+ArrayBoard holds the same state as GameBoard but keeps each per tile field
+in a flat array indexed by x + y * width and the units in a dict keyed by
+index, so a cached game costs a few bytes a tile rather than a GameTile and
+its fields.  board.grid hands out TileView objects on demand which read and
+write the arrays and behave like a GameTile, so GameManager, the codec and
+jsons work with either board.
+'''
+
+from array import array
+
+import jsons
+
+from army import Army
+from gameboard import GameBoard, GameTile
+from mapping import MapType, map_tile
+
+TYPES = {type.value: type for type in MapType}
+ARMIES = {army.value: army for army in Army}
+ARMIES[-1] = None
+
+# GameBoard fields copied as they are
+FIELDS = ('turn_order', 'current_turn', 'game_active', 'total_red_troops',
+          'total_red_properties', 'red_funds', 'total_blue_troops',
+          'total_blue_properties', 'blue_funds', 'days', 'version',
+          'next_unit_id', 'map_id')
+
+
+def flagged(flags: bytearray):
+    '''Yields the index of every set flag.'''
+    i = flags.find(1)
+    while i >= 0:
+        yield i
+        i = flags.find(1, i + 1)
+
+
+class TileView():
+    '''A GameTile like view of one tile of an ArrayBoard.'''
+    __slots__ = ('_board', '_index')
+
+    def __init__(self, board, index: int):
+        self._board = board
+        self._index = index
+
+    def __eq__(self, other):
+        return (isinstance(other, TileView) and other._board is self._board
+                and other._index == self._index)
+
+    def __hash__(self):
+        return hash(self._index)
+
+    def __repr__(self):
+        return f'TileView(x={self.x}, y={self.y})'
+
+    @property
+    def x(self) -> int:
+        return self._index % self._board.width
+
+    @property
+    def y(self) -> int:
+        return self._index // self._board.width
+
+    @property
+    def unit(self):
+        return self._board.units.get(self._index)
+
+    @unit.setter
+    def unit(self, unit):
+        if unit is None:
+            self._board.units.pop(self._index, None)
+        else:
+            self._board.units[self._index] = unit
+
+    @property
+    def mapTile(self):
+        board = self._board
+        return map_tile(TYPES[board.terrain[self._index]],
+                        ARMIES[board.owner[self._index]])
+
+    @mapTile.setter
+    def mapTile(self, tile):
+        self._board.terrain[self._index] = tile.type.value
+        self._board.owner[self._index] = tile.army.value if tile.army else -1
+
+    @property
+    def can_be_moved_to(self) -> bool:
+        return bool(self._board.moved[self._index])
+
+    @can_be_moved_to.setter
+    def can_be_moved_to(self, value: bool):
+        self._board.moved[self._index] = bool(value)
+
+    @property
+    def can_be_attacked(self) -> bool:
+        return bool(self._board.attacked[self._index])
+
+    @can_be_attacked.setter
+    def can_be_attacked(self, value: bool):
+        self._board.attacked[self._index] = bool(value)
+
+    @property
+    def capture_hp(self) -> int:
+        return self._board.capture[self._index]
+
+    @capture_hp.setter
+    def capture_hp(self, value: int):
+        self._board.capture[self._index] = value
+
+    def to_tile(self) -> GameTile:
+        '''Returns the tile as a GameTile sharing its unit.'''
+        return GameTile(self.x, self.y, self.unit, self.mapTile,
+                        self.can_be_moved_to, self.can_be_attacked,
+                        self.capture_hp)
+
+
+class TileGrid():
+    '''The list like board.grid of an ArrayBoard.'''
+    __slots__ = ('_board',)
+
+    def __init__(self, board):
+        self._board = board
+
+    def __len__(self):
+        return len(self._board.terrain)
+
+    def __getitem__(self, index: int) -> TileView:
+        if not 0 <= index < len(self._board.terrain):
+            raise IndexError('tile index out of range')
+        return TileView(self._board, index)
+
+    def __iter__(self):
+        board = self._board
+        return (TileView(board, i) for i in range(len(board.terrain)))
+
+
+class ArrayBoard():
+    '''Game board with the per tile fields in flat arrays.'''
+
+    def __init__(self, width: int, height: int):
+        size = width * height
+        self.width = width
+        self.height = height
+        self.terrain = array('H', bytes(2 * size))
+        self.owner = array('b', [-1]) * size
+        self.capture = array('b', [20]) * size
+        self.moved = bytearray(size)
+        self.attacked = bytearray(size)
+        self.units = {}
+        self._selected = -1
+        self.turn_order = []
+        self.current_turn = None
+        self.game_active = True
+        self.total_red_troops = 0
+        self.total_red_properties = 0
+        self.red_funds = 0
+        self.total_blue_troops = 0
+        self.total_blue_properties = 0
+        self.blue_funds = 0
+        self.days = 0
+        self.version = 0
+        self.next_unit_id = 0
+        self.map_id = ''
+
+    @property
+    def grid(self) -> TileGrid:
+        return TileGrid(self)
+
+    @property
+    def selected(self):
+        if self._selected < 0:
+            return None
+        return TileView(self, self._selected)
+
+    @selected.setter
+    def selected(self, tile):
+        self._selected = -1 if tile is None else tile.x + tile.y * self.width
+
+    def unit_at_index(self, index: int):
+        '''Returns the unit on the tile at the grid index or None.'''
+        return self.units.get(index)
+
+    def terrain_types(self) -> tuple:
+        '''Returns the terrain type of every tile in grid order.'''
+        return tuple(TYPES[value] for value in self.terrain)
+
+    def clear_flags(self) -> set:
+        '''Clears the move and attack flags of every tile.
+        :return: [grid indexes of the tiles that had a flag set]'''
+        indexes = set(flagged(self.moved)) | set(flagged(self.attacked))
+        size = len(self.terrain)
+        self.moved[:] = bytes(size)
+        self.attacked[:] = bytes(size)
+        return indexes
+
+    @classmethod
+    def from_board(cls, board) -> 'ArrayBoard':
+        '''Returns an ArrayBoard with the state of the board, sharing its
+           units.'''
+        if isinstance(board, ArrayBoard):
+            return board
+        self = cls(board.width, board.height)
+        for i, tile in enumerate(board.grid):
+            self.terrain[i] = tile.mapTile.type.value
+            if tile.mapTile.army:
+                self.owner[i] = tile.mapTile.army.value
+            self.capture[i] = tile.capture_hp
+            self.moved[i] = tile.can_be_moved_to
+            self.attacked[i] = tile.can_be_attacked
+            if tile.unit:
+                self.units[i] = tile.unit
+        self.selected = board.selected
+        for field in FIELDS:
+            setattr(self, field, getattr(board, field))
+        self.turn_order = list(board.turn_order)
+        return self
+
+    def to_board(self) -> GameBoard:
+        '''Returns a GameBoard with the state of the board, sharing its
+           units.'''
+        board = GameBoard(self.width, self.height)
+        board.grid = [tile.to_tile() for tile in self.grid]
+        if self._selected >= 0:
+            board.selected = board.grid[self._selected]
+        for field in FIELDS:
+            setattr(board, field, getattr(self, field))
+        board.turn_order = list(self.turn_order)
+        return board
+
+
+# dumped exactly as the GameBoard and GameTile they stand for
+jsons.set_serializer(
+    lambda obj, **kwargs: jsons.dump(obj.to_board(), **kwargs), ArrayBoard)
+jsons.set_serializer(
+    lambda obj, **kwargs: jsons.dump(obj.to_tile(), **kwargs), TileView)
@@ -0,0 +1,415 @@
+#!/usr/bin/python3
+
+'''[Benchmarks for the game engine]
+
+    python3 benchmark.py
+    python3 benchmark.py --http http://localhost:5000 [clients] [requests]
+    python3 benchmark.py --suite [--maps M,M] [--save FILE]
+                                 [--compare FILE] [--threshold 0.25]
+
+Compares the board codec with the jsons encoding for each map, reporting
+encode/decode time and payload size, and the codec with the map terrain
+kept in a terrain store (as saved games are), as text and as zlib
+compressed packed binary.  Also times creating a new game board by
+parsing the map against copying the map's template board, and the memory
+used by a GameBoard against an ArrayBoard.  With --http it load tests a running
+server instead, each client playing its own game.  With --suite it times
+the engine hot paths (path finding, select, move, end turn, missile, jsons
+and map parsing) on every map at a low and a high unit density, saves the
+timings as a JSON baseline and compares a later run with it, exiting 1 if
+any timing is more than the threshold slower.
+'''
+
+import argparse
+import json
+import random
+import secrets
+import sys
+import time
+import tracemalloc
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import jsons
+
+import codec
+from array_board import ArrayBoard
+from config import Config
+from gameboard import GameBoard
+from dijkstra import dijkstra
+from manager import GameManager
+from mapping import Map, MapType, MAP1, MAP_19X18, MAP_SCORPION, \
+    movement_cost, map_tile, INF
+from unit import UnitClass, UnitType
+
+MAPS = {
+    'MAP1': MAP1,
+    'Scorpion Operation': MAP_SCORPION,
+}
+
+config = Config()
+
+
+def time_it(fn, repeat=20):
+    '''Returns the best time in milliseconds of repeat calls to fn.'''
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = (time.perf_counter() - start) * 1000
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def populate(board: GameBoard, density: float, seed: int = 0):
+    '''Places random land units of both armies on the board.'''
+    rng = random.Random(seed)
+    mngr = GameManager(config, board)
+    land = [UnitType.INFANTRY, UnitType.MECH, UnitType.TANK,
+            UnitType.ARTILLERY, UnitType.RECON, UnitType.APC]
+    for tile in board.grid:
+        if tile.unit or rng.random() >= density:
+            continue
+        unit_type = rng.choice(land)
+        cls = config.units[unit_type.name].cls
+        if movement_cost[tile.mapTile.type][cls.value] == INF:
+            continue
+        army = board.turn_order[rng.randrange(len(board.turn_order))]
+        board.current_turn = army
+        board.red_funds = board.blue_funds = 1000000
+        mngr.unit_create(army.name, unit_type.name, tile.x, tile.y)
+    board.current_turn = board.turn_order[0]
+    return mngr
+
+
+def bench_codec(name: str, map_data: str, density: float = 0.2) -> dict:
+    '''Returns the jsons and codec encode/decode times and sizes.'''
+    board = populate(GameBoard.create(Map.parse(map_data)), density).board
+    store = codec.TerrainStore()
+    old = jsons.dumps(board)
+    new = codec.dumps(board)
+    stored = codec.dumps(board, store)
+    packed = codec.dumpb(board, store)
+    return {
+        'map': name,
+        'tiles': board.width * board.height,
+        'jsons_bytes': len(old),
+        'codec_bytes': len(new),
+        'stored_bytes': len(stored),
+        'zlib_bytes': len(packed),
+        'jsons_encode_ms': time_it(lambda: jsons.dumps(board)),
+        'codec_encode_ms': time_it(lambda: codec.dumps(board)),
+        'stored_encode_ms': time_it(lambda: codec.dumps(board, store)),
+        'zlib_encode_ms': time_it(lambda: codec.dumpb(board, store)),
+        'jsons_decode_ms': time_it(
+            lambda: jsons.loads(old, GameBoard, rules=config)),
+        'codec_decode_ms': time_it(lambda: codec.loads(new, config)),
+        'stored_decode_ms': time_it(
+            lambda: codec.loads(stored, config, store)),
+        'zlib_decode_ms': time_it(
+            lambda: codec.loads(packed, config, store)),
+    }
+
+
+def bench_create(name: str, map_data: str) -> dict:
+    '''Returns the time to create a new board by parsing the map and by
+       copying the template board.'''
+    return {
+        'map': name,
+        'parse_ms': time_it(
+            lambda: GameBoard.create(Map.parse(map_data)), 100),
+        'template_ms': time_it(lambda: GameBoard.from_map(map_data), 100),
+    }
+
+
+def allocated(fn) -> int:
+    '''Returns the bytes still allocated by the object fn returns.'''
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = fn()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def bench_memory(name: str, map_data: str, density: float = 0.2) -> dict:
+    '''Returns the bytes used by the board decoded as a GameBoard and as an
+       ArrayBoard, and the time of a whole board pass (unit_deselect).'''
+    data = codec.encode_board(populate(GameBoard.from_map(map_data),
+                                       density).board)
+    boards = {
+        'objects': lambda: codec.decode_board(data, config),
+        'arrays': lambda: ArrayBoard.from_board(
+            codec.decode_board(data, config)),
+    }
+    result = {'map': name}
+    for layout, load in boards.items():
+        result[layout + '_bytes'] = allocated(load)
+        mngr = GameManager(config, load())
+        result[layout + '_deselect_ms'] = time_it(mngr.unit_deselect, 100)
+    return result
+
+
+def synthetic_map(width: int, height: int, seed: int = 0) -> str:
+    '''Returns the text of a random land map, red's HQ and factory in the
+       top left corner, blue's in the bottom right and a missile silo in the
+       middle.'''
+    rng = random.Random(seed)
+    terrain = ['PLAIN'] * 6 + ['WOOD', 'MOUNTAIN', 'ROAD_HORT', 'CITY']
+    rows = [[rng.choice(terrain) for x in range(width)]
+            for y in range(height)]
+    rows[0][:2] = ['BASE_TOWER_1:RED', 'FACTORY:RED']
+    rows[-1][-2:] = ['FACTORY:BLUE', 'BASE_TOWER_1:BLUE']
+    rows[height // 2][width // 2] = 'MISSILE_SILO'
+    return 'RED,BLUE\n' + '\n'.join(','.join(row) for row in rows) + '\n'
+
+
+def suite_maps() -> dict:
+    '''Returns the maps of the engine suite by name.'''
+    return {
+        'MAP1': MAP1,
+        'MAP_19X18': MAP_19X18,
+        'Scorpion Operation': MAP_SCORPION,
+        'synthetic 64x64': synthetic_map(64, 64),
+        'synthetic 128x128': synthetic_map(128, 128),
+    }
+
+
+def measure(fn, seconds: float = 0.1) -> float:
+    '''Returns the best time in milliseconds of fn, called as many times as
+       fit in about the given seconds (at least 3).'''
+    first = time_it(fn, 1)
+    repeat = int(seconds * 1000 / max(first, 0.001))
+    return min(first, time_it(fn, max(2, min(repeat, 500))))
+
+
+def mover(mngr: GameManager) -> tuple:
+    '''Returns (x, y, x2, y2) of a unit of the current army that can move
+       from x,y to the farthest tile x2,y2 and back.'''
+    army = mngr.board.current_turn
+    for id in sorted(mngr.army_units[army]):
+        x, y = mngr.unit_positions[id]
+        unit = mngr.unit_at(x, y)
+        fuel = unit.status.fuel
+        unit.can_move = True
+        moves = mngr.unit_reachable(unit)
+        for x2, y2 in sorted(moves, key=lambda pos: -moves[pos]):
+            if (x2, y2) == (x, y):
+                continue
+            mngr.unit_move(x, y, x2, y2, False)
+            unit.can_move = True
+            back = (x, y) in mngr.unit_reachable(unit)
+            mngr.unit_place(mngr.unit_remove(x2, y2), x, y)
+            unit.status.fuel = fuel
+            if back:
+                return x, y, x2, y2
+    raise Exception(f'no {army.name} unit can move')
+
+
+def bench_engine(map_data: str, density: float,
+                 seconds: float = 0.1) -> dict:
+    '''Returns the best time in milliseconds of each engine hot path on the
+       map with the unit density.'''
+    mngr = populate(GameBoard.from_map(map_data), density)
+    board = mngr.board
+    army = board.current_turn
+    if not mngr.army_units[army]:
+        tile = next(tile for tile in board.grid if not tile.unit and
+                    movement_cost[tile.mapTile.type][UnitClass.FOOT.value]
+                    != INF)
+        mngr.unit_create(army.name, 'INFANTRY', tile.x, tile.y)
+    x, y, x2, y2 = mover(mngr)
+    unit = mngr.unit_at(x, y)
+    source = mngr.tile_at(x, y)
+    costs = mngr.cost_grid(unit.status.cls)
+    # the standable tile farthest away, searched from end to end
+    target = max((tile for tile in board.grid
+                  if costs[tile.x + tile.y * board.width] != INF),
+                 key=lambda tile: abs(tile.x - x) + abs(tile.y - y))
+    fuel = unit.status.fuel
+    position = [x, y, x2, y2]
+
+    def move():
+        unit.can_move = True
+        unit.status.fuel = fuel
+        mngr.unit_move(*position)
+        position[:] = position[2:] + position[:2]
+
+    silo = map_tile(MapType.MISSILE_SILO)
+    terrain = source.mapTile
+
+    def launch():
+        source.mapTile = silo
+        mngr.terrain_changed()
+        mngr.launch_missile(x, y, board.width // 2, board.height // 2)
+
+    result = {
+        'dijkstra_ms': measure(
+            lambda: dijkstra(board, source, target, INF, costs), seconds),
+        'unit_select_ms': measure(
+            lambda: (mngr.unit_select(x, y), mngr.unit_deselect()), seconds),
+        'unit_move_ms': measure(move, seconds),
+    }
+    if position[:2] != [x, y]:
+        move()
+    result['launch_missile_ms'] = measure(launch, seconds)
+    source.mapTile = terrain
+    mngr.terrain_changed()
+    text = jsons.dumps(board)
+    result['jsons_encode_ms'] = measure(lambda: jsons.dumps(board), seconds)
+    result['jsons_decode_ms'] = measure(
+        lambda: jsons.loads(text, GameBoard, rules=config), seconds)
+    result['map_parse_ms'] = measure(lambda: Map.parse(map_data), seconds)
+    result['army_end_turn_ms'] = measure(mngr.army_end_turn, seconds)
+    return result
+
+
+def run_suite(maps: dict, densities=(0.05, 0.2),
+              seconds: float = 0.1) -> dict:
+    '''Returns the engine timings of every map and density, keyed by case
+       name, with the python version they were taken with.'''
+    cases = {}
+    for name, map_data in maps.items():
+        for density in densities:
+            case = f'{name} {density:.0%}'
+            cases[case] = bench_engine(map_data, density, seconds)
+    return {'python': sys.version.split()[0], 'cases': cases}
+
+
+def compare(baseline: dict, results: dict, threshold: float = 0.25) -> list:
+    '''Returns (case, metric, baseline ms, ms, ratio, regressed) of every
+       timing in both results, regressed when it is more than threshold
+       slower than the baseline.'''
+    rows = []
+    for case, metrics in results['cases'].items():
+        old = baseline['cases'].get(case, {})
+        for metric, ms in metrics.items():
+            if metric not in old:
+                continue
+            ratio = ms / old[metric] if old[metric] else 1.0
+            rows.append((case, metric, old[metric], ms, ratio,
+                         ratio > 1 + threshold))
+    return rows
+
+
+def suite_main(argv: list):
+    parser = argparse.ArgumentParser(
+        prog='benchmark.py --suite',
+        description='times the engine hot paths on every map and density')
+    parser.add_argument('--maps', help='comma separated map names')
+    parser.add_argument('--densities', default='0.05,0.2')
+    parser.add_argument('--seconds', type=float, default=0.1,
+                        help='time spent on each measurement')
+    parser.add_argument('--save', help='write the results to a JSON file')
+    parser.add_argument('--compare', help='JSON baseline to compare with')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='slowdown flagged as a regression')
+    args = parser.parse_args(argv)
+    maps = suite_maps()
+    if args.maps:
+        names = args.maps.split(',')
+        for name in names:
+            if name not in maps:
+                parser.error(f'unknown map {name}, one of {", ".join(maps)}')
+        maps = {name: maps[name] for name in names}
+    densities = [float(density) for density in args.densities.split(',')]
+    results = run_suite(maps, densities, args.seconds)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if not args.compare:
+        metrics = list(next(iter(results['cases'].values())))
+        print(f'{"case":<24} ' + ' '.join(
+            f'{metric[:-3]:>15}' for metric in metrics))
+        for case, result in results['cases'].items():
+            print(f'{case:<24} ' + ' '.join(
+                f'{result[metric]:>15.3f}' for metric in metrics))
+        return
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    rows = compare(baseline, results, args.threshold)
+    print(f'{"case":<24} {"metric":<18} {"baseline ms":>12} {"ms":>10} '
+          f'{"ratio":>6}')
+    for case, metric, old, ms, ratio, regressed in rows:
+        print(f'{case:<24} {metric[:-3]:<18} {old:>12.3f} {ms:>10.3f} '
+              f'{ratio:>6.2f}' + ('  REGRESSION' if regressed else ''))
+    regressions = sum(row[5] for row in rows)
+    if regressions:
+        print(f'{regressions} regressions beyond {args.threshold:.0%}')
+        sys.exit(1)
+
+
+def rpc(url: str, method: str, **params):
+    '''Calls the JSON-RPC method on the server and returns the result.'''
+    body = json.dumps({'jsonrpc': '2.0', 'method': method,
+                       'params': params, 'id': 1}).encode()
+    request = urllib.request.Request(
+        url + '/api', body, {'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())['result']
+
+
+def bench_http(url: str, clients: int = 8, requests: int = 100) -> dict:
+    '''Returns the requests per second of clients playing in parallel, each
+       one repeating game_board, unit_select and tile on its own game.'''
+    def play(n):
+        token = 'bench' + secrets.token_hex(4)
+        rpc(url, 'game_create', token=token)
+        rpc(url, 'unit_create', token=token, army='RED',
+            unit_type='INFANTRY', x=3, y=1)
+        start = time.perf_counter()
+        for i in range(0, requests, 3):
+            rpc(url, 'game_board', token=token)
+            rpc(url, 'unit_select', token=token, x=3, y=1)
+            rpc(url, 'tile', token=token, x=3, y=2)
+        elapsed = time.perf_counter() - start
+        rpc(url, 'game_delete', token=token)
+        return elapsed
+    with ThreadPoolExecutor(clients) as pool:
+        start = time.perf_counter()
+        list(pool.map(play, range(clients)))
+        elapsed = time.perf_counter() - start
+    total = clients * len(range(0, requests, 3)) * 3
+    return {'clients': clients, 'requests': total,
+            'requests_per_sec': total / elapsed}
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--suite':
+        suite_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 2 and sys.argv[1] == '--http':
+        args = [int(arg) for arg in sys.argv[3:5]]
+        result = bench_http(sys.argv[2], *args)
+        print(f'{result["clients"]} clients {result["requests"]} requests '
+              f'{result["requests_per_sec"]:.1f} requests/sec')
+        return
+    print(f'{"map":<20} {"tiles":>6} {"":>7} {"bytes":>8} '
+          f'{"encode ms":>10} {"decode ms":>10}')
+    for name, map_data in MAPS.items():
+        result = bench_codec(name, map_data)
+        for fmt in ('jsons', 'codec', 'stored', 'zlib'):
+            print(f'{name:<20} {result["tiles"]:>6} {fmt:>7} '
+                  f'{result[fmt + "_bytes"]:>8} '
+                  f'{result[fmt + "_encode_ms"]:>10.2f} '
+                  f'{result[fmt + "_decode_ms"]:>10.2f}')
+    print()
+    print(f'{"new board":<20} {"parse ms":>10} {"template ms":>12}')
+    for name, map_data in MAPS.items():
+        result = bench_create(name, map_data)
+        print(f'{name:<20} {result["parse_ms"]:>10.3f} '
+              f'{result["template_ms"]:>12.3f}')
+    print()
+    print(f'{"board memory":<20} {"layout":>8} {"bytes":>8} '
+          f'{"deselect ms":>12}')
+    for name, map_data in MAPS.items():
+        result = bench_memory(name, map_data)
+        for layout in ('objects', 'arrays'):
+            print(f'{name:<20} {layout:>8} {result[layout + "_bytes"]:>8} '
+                  f'{result[layout + "_deselect_ms"]:>12.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+'''[This module encodes the game board for storage]
+
+A compact, versioned alternative to jsons reflection.  Terrain, ownership
+and capture HP are stored as run-length encoded arrays of ids, units as a
+sparse list of [index, army, type, id, flags, hp, fuel, ammo, cargo] records
+and the per-type unit stats are taken from the config on decode rather than
+stored with every unit.
+
+Given a TerrainStore the terrain is not stored with the board at all: the
+board keeps the key of its map's terrain, which is stored once for every
+game on that map, and only the tiles that have changed since (used silos).
+
+dumpb() stores the same data in a packed binary form, see pack(), compressed
+with zlib.
+'''
+
+import json
+import zlib
+
+import jsons
+
+from army import Army
+from config import Config
+from gameboard import GameBoard, GameTile
+from mapping import MapType, map_tile, map_terrain, terrain_key
+from unit import Unit, UnitStatus, UnitType
+
+CODEC_VERSION = 2
+
+CAN_MOVE = 1
+CAN_ATTACK = 2
+CAN_CAPTURE = 4
+
+# packed value tags, see pack()
+TAG_NONE = 0
+TAG_FALSE = 1
+TAG_TRUE = 2
+TAG_INT = 3
+TAG_STR = 4
+TAG_LIST = 5
+TAG_DICT = 6
+
+
+def rle_encode(values: list) -> list:
+    '''Returns the values as a list of [value, count] runs.'''
+    runs = []
+    for value in values:
+        if runs and runs[-1][0] == value:
+            runs[-1][1] += 1
+        else:
+            runs.append([value, 1])
+    return runs
+
+
+def rle_decode(runs: list) -> list:
+    '''Returns the values from a list of [value, count] runs.'''
+    values = []
+    for value, count in runs:
+        values.extend([value] * count)
+    return values
+
+
+def pack_uint(out: bytearray, value: int):
+    '''Appends the unsigned int as a varint, 7 bits a byte.'''
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def unpack_uint(data: bytes, i: int) -> tuple:
+    '''Returns the varint at i and the index after it.'''
+    value = shift = 0
+    while True:
+        byte = data[i]
+        i += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, i
+        shift += 7
+
+
+def pack(value, out: bytearray = None) -> bytearray:
+    '''Packs None, bools, ints, strs, lists and dicts with str keys into
+       tagged bytes, msgpack style.  Ints are zigzag varints so the small
+       ids and counts that make up a board take one byte each.'''
+    if out is None:
+        out = bytearray()
+    if value is None:
+        out.append(TAG_NONE)
+    elif value is True:
+        out.append(TAG_TRUE)
+    elif value is False:
+        out.append(TAG_FALSE)
+    elif isinstance(value, int):
+        out.append(TAG_INT)
+        pack_uint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+    elif isinstance(value, str):
+        text = value.encode()
+        out.append(TAG_STR)
+        pack_uint(out, len(text))
+        out += text
+    elif isinstance(value, (list, tuple)):
+        out.append(TAG_LIST)
+        pack_uint(out, len(value))
+        for item in value:
+            pack(item, out)
+    elif isinstance(value, dict):
+        out.append(TAG_DICT)
+        pack_uint(out, len(value))
+        for key, item in value.items():
+            pack(key, out)
+            pack(item, out)
+    else:
+        raise Exception(f'can not pack {type(value).__name__}')
+    return out
+
+
+def unpack(data: bytes, i: int = 0) -> tuple:
+    '''Returns the value packed at i and the index after it.'''
+    tag = data[i]
+    i += 1
+    if tag == TAG_NONE:
+        return None, i
+    if tag == TAG_TRUE:
+        return True, i
+    if tag == TAG_FALSE:
+        return False, i
+    if tag == TAG_INT:
+        value, i = unpack_uint(data, i)
+        return (value >> 1 if not value & 1 else -((value + 1) >> 1)), i
+    if tag == TAG_STR:
+        size, i = unpack_uint(data, i)
+        return data[i:i + size].decode(), i + size
+    if tag == TAG_LIST:
+        size, i = unpack_uint(data, i)
+        items = []
+        for n in range(size):
+            item, i = unpack(data, i)
+            items.append(item)
+        return items, i
+    if tag == TAG_DICT:
+        size, i = unpack_uint(data, i)
+        items = {}
+        for n in range(size):
+            key, i = unpack(data, i)
+            items[key], i = unpack(data, i)
+        return items, i
+    raise Exception(f'bad packed tag {tag}')
+
+
+class TerrainStore():
+    '''Terrain of each map stored once, keyed by terrain_key().
+
+       load(key) returns the (width, height, terrain) stored elsewhere for
+       a key missing here, or None, and save(key, width, height, terrain)
+       stores new terrain.  Without them terrain is only kept in memory.
+       The terrain of a map boards were created from is found in
+       mapping.map_terrain.'''
+
+    def __init__(self, load=None, save=None):
+        self.load = load
+        self.save = save
+        self._terrain = {}
+
+    def __len__(self):
+        return len(self._terrain)
+
+    def put(self, width: int, height: int, terrain: list) -> str:
+        '''Stores the terrain, a list of MapType values, and returns its
+           key.'''
+        key = terrain_key(width, height, terrain)
+        if key not in self._terrain:
+            if self.save:
+                self.save(key, width, height, terrain)
+            self._terrain[key] = (width, height, terrain)
+        return key
+
+    def get(self, key: str) -> tuple:
+        '''Returns the (width, height, terrain) stored for the key.'''
+        if key not in self._terrain:
+            found = self.load(key) if self.load else None
+            if found is None:
+                found = map_terrain.get(key)
+                if found is None:
+                    raise Exception(f'unknown terrain {key}')
+                if self.save:
+                    self.save(key, *found)
+            self._terrain[key] = found
+        return self._terrain[key]
+
+
+def encode_unit(unit: Unit) -> list:
+    '''Returns the unit as a compact record.'''
+    flags = ((CAN_MOVE if unit.can_move else 0) |
+             (CAN_ATTACK if unit.can_attack else 0) |
+             (CAN_CAPTURE if unit.can_capture else 0))
+    return [unit.army.value, unit.type.value, unit.id, flags,
+            unit.status.hp, unit.status.fuel, unit.status.ammo,
+            [encode_unit(cargo) for cargo in unit.status.cargo]]
+
+
+def decode_unit(record: list, config: Config) -> Unit:
+    '''Returns the unit from a compact record.'''
+    army, type, id, flags, hp, fuel, ammo, cargo = record
+    type = UnitType(type)
+    status = UnitStatus(config.stats[type.value], hp, fuel, ammo,
+                        [decode_unit(c, config) for c in cargo])
+    return Unit(Army(army), type, status, id, bool(flags & CAN_MOVE),
+                bool(flags & CAN_ATTACK), bool(flags & CAN_CAPTURE))
+
+
+def encode_board(board: GameBoard, store: TerrainStore = None) -> dict:
+    '''Returns the board as a dict of plain lists and ints.  With a store
+       the terrain is replaced by its key and the changed tiles.'''
+    grid = board.grid
+    selected = None
+    if board.selected:
+        selected = board.selected.x + board.selected.y * board.width
+    terrain = [t.mapTile.type.value for t in grid]
+    data = {
+        'v': CODEC_VERSION,
+        'w': board.width,
+        'h': board.height,
+        'owner': rle_encode([t.mapTile.army.value if t.mapTile.army else -1
+                             for t in grid]),
+        'capture': rle_encode([t.capture_hp for t in grid]),
+        'units': [[i] + encode_unit(t.unit)
+                  for i, t in enumerate(grid) if t.unit],
+        'moved': [i for i, t in enumerate(grid) if t.can_be_moved_to],
+        'attacked': [i for i, t in enumerate(grid) if t.can_be_attacked],
+        'selected': selected,
+        'turn_order': [army.value for army in board.turn_order],
+        'turn': board.current_turn.value if board.current_turn else None,
+        'active': board.game_active,
+        'red': [board.total_red_troops, board.total_red_properties,
+                board.red_funds],
+        'blue': [board.total_blue_troops, board.total_blue_properties,
+                 board.blue_funds],
+        'days': board.days,
+        'version': board.version,
+        'next_id': board.next_unit_id,
+    }
+    if store is None:
+        data['terrain'] = rle_encode(terrain)
+        if board.map_id:
+            data['map'] = board.map_id
+        return data
+    map_id = board.map_id
+    if not map_id:
+        # a board decoded with its terrain inline, which becomes its map
+        map_id = store.put(board.width, board.height, terrain)
+    base = store.get(map_id)[2]
+    data['map'] = map_id
+    data['changed'] = [[i, value] for i, (value, old)
+                       in enumerate(zip(terrain, base)) if value != old]
+    return data
+
+
+def decode_board(data: dict, config: Config,
+                 store: TerrainStore = None) -> GameBoard:
+    '''Returns the board from a dict made by encode_board, the store is
+       needed if it was given to encode_board.'''
+    if data['v'] not in (1, CODEC_VERSION):
+        raise Exception(f'unsupported board version {data["v"]}')
+    width = data['w']
+    if 'terrain' in data:
+        terrain = rle_decode(data['terrain'])
+    else:
+        if store is None:
+            raise Exception('board terrain is in a terrain store')
+        terrain = list(store.get(data['map'])[2])
+        for i, value in data['changed']:
+            terrain[i] = value
+    owner = rle_decode(data['owner'])
+    capture = rle_decode(data['capture'])
+    board = GameBoard(width, data['h'])
+    grid = board.grid
+    for i, type in enumerate(terrain):
+        army = Army(owner[i]) if owner[i] >= 0 else None
+        grid.append(GameTile(i % width, i // width,
+                             mapTile=map_tile(MapType(type), army),
+                             capture_hp=capture[i]))
+    for record in data['units']:
+        grid[record[0]].unit = decode_unit(record[1:], config)
+    for i in data['moved']:
+        grid[i].can_be_moved_to = True
+    for i in data['attacked']:
+        grid[i].can_be_attacked = True
+    if data['selected'] is not None:
+        board.selected = grid[data['selected']]
+    board.turn_order = [Army(army) for army in data['turn_order']]
+    if data['turn'] is not None:
+        board.current_turn = Army(data['turn'])
+    board.game_active = data['active']
+    (board.total_red_troops, board.total_red_properties,
+     board.red_funds) = data['red']
+    (board.total_blue_troops, board.total_blue_properties,
+     board.blue_funds) = data['blue']
+    board.days = data['days']
+    board.version = data['version']
+    board.next_unit_id = data['next_id']
+    board.map_id = data.get('map', '')
+    return board
+
+
+def load_legacy_unit(data: dict, cls=Unit, **kwargs) -> Unit:
+    '''jsons deserializer for units of boards saved by jsons.dumps, when
+       every unit carried a full copy of its type's stats.  The stats are
+       taken from the rules passed to jsons.load as rules=config.'''
+    config = kwargs.get('rules')
+    if config is None:
+        raise Exception('Legacy units need the rules of their game')
+    type = UnitType[data['type']]
+    status = data['status']
+    cargo = [load_legacy_unit(unit, cls, **kwargs)
+             for unit in status['cargo']]
+    return Unit(Army[data['army']], type,
+                UnitStatus(config.stats[type.value], status['hp'],
+                           status['fuel'], status['ammo'], cargo),
+                data['id'], data['can_move'], data['can_attack'],
+                data['can_capture'])
+
+
+jsons.set_deserializer(load_legacy_unit, Unit)
+
+
+def dumps(board: GameBoard, store: TerrainStore = None) -> str:
+    '''Returns the board encoded as compact JSON text.'''
+    return json.dumps(encode_board(board, store), separators=(',', ':'))
+
+
+def dumpb(board: GameBoard, store: TerrainStore = None) -> bytes:
+    '''Returns the board packed and compressed.'''
+    return zlib.compress(bytes(pack(encode_board(board, store))))
+
+
+def loads(text, config: Config, store: TerrainStore = None) -> GameBoard:
+    '''Returns the board from bytes made by dumpb, text made by dumps, or
+       by jsons.dumps for boards saved before the codec existed.'''
+    if isinstance(text, (bytes, bytearray, memoryview)):
+        return decode_board(unpack(zlib.decompress(text))[0], config, store)
+    data = json.loads(text)
+    if 'v' not in data:
+        return jsons.load(data, GameBoard, rules=config)
+    return decode_board(data, config, store)
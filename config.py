@@ -1,26 +1,74 @@
+'''[This module compiles the game rules from config.ini]
+
+The file is parsed once into typed tables: the UnitConfig of every unit
+type indexed by UnitType.value, the income of a property and the unit
+classes each property repairs.  Config.reload() compiles the file again
+when it has changed on disk.
+'''
+
+import os
 from configparser import ConfigParser
+from functools import lru_cache
 
+from mapping import MapType
 from unit import UnitType, UnitClass, UnitConfig
 
 
+@lru_cache(maxsize=1)
+def load_rules(path: str, mtime: float = 0) -> tuple:
+    '''Returns (unit stats, income, repair classes) compiled from the file.
+       Only the latest compiled file is cached, so Configs of the same file
+       share its stats and an edited file frees the rules it replaced.'''
+    cfg = ConfigParser()
+    cfg.read(path)
+    units = []
+    for unit_type in UnitType:
+        name = unit_type.name
+        units.append(UnitConfig(
+            UnitClass[cfg.get(name, 'class')],
+            int(cfg.get(name, 'cost')),
+            int(cfg.get(name, 'move')),
+            int(cfg.get(name, 'rangemin')),
+            int(cfg.get(name, 'rangemax')),
+            int(cfg.get(name, 'fuel')),
+            int(cfg.get(name, 'vision')),
+            int(cfg.get(name, 'hp')),
+            int(cfg.get(name, 'ammo')),
+        ))
+    repair = {map_type: frozenset() for map_type in MapType}
+    if cfg.has_section('REPAIR'):
+        for name in cfg.options('REPAIR'):
+            repair[MapType[name.upper()]] = frozenset(
+                UnitClass[cls] for cls in cfg.get('REPAIR', name).split())
+    return tuple(units), cfg.getint('FUNDS', 'income'), repair
+
+
 class Config:
-    def __init__(self):
-        cfg = ConfigParser()
-        cfg.read('config.ini')
-
-        # get unit configs
-        self.units = {}
-        for unit_type in UnitType:
-            name = unit_type.name
-            self.units[name] = UnitConfig(
-                UnitClass[cfg.get(name, 'class')],
-                int(cfg.get(name, 'cost')),
-                int(cfg.get(name, 'move')),
-                int(cfg.get(name, 'rangemin')),
-                int(cfg.get(name, 'rangemax')),
-                int(cfg.get(name, 'fuel')),
-                int(cfg.get(name, 'vision')),
-                int(cfg.get(name, 'hp')),
-                int(cfg.get(name, 'ammo')),
-                []
-            )
+    '''The compiled rules, read with attribute and index lookups.'''
+
+    def __init__(self, path: str = 'config.ini'):
+        self.path = path
+        self.mtime = None
+        self.reload()
+
+    def reload(self) -> bool:
+        '''Compiles the file again if it changed since it was last read.
+           Units already on a board keep the stats they were created with
+           until their game is loaded again.
+        :return: [True if the rules were replaced]'''
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = 0
+        if mtime == self.mtime:
+            return False
+        self.stats, self.income, self.repair = load_rules(self.path, mtime)
+        # get unit configs by name
+        self.units = {unit_type.name: self.stats[unit_type.value]
+                      for unit_type in UnitType}
+        self.mtime = mtime
+        return True
+
+
+# the rules shared by the app and new boards
+rules = Config()
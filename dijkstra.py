@@ -5,116 +5,105 @@ between that node and every other. It can also be used for finding
 the shortest paths from a single node to a single destination node by stopping
 the algorithm once the shortest path to the destination node has been
 determined
+
+The frontier is kept in a binary heap and the search stops as soon as the
+cheapest unsettled node costs more than the given budget (the unit's move or
+fuel), so a lookup only touches the tiles the unit could actually reach.
 '''
 
-from dataclasses import dataclass
-from typing import List
-from mapping import movement_cost
+import heapq
+from typing import Dict, List, Tuple
+from array import array
+from mapping import compile_cost_grids
 
 from gameboard import GameTile, GameBoard
 
 INF = 99999999
 
 
-@dataclass
-class Node():
-    '''Defines the node.'''
-    x: int
-    y: int
-    cost: int
-    occupied: bool
-    visited: bool
-    distance: float
-
-
-@dataclass
-class Area():
-    '''Defines the list of nodes, width and hight.'''
-    nodes: List[Node]
-    width: int
-    height: int
-
-
-def least_unvisited_distance(area):
-    '''Returns the least unvisited distance.'''
-    candidate = None
-    for node in area.nodes:
-        if node.occupied or node.visited:
+def cost_grid(board: GameBoard, cls: int) -> array:
+    '''Returns the movement cost grid of the board for the unit class.'''
+    return compile_cost_grids(board.terrain_types())[cls]
+
+
+def _search(board: GameBoard, source: GameTile, budget: int,
+            costs: array = None, target: GameTile = None) -> Tuple[dict, dict]:
+    '''Searches outwards from the source tile for the unit on it, stopping
+       once the target (if given) is settled.
+    :return: [(movement cost, previous grid index) of each grid index
+              reached within budget]'''
+    unit = source.unit
+    if costs is None:
+        costs = cost_grid(board, unit.status.cls.value)
+    width = board.width
+    height = board.height
+    unit_at = board.unit_at_index
+    start = source.x + source.y * width
+    goal = target.x + target.y * width if target else None
+    dist = {start: 0}
+    prev = {}
+    heap = [(0, start)]
+    while heap:
+        cost, index = heapq.heappop(heap)
+        if cost > dist[index]:
+            # stale heap entry
             continue
-        if not candidate or node.distance < candidate.distance:
-            candidate = node
-    return candidate
-
-
-def node_at(area, x, y):
-    if x < 0 or y < 0 or x >= area.width or y >= area.height:
-        return None
-    index = x + y * area.width
-    if index >= 0 and index < len(area.nodes):
-        return area.nodes[index]
-    return None
-
-
-def calc_neighbor_distances(area, current_node):
-    '''East, West, North, South nodes'''
-    # West
-    node = node_at(area, current_node.x - 1, current_node.y)
-    if node and not node.occupied:
-        new_dist = current_node.distance + node.cost
-        if new_dist < node.distance:
-            node.distance = new_dist
-    # North node
-    node = node_at(area, current_node.x, current_node.y - 1)
-    if node and not node.occupied:
-        new_dist = current_node.distance + node.cost
-        if new_dist < node.distance:
-            node.distance = new_dist
-    # East node
-    node = node_at(area, current_node.x + 1, current_node.y)
-    if node and not node.occupied:
-        new_dist = current_node.distance + node.cost
-        if new_dist < node.distance:
-            node.distance = new_dist
-    # South node
-    node = node_at(area, current_node.x, current_node.y + 1)
-    if node and not node.occupied:
-        new_dist = current_node.distance + node.cost
-        if new_dist < node.distance:
-            node.distance = new_dist
-
-
-def dijkstra(board: GameBoard, source: GameTile, target: GameTile) -> int:
+        if index == goal:
+            break
+        x = index % width
+        y = index // width
+        # West, North, East, South
+        for nx, ny in ((x - 1, y), (x, y - 1), (x + 1, y), (x, y + 1)):
+            if nx < 0 or ny < 0 or nx >= width or ny >= height:
+                continue
+            n = nx + ny * width
+            occupant = unit_at(n)
+            if occupant is not None and occupant.army != unit.army:
+                continue
+            new_cost = cost + costs[n]
+            if new_cost > budget:
+                continue
+            if new_cost < dist.get(n, INF):
+                dist[n] = new_cost
+                prev[n] = index
+                heapq.heappush(heap, (new_cost, n))
+    return dist, prev
+
+
+def shortest_path(board: GameBoard, source: GameTile, target: GameTile,
+                  budget: int = INF,
+                  costs: array = None) -> Tuple[int, List[Tuple[int, int]]]:
+    '''Returns the movement cost and the path of (x, y) coordinates from the
+       source tile to the target tile for the unit on the source tile.
+       Returns (INF, []) when the target cannot be reached within budget.
+       costs is the cost grid for the unit class, see cost_grid().'''
+    dist, prev = _search(board, source, budget, costs, target)
+    width = board.width
+    start = source.x + source.y * width
+    index = target.x + target.y * width
+    if index not in dist:
+        return INF, []
+    cost = dist[index]
+    path = [(target.x, target.y)]
+    while index != start:
+        index = prev[index]
+        path.append((index % width, index // width))
+    path.reverse()
+    return cost, path
+
+
+def dijkstra(board: GameBoard, source: GameTile, target: GameTile,
+             budget: int = INF, costs: array = None) -> int:
     """Dijkstra's Path Finding Algorithm for a rectangular grid where the
        distance between each adjacent (non-diagonal) node is given by the
        variable cost"""
-    # mark all nodes unvisited
-    # set the distance to 0 for initial node and infinity for others
-    nodes = []
-    for tile in board.grid:
-        cost = movement_cost[tile.mapTile.type][source.unit.status.cls.value]
-        occupied = tile.unit != None and tile.unit.army != source.unit.army
-        visited = False
-        dist = INF
-        if source.x == tile.x and source.y == tile.y:
-            dist = 0
-        node = Node(tile.x, tile.y, cost, occupied, visited, dist)
-        nodes.append(node)
-    area = Area(nodes, board.width, board.height)
-    destination = node_at(area, target.x, target.y)
-    while True:
-        # select the unvisited node with the smallest distance,
-        #  make it the current node
-        current_node = least_unvisited_distance(area)
-        # print(current_node, current_node.x, current_node.y)
-        # find unvisited neighbours and calc distances,
-        # compare to assigned distance and save if is smaller
-        calc_neighbor_distances(area, current_node)
-        # set current node as visited
-        current_node.visited = True
-        # check if destination has been visited
-        if destination.visited:
-            return destination.distance
-        # check smallest unvisited distance
-        node = least_unvisited_distance(area)
-        if not node or node.distance >= INF:
-            return INF
+    return shortest_path(board, source, target, budget, costs)[0]
+
+
+def reachable(board: GameBoard, source: GameTile, budget: int,
+              costs: array = None) -> Dict[Tuple[int, int], int]:
+    '''Returns the movement cost of every (x, y) coordinate the unit on the
+       source tile can reach within budget, including the source itself.'''
+    dist, _ = _search(board, source, budget, costs)
+    width = board.width
+    return {(i % width, i // width): cost for i, cost in dist.items()}
@@ -0,0 +1,87 @@
+'''[This module tells the other workers when a game has changed]
+
+When several worker processes share one database each keeps its own game
+cache.  After a worker commits an action it publishes the game token and
+the new board version on the bus, and the other workers drop their cached
+copy if it is older so their next call reloads the game from the database.
+
+The backend is chosen by url: memory:// keeps messages inside the process
+(a single worker, or tests) and redis://host:port/db uses Redis pub/sub,
+which needs the redis package.
+'''
+
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'aw-rpc-games'
+
+
+def spawn_thread(fn):
+    '''Runs fn on a daemon thread.'''
+    thread = threading.Thread(target=fn, daemon=True)
+    thread.start()
+    return thread
+
+
+class LocalBus():
+    '''In process bus, handlers are called straight away.'''
+
+    def __init__(self):
+        self._handlers = []
+
+    def publish(self, message: dict):
+        for handler in list(self._handlers):
+            handler(message)
+
+    def subscribe(self, handler, spawn=None):
+        self._handlers.append(handler)
+
+    def unsubscribe(self, handler):
+        self._handlers.remove(handler)
+
+
+class RedisBus():
+    '''Redis pub/sub bus, each subscriber listens on its own thread.'''
+
+    def __init__(self, url, channel=CHANNEL):
+        try:
+            import redis
+        except ImportError:
+            raise Exception(f'the redis package is needed for {url}')
+        self._redis = redis.Redis.from_url(url)
+        self._errors = (redis.ConnectionError, redis.TimeoutError)
+        self.channel = channel
+
+    def publish(self, message: dict):
+        self._redis.publish(self.channel, json.dumps(message))
+
+    def subscribe(self, handler, spawn=None):
+        '''Calls handler(message) for every message published, using
+           spawn(fn) to run the listener, a daemon thread by default.'''
+        def listen():
+            while True:
+                try:
+                    pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(self.channel)
+                    for item in pubsub.listen():
+                        try:
+                            handler(json.loads(item['data']))
+                        except Exception as ex:
+                            logger.error(f'game bus handler failed: {ex}')
+                except self._errors as ex:
+                    logger.error(f'game bus connection lost: {ex}')
+                    time.sleep(1)
+        (spawn or spawn_thread)(listen)
+
+
+def connect(url):
+    '''Returns the bus for the url.'''
+    if not url or url.startswith('memory://'):
+        return LocalBus()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBus(url)
+    raise Exception(f'unsupported game bus url {url}')
@@ -0,0 +1,178 @@
+'''[This module keeps recently used games in memory]
+
+Games are kept as live GameManager objects keyed by token so an RPC does not
+have to query and decode the board on every call.  Saves are coalesced: a
+changed game is marked dirty with a snapshot of its board and the latest
+snapshot is written by a background flusher every save_interval seconds (or
+straight away when the interval is 0), and always on eviction and shutdown.
+The flusher only writes snapshots so it never reads a board while an action
+is changing it.
+'''
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class CacheEntry():
+    '''A cached game and its bookkeeping.'''
+
+    def __init__(self, mngr, size):
+        self.mngr = mngr
+        self.size = size
+        self.dirty = False
+        self.snapshot = None
+        self.evicted = False
+        self.lock = threading.RLock()
+
+
+class GameCache():
+    '''LRU cache of GameManager objects with write-behind saving.
+
+       save(token, snapshot) is called to persist a game snapshot.
+       sizeof(mngr) returns the bytes a game takes in memory, counted
+       against max_bytes when it is added and each time it is saved.'''
+
+    def __init__(self, save, max_games=256, max_bytes=64 * 1024 * 1024,
+                 save_interval=0.0, sizeof=None):
+        self.save = save
+        self.sizeof = sizeof or (lambda mngr: 0)
+        self.max_games = max_games
+        self.max_bytes = max_bytes
+        self.save_interval = save_interval
+        self.hits = 0
+        self.misses = 0
+        self._games = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self._flusher = None
+
+    def __len__(self):
+        return len(self._games)
+
+    def __contains__(self, token):
+        return token in self._games
+
+    def get(self, token):
+        '''Returns the cached game manager for the token or None.'''
+        with self._lock:
+            entry = self._games.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._games.move_to_end(token)
+            self.hits += 1
+            return entry.mngr
+
+    def peek(self, token):
+        '''Returns the cached game manager for the token or None, without
+           counting it as a use.'''
+        with self._lock:
+            entry = self._games.get(token)
+        return entry.mngr if entry else None
+
+    def put(self, token, mngr):
+        '''Adds the game to the cache, evicting the least recently used
+           games when over the game count or memory limit.'''
+        size = self.sizeof(mngr)
+        with self._lock:
+            old = self._games.pop(token, None)
+            if old:
+                self._bytes -= old.size
+            self._games[token] = CacheEntry(mngr, size)
+            self._bytes += size
+            victims = []
+            while len(self._games) > 1 and (
+                    len(self._games) > self.max_games or
+                    self._bytes > self.max_bytes):
+                victim, entry = self._games.popitem(last=False)
+                self._bytes -= entry.size
+                victims.append((victim, entry))
+        for victim, entry in victims:
+            self._retire(victim, entry, flush=True)
+
+    def mark_dirty(self, token, snapshot) -> bool:
+        '''Records the snapshot to save for the changed game.  Returns
+           false if the game is not cached so the caller must save it.'''
+        with self._lock:
+            entry = self._games.get(token)
+            if entry is None:
+                return False
+            # units come and go, so the size is estimated again
+            size = self.sizeof(entry.mngr)
+            self._bytes += size - entry.size
+            entry.size = size
+        with entry.lock:
+            entry.snapshot = snapshot
+            entry.dirty = True
+        if self.save_interval <= 0:
+            self._flush_entry(token, entry)
+        return True
+
+    def evict(self, token, flush=True):
+        '''Removes the game from the cache, saving it first if flush.'''
+        with self._lock:
+            entry = self._games.pop(token, None)
+            if entry:
+                self._bytes -= entry.size
+        if entry:
+            self._retire(token, entry, flush)
+
+    def flush(self):
+        '''Saves every dirty game.'''
+        with self._lock:
+            entries = list(self._games.items())
+        for token, entry in entries:
+            if entry.dirty:
+                self._flush_entry(token, entry)
+
+    def close(self):
+        '''Saves and drops every game, used at shutdown.'''
+        with self._lock:
+            entries = list(self._games.items())
+            self._games.clear()
+            self._bytes = 0
+        for token, entry in entries:
+            self._retire(token, entry, flush=True)
+
+    def start(self, spawn=None):
+        '''Starts the background flusher using spawn(fn) to run it,
+           a plain daemon thread by default.'''
+        with self._lock:
+            if self.save_interval <= 0 or self._flusher:
+                return
+            self._flusher = True
+        if spawn is None:
+            def spawn(fn):
+                thread = threading.Thread(target=fn, daemon=True)
+                thread.start()
+                return thread
+        self._flusher = spawn(self._run)
+
+    def _run(self):
+        while True:
+            time.sleep(self.save_interval)
+            try:
+                self.flush()
+            except Exception as ex:
+                logger.error(f'game cache flush failed: {ex}')
+
+    def _retire(self, token, entry, flush):
+        with entry.lock:
+            if flush and entry.dirty:
+                self._flush_entry(token, entry)
+            entry.evicted = True
+
+    def _flush_entry(self, token, entry):
+        with entry.lock:
+            if entry.evicted or not entry.dirty:
+                return
+            entry.dirty = False
+            try:
+                self.save(token, entry.snapshot)
+            except Exception:
+                entry.dirty = True
+                raise
@@ -0,0 +1,72 @@
+'''[This module runs the calls for each game one at a time]
+
+Each game token has a turnstile: a caller takes the next ticket and waits
+until its number is served, then runs its call on its own thread, in its
+own context, and hands the turn to the next ticket.  Calls on one game
+never overlap and run in the order they arrived, while calls on different
+games run in parallel.
+'''
+
+import threading
+from contextlib import contextmanager
+
+
+class Turnstile():
+    '''The tickets of one game.'''
+    __slots__ = ('next', 'serving', 'owner', 'turn')
+
+    def __init__(self, lock):
+        self.next = 0
+        self.serving = 0
+        self.owner = None
+        self.turn = threading.Condition(lock)
+
+
+class GameQueue():
+    '''Serializes calls per game token.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._games = {}
+
+    def __len__(self):
+        return len(self._games)
+
+    @contextmanager
+    def hold(self, token):
+        '''Waits for the game's turn and holds it for the block.  A block
+           entered from inside a running call for the same game runs at
+           once.'''
+        me = threading.get_ident()
+        with self._lock:
+            game = self._games.get(token)
+            if game is None:
+                game = self._games[token] = Turnstile(self._lock)
+            elif game.owner == me:
+                game = None
+            if game:
+                ticket = game.next
+                game.next += 1
+                while game.serving != ticket:
+                    game.turn.wait()
+                game.owner = me
+        if game is None:
+            yield
+            return
+        try:
+            yield
+        finally:
+            with self._lock:
+                game.owner = None
+                game.serving += 1
+                if game.serving == game.next:
+                    del self._games[token]
+                else:
+                    game.turn.notify_all()
+
+    def run(self, token, fn, *args, **kwargs):
+        '''Calls fn(*args, **kwargs) once the calls for the game that came
+           before it are done and returns its result or raises its
+           exception.'''
+        with self.hold(token):
+            return fn(*args, **kwargs)
@@ -1,13 +1,11 @@
 '''[This module defines and creates the gameboard ]'''
 
 from dataclasses import dataclass, field
+from functools import lru_cache
 from typing import List
 from unit import Army, Unit
-from mapping import MapTile, Map
-
-import configparser
-config = configparser.ConfigParser()
-config.read('config.ini')
+from mapping import MapTile, Map, compile_map, map_key
+from config import rules
 
 
 @dataclass
@@ -37,16 +35,21 @@ class GameBoard():
     total_blue_properties: int = 0
     blue_funds: int = 0
     days: int = 0
+    version: int = 0
+    next_unit_id: int = 0
+    # terrain key of the map in the terrain store, see codec.TerrainStore
+    map_id: str = ''
 
     @classmethod
     def create(cls, map: Map):
         board = GameBoard(map.width, map.height)
+        board.map_id = map_key(map)
         for i in range(map.width * map.height):
             x = i % map.width
             y = int(i / map.width)
             tile = GameTile(x, y, mapTile=map.tiles[i])
             board.grid.append(tile)
-            board.turn_order = map.turn_order
+            board.turn_order = list(map.turn_order)
             board.current_turn = map.turn_order[0]
             board.total_red_troops = 0
             board.total_red_properties = 0
@@ -58,7 +61,59 @@ class GameBoard():
         # add funds from properties for first turn
         for i in board.grid:
             if i.mapTile.army and i.mapTile.army.name == "RED":
-                board.red_funds += int(config['FUNDS']['income'])
-                board.total_red_properties += int(config['FUNDS']['income'])
-                board.total_blue_properties += int(config['FUNDS']['income'])
+                board.red_funds += rules.income
+                board.total_red_properties += rules.income
+                board.total_blue_properties += rules.income
         return board
+
+    def unit_at_index(self, index: int) -> Unit:
+        '''Returns the unit on the tile at the grid index or None.'''
+        return self.grid[index].unit
+
+    def terrain_types(self) -> tuple:
+        '''Returns the terrain type of every tile in grid order.'''
+        return tuple(tile.mapTile.type for tile in self.grid)
+
+    def clear_flags(self) -> set:
+        '''Clears the move and attack flags of every tile.
+        :return: [grid indexes of the tiles that had a flag set]'''
+        indexes = set()
+        for i, tile in enumerate(self.grid):
+            if tile.can_be_moved_to or tile.can_be_attacked:
+                indexes.add(i)
+                tile.can_be_moved_to = False
+                tile.can_be_attacked = False
+        return indexes
+
+    @classmethod
+    def from_board(cls, board):
+        '''Returns the board, boards of other layouts (see array_board.py)
+           convert to this one.'''
+        if isinstance(board, GameBoard):
+            return board
+        return board.to_board()
+
+    @classmethod
+    def from_map(cls, map_data: str):
+        '''Returns a new board for the map text, copied from a template
+           board built once per map.  Tiles share their immutable MapTile
+           with the template.'''
+        template = template_board(map_data, rules.income)
+        board = GameBoard(template.width, template.height)
+        board.grid = [GameTile(tile.x, tile.y, None, tile.mapTile, False,
+                               False, tile.capture_hp)
+                      for tile in template.grid]
+        board.turn_order = list(template.turn_order)
+        board.current_turn = template.current_turn
+        board.red_funds = template.red_funds
+        board.total_red_properties = template.total_red_properties
+        board.total_blue_properties = template.total_blue_properties
+        board.map_id = template.map_id
+        return board
+
+
+@lru_cache(maxsize=64)
+def template_board(map_data: str, income: int) -> GameBoard:
+    '''Returns the board a new game on the map starts from, built once per
+       map and income.  It is shared so must not be modified.'''
+    return GameBoard.create(compile_map(map_data))
@@ -2,41 +2,111 @@
 
 
 import math
+import random
+from collections import Counter
+from functools import lru_cache
+from array_board import ArrayBoard
 from gameboard import GameBoard, GameTile
-from unit import Army, UnitType, Unit, UnitClass
-from dijkstra import dijkstra
-from mapping import MapType, movement_cost, INF
+from unit import Army, UnitType, Unit, UnitClass, DAMAGE_TABLE, \
+    DIRECT_TYPES, INDIRECT_TYPES, damage_rolls
+from dijkstra import shortest_path, reachable
+from mapping import MapType, INF, compile_cost_grids, map_tile, terrain_star
 from config import Config
-import configparser
-config = configparser.ConfigParser()
-config.read('config.ini')
-
-
-REPAIR_CLASSES = {
-    MapType.CITY: {UnitClass.BOOTS, UnitClass.TREADS, UnitClass.TYRES,
-                   UnitClass.FOOT},
-    MapType.FACTORY: {UnitClass.BOOTS, UnitClass.TREADS,
-                      UnitClass.TYRES, UnitClass.FOOT},
-    MapType.AIRPORT: {UnitClass.AIR},
-    MapType.PORT: {UnitClass.SEA, UnitClass.LANDER},
-    MapType.BASE_TOWER_1: {UnitClass.BOOTS, UnitClass.TREADS,
-                           UnitClass.TYRES, UnitClass.FOOT},
+import codec
+
+
+# methods that change the game and can be replayed from the action log
+ACTIONS = {
+    'army_end_turn', 'end_game', 'capture_tile', 'unit_wait', 'unit_select',
+    'unit_move', 'unit_move2', 'unit_create', 'unit_attack', 'unit_delete',
+    'unit_join', 'unit_load', 'unit_unload', 'launch_missile',
+    'unit_resupply', 'unit_command',
 }
 
+# approximate bytes a game takes in memory per tile of each board layout,
+# per unit and for the rest, measured as benchmark.py's board memory
+TILE_BYTES = {GameBoard: 200, ArrayBoard: 9}
+UNIT_BYTES = 350
+GAME_BYTES = 10000
+
+
+@lru_cache(maxsize=None)
+def attack_ring(rangemin: int, rangemax: int) -> tuple:
+    '''Returns the (dx, dy) offsets between rangemin and rangemax
+       Manhattan distance.'''
+    return tuple((dx, dy)
+                 for dx in range(-rangemax, rangemax + 1)
+                 for dy in range(-rangemax, rangemax + 1)
+                 if rangemin <= abs(dx) + abs(dy) <= rangemax)
+
+
+def hp_range(hps: Counter) -> tuple:
+    '''Returns the min, max and mean of the hp outcomes, a unit that is
+       destroyed counting as 0.'''
+    total = sum(hps.values())
+    expected = sum(max(hp, 0) * count for hp, count in hps.items()) / total
+    return max(min(hps), 0), max(max(hps), 0), round(expected, 1)
+
+
+@lru_cache(maxsize=4096)
+def exchange_forecast(damage: int, counter: int, counters: bool,
+                      atk_star: int, def_star: int, attacker_hp: int,
+                      defender_hp: int) -> tuple:
+    '''Returns the (min, max, expected) hp of the attacker and of the
+       defender after an attack with the base damage, and the defender's
+       counterattack with the base counter if it counters, over the 100
+       equally likely pairs of damage rolls.'''
+    atk_hp = math.ceil(attacker_hp / 10)
+    defender_hps = Counter()
+    for roll in damage_rolls(damage, def_star, atk_hp,
+                             math.ceil(defender_hp / 10)):
+        defender_hps[defender_hp - roll] += 10
+    attacker_hps = Counter()
+    for hp, count in defender_hps.items():
+        if not counters or hp < 1:
+            attacker_hps[attacker_hp] += count
+            continue
+        # the counterattack is made with the hp the defender has left
+        for roll in damage_rolls(counter, atk_star, math.ceil(hp / 10),
+                                 atk_hp):
+            attacker_hps[attacker_hp - roll] += count // 10
+    return hp_range(attacker_hps), hp_range(defender_hps)
+
 
 class GameManager():
 
     def __init__(self, config: Config, board: GameBoard):
         self.config = config
         self.board = board
+        self._cost_grids = None
+        self.rng = random.Random()
+        self.changed = set()
+        # threat maps by army, with the board version they were made at
+        self.threat_maps = {}
+        self.rebuild_index()
 
     def __repr__(self):
         return f"{self.__class__.__name__}"
 
+    def apply(self, method: str, args: list, seed: int = None):
+        '''Applies the action method with args, seeding the random
+           damage rolls so that the action replays the same.'''
+        if method not in ACTIONS:
+            raise Exception(f'unknown action {method}')
+        self.rng.seed(seed)
+        return getattr(self, method)(*args)
+
+    def memory_estimate(self) -> int:
+        '''Returns the approximate bytes the game takes in memory.'''
+        board = self.board
+        return (GAME_BYTES + len(self.unit_positions) * UNIT_BYTES
+                + board.width * board.height * TILE_BYTES.get(type(board),
+                                                              200))
+
     def coord_valid(self, x: int, y: int) -> bool:
         '''Returns true if the coordinate is
            within the board width and hight.'''
-        return x in range(self.board.width) and y in range(self.board.width)
+        return x in range(self.board.width) and y in range(self.board.height)
 
     def check_turn_and_raise(self, unit):
         '''Raises exception if its not the units turn.'''
@@ -53,11 +123,72 @@ class GameManager():
         index = x + y * self.board.width
         return self.board.grid[index]
 
+    def rebuild_index(self):
+        '''Rebuilds the unit position index, the properties of each army
+           and the tiles being captured from the board, and gives units
+           from older boards a compact per-game ID.'''
+        self.unit_positions = {}
+        self.army_units = {army: {} for army in Army}
+        self.army_properties = {army: set() for army in Army}
+        self.capture_sites = set()
+        for i, tile in enumerate(self.board.grid):
+            if tile.unit:
+                for unit in [tile.unit] + tile.unit.status.cargo:
+                    if not (isinstance(unit.id, int) and
+                            0 <= unit.id < self.board.next_unit_id):
+                        unit.id = self.new_unit_id()
+                self._index_add(tile.unit, tile.x, tile.y)
+            if tile.mapTile.army:
+                self.army_properties[tile.mapTile.army].add(i)
+            if tile.capture_hp != 20:
+                self.capture_sites.add(i)
+
+    def new_unit_id(self) -> int:
+        '''Returns the next unused unit ID for this game.'''
+        id = self.board.next_unit_id
+        self.board.next_unit_id += 1
+        return id
+
+    def _index_add(self, unit: Unit, x: int, y: int):
+        self.unit_positions[unit.id] = (x, y)
+        self.army_units[unit.army][unit.id] = unit
+
+    def _index_remove(self, unit: Unit):
+        del self.unit_positions[unit.id]
+        del self.army_units[unit.army][unit.id]
+
+    def touch(self, x: int, y: int):
+        '''Records that the tile at the coordinates has changed.'''
+        self.changed.add(x + y * self.board.width)
+
+    def touch_unit(self, unit: Unit):
+        '''Records that the tile holding the unit has changed.'''
+        pos = self.unit_positions.get(unit.id)
+        if pos:
+            self.touch(*pos)
+
+    def pop_changes(self) -> list:
+        '''Returns the tiles changed since the last call.'''
+        tiles = [self.board.grid[i] for i in sorted(self.changed)]
+        self.changed.clear()
+        return tiles
+
     def tile_from_unit(self, unit: Unit) -> GameTile:
         '''Returns the tile the unit is on.'''
-        for tile in self.board.grid:
-            if tile.unit and tile.unit.id == unit.id:
-                return tile
+        pos = self.unit_positions.get(unit.id)
+        if pos:
+            return self.tile_at(*pos)
+
+    def cost_grid(self, cls: UnitClass):
+        '''Returns the flat movement cost grid of the board for the
+           unit class, compiled once and reused until the terrain changes.'''
+        if self._cost_grids is None:
+            self._cost_grids = compile_cost_grids(self.board.terrain_types())
+        return self._cost_grids[cls.value]
+
+    def terrain_changed(self):
+        '''Drops the cached cost grids after the terrain is modified.'''
+        self._cost_grids = None
 
     def unit_at(self, x: int, y: int) -> Unit:
         '''Returns the unit at the given coordinates.'''
@@ -65,8 +196,9 @@ class GameManager():
 
     def resupply_unit(self, unit: Unit):
         '''Sets the units fuel and ammo to the max for that unit.'''
-        unit.status.fuel = int(config[unit.type.name]['fuel'])
-        unit.status.ammo = int(config[unit.type.name]['ammo'])
+        unit.status.fuel = unit.status.config.fuel
+        unit.status.ammo = unit.status.config.ammo
+        self.touch_unit(unit)
 
     def unit_resupply(self, x: int, y: int, x2: int, y2: int):
         '''Resupplys the given unit from the unit specified.'''
@@ -91,6 +223,7 @@ class GameManager():
         unit.status.hp -= 30
         if unit.status.hp <= 10:
             unit.status.hp = 10
+        self.touch_unit(unit)
 
     def unit_can_move_to(self, unit: Unit, x: int, y: int) -> bool:
         '''Returns true if the unit can move to that coordinate.'''
@@ -104,7 +237,9 @@ class GameManager():
             return False
         if dist > unit.status.fuel:
             return False
-        dist = dijkstra(self.board, tile, self.tile_at(x, y))
+        dist, _ = shortest_path(self.board, tile, self.tile_at(x, y),
+                                unit.status.move,
+                                self.cost_grid(unit.status.cls))
         if dist > unit.status.move:
             return False
         return True
@@ -120,7 +255,9 @@ class GameManager():
             return False
         if dist > unit.status.fuel:
             return False
-        dist = dijkstra(self.board, tile, self.tile_at(x, y))
+        dist, _ = shortest_path(self.board, tile, self.tile_at(x, y),
+                                unit.status.move,
+                                self.cost_grid(unit.status.cls))
         if dist > unit.status.move:
             return False
         return True
@@ -135,14 +272,82 @@ class GameManager():
         dist = abs(x - tile.x) + abs(y - tile.y)
         if dist > unit.status.move:
             return False
-        dist = dijkstra(self.board, tile, self.tile_at(x, y))
+        dist, _ = shortest_path(self.board, tile, self.tile_at(x, y),
+                                min(unit.status.move, unit.status.fuel),
+                                self.cost_grid(unit.status.cls))
         if dist > unit.status.move or dist > unit.status.fuel:
             return False
         return True
 
-    def unit_can_attack(self, unit: Unit, x: int, y: int) -> bool:
+    def unit_reachable(self, unit: Unit, tile: GameTile = None) -> dict:
+        '''Returns the movement cost of every coordinate the unit
+           can move to, found with a single search from its tile.'''
+        if tile is None:
+            tile = self.tile_from_unit(unit)
+        costs = reachable(self.board, tile, unit.status.move,
+                          self.cost_grid(unit.status.cls))
+        result = {}
+        for (x, y), cost in costs.items():
+            if abs(x - tile.x) + abs(y - tile.y) > unit.status.fuel:
+                continue
+            if self.unit_at(x, y):
+                continue
+            result[(x, y)] = cost
+        return result
+
+    def reachable_tiles(self, x: int, y: int) -> list:
+        '''Returns the coordinates and movement cost of every tile
+           the unit at the given coordinates can move to.'''
+        if not self.coord_valid(x, y):
+            raise Exception('coordinate out of range')
+        unit = self.unit_at(x, y)
+        if not unit:
+            raise Exception('unit does not exist at coordinate')
+        costs = self.unit_reachable(unit)
+        return [{'x': x2, 'y': y2, 'cost': cost}
+                for (x2, y2), cost in sorted(costs.items())]
+
+    def threat_map(self, army: str) -> list:
+        '''Returns every tile the army could attack next turn with the
+           number of units threatening it and, for tiles holding an enemy
+           unit, the highest expected damage it could take.'''
+        army = army.upper()
+        try:
+            army = Army[army]
+        except KeyError:
+            raise Exception('invalid "army" parameter')
+        threat = {}
+        damage = {}
+        for tile in self.board.grid:
+            unit = tile.unit
+            if not unit or unit.army != army or not unit.has_weapon():
+                continue
+            origins = [(tile.x, tile.y)]
+            if not unit.is_indirect():
+                origins.extend(self.unit_reachable(unit, tile))
+            ring = attack_ring(unit.status.rangemin, unit.status.rangemax)
+            targets = set()
+            for x, y in origins:
+                for dx, dy in ring:
+                    if self.coord_valid(x + dx, y + dy):
+                        targets.add((x + dx, y + dy))
+            for x, y in targets:
+                threat[(x, y)] = threat.get((x, y), 0) + 1
+                target_tile = self.tile_at(x, y)
+                target = target_tile.unit
+                if target and target.army != army and \
+                        unit.is_attackable(target):
+                    dmg = unit.expected_damage(target, target_tile)
+                    damage[(x, y)] = max(damage.get((x, y), 0), dmg)
+        return [{'x': x, 'y': y, 'threat': count,
+                 'damage': round(damage.get((x, y), 0), 1)}
+                for (x, y), count in sorted(threat.items())]
+
+    def unit_can_attack(self, unit: Unit, x: int, y: int,
+                        tile: GameTile = None) -> bool:
         '''Returns true if the unit can attack.'''
-        tile = self.tile_from_unit(unit)
+        if tile is None:
+            tile = self.tile_from_unit(unit)
         if tile.x == x and tile.y == y:
             return False
         target = self.unit_at(x, y)
@@ -155,11 +360,11 @@ class GameManager():
         dist = abs(x - tile.x) + abs(y - tile.y)
         return unit.status.rangemin <= dist <= unit.status.rangemax
 
-    def unit_from_id(self, id: str) -> Unit:
+    def unit_from_id(self, id: int) -> Unit:
         '''Returns the unit from the ID given.'''
-        for tile in self.board.grid:
-            if tile.unit and tile.unit.id == id:
-                return tile.unit
+        pos = self.unit_positions.get(id)
+        if pos:
+            return self.unit_at(*pos)
 
     def unit_remove(self, x: int, y: int) -> Unit:
         '''Remove the unit at the given coordinates.'''
@@ -169,21 +374,23 @@ class GameManager():
         tile.mapTile.is_capturable == True
         tile.capture_hp = 20
         tile.unit = None
+        self.capture_sites.discard(x + y * self.board.width)
+        self.touch(x, y)
+        if unit:
+            self._index_remove(unit)
         return unit
 
-    def unit_remove2(self, id: str) -> Unit:
+    def unit_remove2(self, id: int) -> Unit:
         '''Remove the unit with the given ID.'''
-        for tile in self.board.grid:
-            if tile.unit and tile.unit.id == id:
-                unit = tile.unit
-                tile.mapTile.is_capturable == True
-                tile.capture_hp = 20
-                tile.unit = None
-                return unit
+        pos = self.unit_positions.get(id)
+        if pos:
+            return self.unit_remove(*pos)
 
     def unit_place(self, unit: Unit, x: int, y: int):
         '''Place the unit at the given coordinates.'''
         self.tile_at(x, y).unit = unit
+        self.touch(x, y)
+        self._index_add(unit, x, y)
 
     def tile_get(self, x: int, y: int) -> GameTile:
         '''Return the tile at the given coordinates.'''
@@ -194,9 +401,7 @@ class GameManager():
     def unit_deselect(self):
         '''Deselects the unit.'''
         self.board.selected = None
-        for tile in self.board.grid:
-            tile.can_be_moved_to = False
-            tile.can_be_attacked = False
+        self.changed.update(self.board.clear_flags())
 
     def capture_tile(self, x: int, y: int):
         '''Capture the tile at the given coordinate.'''
@@ -218,24 +423,30 @@ class GameManager():
         self.check_turn_and_raise(unit)
         if not unit.type_can_capture():
             raise Exception('Unit cannot capture')
+        index = x + y * self.board.width
         tile.capture_hp -= math.ceil(unit.status.hp / 10)
+        self.capture_sites.add(index)
         if tile.capture_hp <= 0:
             if not tile.mapTile.army is None:
+                self.army_properties[tile.mapTile.army].discard(index)
                 if tile.mapTile.army.name == 'RED':
-                    self.board.total_red_properties -= int(config['FUNDS']['income'])
+                    self.board.total_red_properties -= self.config.income
                 elif tile.mapTile.army.name == 'BLUE':
-                    self.board.total_blue_properties -= int(config['FUNDS']['income'])
-            tile.mapTile.army = unit.army
+                    self.board.total_blue_properties -= self.config.income
+            tile.mapTile = map_tile(tile.mapTile.type, unit.army)
+            self.army_properties[unit.army].add(index)
             tile.capture_hp = 20
+            self.capture_sites.discard(index)
             if tile.mapTile.type == MapType.BASE_TOWER_1:
                 self.board.game_active = False
             if self.board.current_turn.name == 'RED':
-                self.board.total_red_properties += int(config['FUNDS']['income'])
+                self.board.total_red_properties += self.config.income
             if self.board.current_turn.name == 'BLUE':
-                self.board.total_blue_properties += int(config['FUNDS']['income'])
+                self.board.total_blue_properties += self.config.income
         unit.can_move = False
         unit.can_attack = False
         unit.can_capture = False
+        self.touch(x, y)
         self.unit_deselect()
         return self.tile_at(x, y)
 
@@ -254,7 +465,9 @@ class GameManager():
             raise Exception('cannot launch from this tile')
         if not tile.unit:
             raise Exception('unit does not exist at coordinate')
-        tile.mapTile.type = MapType.EMPTY_SILO
+        tile.mapTile = map_tile(MapType.EMPTY_SILO, tile.mapTile.army)
+        self.terrain_changed()
+        self.touch(x, y)
         unit = tile.unit
         self.check_turn_and_raise(unit)
         unit.can_move = False
@@ -354,6 +567,7 @@ class GameManager():
         unit.can_move = False
         unit.can_attack = False
         unit.can_capture = False
+        self.touch(x, y)
         self.unit_deselect()
         return self.tile_at(x, y)
 
@@ -372,27 +586,24 @@ class GameManager():
         if self.board.game_active == False:
             raise Exception("tried to end turn but Game Over")
         self.unit_deselect()
+        board = self.board
+        income = self.config.income
+        # totals and income from the unit and property indexes
+        board.total_red_troops = len(self.army_units[Army.RED])
+        board.total_blue_troops = len(self.army_units[Army.BLUE])
+        board.total_red_properties = income * len(
+            self.army_properties[Army.RED])
+        board.total_blue_properties = income * len(
+            self.army_properties[Army.BLUE])
+        if board.current_turn == Army.RED:
+            board.blue_funds += board.total_blue_properties
+        if board.current_turn == Army.BLUE:
+            board.red_funds += board.total_red_properties
         # remove move/attack statuses from units
-        self.board.total_blue_troops = 0
-        self.board.total_red_troops = 0
-        self.board.total_blue_properties = 0
-        self.board.total_red_properties = 0
-        for tile in self.board.grid:
-            if tile.unit and tile.unit.army.value == 0:
-                self.board.total_red_troops += 1
-            if tile.unit and tile.unit.army.value == 1:
-                self.board.total_blue_troops += 1
-            if tile.mapTile.army and tile.mapTile.army.name == "BLUE":
-                self.board.total_blue_properties += 1000
-                if self.board.current_turn.name == "RED":
-                    self.board.blue_funds += int(config['FUNDS']['income'])
-            if tile.mapTile.army and tile.mapTile.army.name == "RED":
-                self.board.total_red_properties += 1000
-                if self.board.current_turn.name == "BLUE":
-                    self.board.red_funds += int(config['FUNDS']['income'])
-            if tile.unit and tile.unit.army == self.board.current_turn:
-                tile.unit.can_move = False
-                tile.unit.can_attack = False
+        for unit in self.army_units[board.current_turn].values():
+            unit.can_move = False
+            unit.can_attack = False
+            self.touch_unit(unit)
         # change current_turn
         idx = None
         for i in range(len(self.board.turn_order)):
@@ -403,50 +614,36 @@ class GameManager():
         if idx >= len(self.board.turn_order):
             idx = 0
         self.board.current_turn = self.board.turn_order[idx]
-        # give move/attack statuses to units
-        for tile in self.board.grid:
-            if tile.unit and tile.unit.army == self.board.current_turn:
-                tile.unit.can_move = True
-                tile.unit.can_attack = True
-                unit = tile.unit
-                unit.can_capture = True
-                unit.status.fuel -= unit.fuel_use()
-                if unit.fuel_daily_use() and unit.status.fuel <= 0:
-                    tile = self.tile_from_unit(unit)
-                    self.unit_remove(tile.x, tile.y)
-                if (unit.army == tile.mapTile.army and unit.status.cls
-                        in REPAIR_CLASSES[tile.mapTile.type]):
-                    unit.status.hp = min(100, unit.status.hp + 20)
-                    self.resupply_unit(unit)
-                # Refuel units adjacent APC
-                if unit.type in {UnitType.APC}:
-                    b = tile.x + 1
-                    if self.coord_valid(b, tile.y):
-                        target = self.tile_get(b, tile.y)
-                        if target.unit:
-                            unit = target.unit
-                            self.resupply_unit(unit)
-                    b = tile.x - 1
-                    if self.coord_valid(b, tile.y):
-                        target = self.tile_get(b, tile.y)
-                        if target.unit:
-                            unit = target.unit
-                            self.resupply_unit(unit)
-                    c = tile.y + 1
-                    if self.coord_valid(tile.x, c):
-                        target = self.tile_get(tile.x, c)
-                        if target.unit:
-                            unit = target.unit
-                            self.resupply_unit(unit)
-                    c = tile.y - 1
-                    if self.coord_valid(tile.x, c):
-                        target = self.tile_get(tile.x, c)
-                        if target.unit:
-                            unit = target.unit
-                            self.resupply_unit(unit)
-
-            if not tile.unit and tile.mapTile.is_capturable:
+        # give move/attack statuses to units, in grid order as a unit
+        # resupplied by an APC before its own turn still uses its fuel
+        units = sorted(self.army_units[board.current_turn].values(),
+                       key=lambda unit: self.unit_positions[unit.id][::-1])
+        for unit in units:
+            tile = self.tile_from_unit(unit)
+            unit.can_move = True
+            unit.can_attack = True
+            unit.can_capture = True
+            unit.status.fuel -= unit.fuel_use()
+            self.touch(tile.x, tile.y)
+            if unit.fuel_daily_use() and unit.status.fuel <= 0:
+                self.unit_remove(tile.x, tile.y)
+            if (unit.army == tile.mapTile.army and unit.status.cls
+                    in self.config.repair[tile.mapTile.type]):
+                unit.status.hp = min(100, unit.status.hp + 20)
+                self.resupply_unit(unit)
+            # Refuel units adjacent APC
+            if unit.type in {UnitType.APC}:
+                for x, y in ((tile.x + 1, tile.y), (tile.x - 1, tile.y),
+                             (tile.x, tile.y + 1), (tile.x, tile.y - 1)):
+                    if self.coord_valid(x, y) and self.unit_at(x, y):
+                        self.resupply_unit(self.unit_at(x, y))
+        # captures left by their unit start again
+        for index in list(self.capture_sites):
+            tile = board.grid[index]
+            if not tile.unit:
                 tile.capture_hp = 20
+                self.capture_sites.discard(index)
+                self.changed.add(index)
         if self.board.current_turn.name == "RED":
             self.board.days += 1
 
@@ -463,22 +660,22 @@ class GameManager():
             self.check_turn_and_raise(tile.unit)
             self.board.selected = tile
             unit = tile.unit
+            source = tile
+            moves = self.unit_reachable(unit) if unit.can_move else {}
             for tile in self.board.grid:
-                if unit.can_move:
-                    tile.can_be_moved_to = self.unit_can_move_to(unit,
-                                                                 tile.x,
-                                                                 tile.y)
-                else:
-                    tile.can_be_moved_to = False
-                if unit.can_attack:
-                    tile.can_be_attacked = self.unit_can_attack(unit,
-                                                                tile.x,
-                                                                tile.y)
-                else:
-                    tile.can_be_attacked = False
+                can_be_moved_to = (tile.x, tile.y) in moves
+                can_be_attacked = (unit.can_attack and tile.unit is not None
+                                   and self.unit_can_attack(unit, tile.x,
+                                                            tile.y, source))
+                if (can_be_moved_to != tile.can_be_moved_to or
+                        can_be_attacked != tile.can_be_attacked):
+                    self.touch(tile.x, tile.y)
+                tile.can_be_moved_to = can_be_moved_to
+                tile.can_be_attacked = can_be_attacked
         return tile.unit
 
-    def unit_move(self, x: int, y: int, x2: int, y2: int) -> Unit:
+    def unit_move(self, x: int, y: int, x2: int, y2: int,
+                  select: bool = True) -> Unit:
         '''Move the unit to / from the coordinates given.'''
         if not self.coord_valid(x, y):
             raise Exception('coordinate out of range')
@@ -503,10 +700,86 @@ class GameManager():
         dist = abs(x - tile.x) + abs(y - tile.y)
         unit.status.fuel -= dist
         self.unit_deselect()
-        self.unit_select(x2, y2)
+        if select:
+            self.unit_select(x2, y2)
         return unit
 
-    def unit_move2(self, id: str, x: int, y: int) -> Unit:
+    def check_path(self, unit: Unit, path: list):
+        '''Raises exception if the unit cannot follow the path of
+           [x, y] steps from its tile.'''
+        tile = self.tile_from_unit(unit)
+        if [tile.x, tile.y] != list(path[0]):
+            raise Exception('path does not start at the unit')
+        costs = self.cost_grid(unit.status.cls)
+        cost = 0
+        for (x, y), (x2, y2) in zip(path, path[1:]):
+            if abs(x2 - x) + abs(y2 - y) != 1:
+                raise Exception('path steps must be adjacent')
+            if not self.coord_valid(x2, y2):
+                raise Exception('coordinate out of range')
+            other = self.unit_at(x2, y2)
+            if other and other.army != unit.army:
+                raise Exception('path is blocked')
+            cost += costs[x2 + y2 * self.board.width]
+        if cost > unit.status.move:
+            raise Exception('path too long')
+
+    def unit_command(self, x: int, y: int, path_or_dest: list, action: str,
+                     target: list = None) -> GameTile:
+        '''Moves the unit then carries out the action as one command.
+           path_or_dest is the [x, y] destination or a path of [x, y]
+           steps.  action is one of wait, attack, capture, load or join,
+           target is the [x, y] to attack or the unit to load into or join.
+           If any part fails the board is left unchanged.'''
+        if not self.coord_valid(x, y):
+            raise Exception('coordinate out of range')
+        unit = self.unit_at(x, y)
+        if not unit:
+            raise Exception('unit does not exist at source tile')
+        if not path_or_dest:
+            raise Exception('no destination given')
+        path = None
+        if isinstance(path_or_dest[0], (list, tuple)):
+            path = path_or_dest
+            path_or_dest = path[-1]
+        x2, y2 = path_or_dest
+        if action in {'load', 'join'}:
+            # moving onto the unit is part of loading or joining
+            if not target or list(target) != [x2, y2]:
+                raise Exception(f'{action} must end on the target unit')
+        elif action not in {'wait', 'attack', 'capture'}:
+            raise Exception(f'unknown action {action}')
+        board = codec.encode_board(self.board)
+        changed = set(self.changed)
+        try:
+            if path:
+                self.check_path(unit, path)
+            if action == 'load':
+                self.unit_load(x, y, x2, y2)
+                return self.tile_at(x2, y2)
+            if action == 'join':
+                self.unit_join(x, y, x2, y2)
+                return self.tile_at(x2, y2)
+            if (x2, y2) != (x, y):
+                self.unit_move(x, y, x2, y2, select=False)
+            if action == 'wait':
+                self.unit_wait(x2, y2)
+            elif action == 'attack':
+                if not target:
+                    raise Exception('attack needs a target')
+                self.unit_attack(x2, y2, target[0], target[1])
+            elif action == 'capture':
+                self.capture_tile(x2, y2)
+            return self.tile_at(x2, y2)
+        except Exception:
+            self.board = type(self.board).from_board(
+                codec.decode_board(board, self.config))
+            self.terrain_changed()
+            self.rebuild_index()
+            self.changed = changed
+            raise
+
+    def unit_move2(self, id: int, x: int, y: int) -> Unit:
         '''Move a unit with ID to the coordinate given.'''
         unit = self.unit_from_id(id)
         if not unit:
@@ -533,19 +806,19 @@ class GameManager():
         if self.unit_at(x, y):
             raise Exception('unit already exists at this tile')
         unit = Unit.create(Army[army], UnitType[unit_type],
-                           self.config.units[unit_type])
+                           self.config.units[unit_type], self.new_unit_id())
 
         if self.board.current_turn.name == 'RED':
             wallet = self.board.red_funds
-            if int(config[unit.type.name]['cost']) <= wallet:
-                self.board.red_funds -= int(config[unit.type.name]['cost'])
+            if unit.status.cost <= wallet:
+                self.board.red_funds -= unit.status.cost
                 self.board.total_red_troops += 1
             else:
                 raise Exception('not enough funds for this unit')
         if self.board.current_turn.name == 'BLUE':
             wallet = self.board.blue_funds
-            if int(config[unit.type.name]['cost']) <= wallet:
-                self.board.blue_funds -= int(config[unit.type.name]['cost'])
+            if unit.status.cost <= wallet:
+                self.board.blue_funds -= unit.status.cost
                 self.board.total_blue_troops += 1
             else:
                 raise Exception('not enough funds for this unit')
@@ -574,23 +847,27 @@ class GameManager():
             raise Exception('target tile too far')
         if attacker.is_direct() and defender.is_direct():
             defender.status.hp -= attacker.attack_damage(defender,
-                                                         defender_tile)
+                                                         defender_tile,
+                                                         self.rng)
             attacker.status.ammo -= 1
             if defender.status.hp >= 1:
                 attacker.status.hp -= defender.attack_damage(attacker,
-                                                             attacker_tile)
+                                                             attacker_tile,
+                                                             self.rng)
                 defender.status.ammo -= 1
             else:
                 self.unit_remove(x2, y2)
         if attacker.is_direct() and defender.is_indirect():
             defender.status.hp -= attacker.attack_damage(defender,
-                                                         defender_tile)
+                                                         defender_tile,
+                                                         self.rng)
             attacker.status.ammo -= 1
             if defender.status.hp <= 1:
                 self.unit_remove(x2, y2)
         if attacker.is_indirect():
             defender.status.hp -= attacker.attack_damage(defender,
-                                                         defender_tile)
+                                                         defender_tile,
+                                                         self.rng)
             attacker.status.ammo -= 1
             if defender.status.hp <= 1:
                 self.unit_remove(x2, y2)
@@ -599,6 +876,8 @@ class GameManager():
         attacker.can_capture = False
         attacker.can_move = False
         attacker.can_attack = False
+        self.touch(x, y)
+        self.touch(x2, y2)
         self.unit_deselect()
         unit = self.unit_at(x, y)
         return unit
@@ -611,28 +890,58 @@ class GameManager():
         if not self.coord_valid(x2, y2):
             raise Exception('coordinate out of range')
         attacker = self.unit_at(x, y)
-        attacker_tile = self.tile_at(x, y)
         defender = self.unit_at(x2, y2)
-        defender_tile = self.tile_at(x2, y2)
-        defender_hp = 100
-        attacker_hp = 100
         if not attacker:
             raise Exception('unit does not exist at source tile')
         if not defender:
             raise Exception('unit does not exist at target tile')
-        if attacker.is_direct() and defender.is_direct():
-            defender_hp = defender.status.hp
-            - attacker.attack_damage(defender, defender_tile)
-            if defender.status.hp >= 1:
-                attacker_hp = attacker.status.hp
-                - defender.attack_damage(attacker, attacker_tile)
-        if attacker.is_direct() and defender.is_indirect():
-            defender_hp = defender.status.hp
-            - attacker.attack_damage(defender, defender_tile)
-        if attacker.is_indirect():
-            defender.status.hp -= attacker.attack_damage(defender,
-                                                         defender_tile)
-        return attacker_hp, defender_hp
+        attacker_hp, defender_hp = self.attack_exchange(
+            attacker, self.tile_at(x, y), defender, self.tile_at(x2, y2))
+        return round(attacker_hp[2]), round(defender_hp[2])
+
+    def attack_exchange(self, attacker: Unit, attacker_tile: GameTile,
+                        defender: Unit, defender_tile: GameTile) -> tuple:
+        '''Returns the (min, max, expected) hp the attacker and defender
+           are left with after unit_attack, without changing either unit.'''
+        direct = attacker.type in DIRECT_TYPES
+        if not (direct or attacker.type in INDIRECT_TYPES) or (
+                direct and defender.type not in DIRECT_TYPES
+                and defender.type not in INDIRECT_TYPES):
+            # unit_attack leaves both units as they are
+            return (attacker.status.hp,) * 3, (defender.status.hp,) * 3
+        return exchange_forecast(
+            DAMAGE_TABLE[attacker.type][defender.type.value],
+            DAMAGE_TABLE[defender.type][attacker.type.value],
+            direct and defender.type in DIRECT_TYPES,
+            terrain_star[attacker_tile.mapTile.type],
+            terrain_star[defender_tile.mapTile.type],
+            attacker.status.hp, defender.status.hp)
+
+    def attack_forecast(self, x: int, y: int) -> list:
+        '''Returns every unit the unit at the coordinates can attack from
+           where it is with the min, max and expected hp of both units after
+           the attack and counterattack.  Nothing on the board changes.'''
+        if not self.coord_valid(x, y):
+            raise Exception('coordinate out of range')
+        attacker = self.unit_at(x, y)
+        if not attacker:
+            raise Exception('unit does not exist at source tile')
+        tile = self.tile_at(x, y)
+        forecast = []
+        for dx, dy in attack_ring(attacker.status.rangemin,
+                                  attacker.status.rangemax):
+            x2, y2 = x + dx, y + dy
+            if not (self.coord_valid(x2, y2) and
+                    self.unit_can_attack(attacker, x2, y2, tile)):
+                continue
+            attacker_hp, defender_hp = self.attack_exchange(
+                attacker, tile, self.unit_at(x2, y2), self.tile_at(x2, y2))
+            forecast.append({
+                'x': x2, 'y': y2,
+                'attacker': dict(zip(('min', 'max', 'expected'), attacker_hp)),
+                'defender': dict(zip(('min', 'max', 'expected'), defender_hp)),
+            })
+        return sorted(forecast, key=lambda target: (target['x'], target['y']))
 
     def unit_delete(self, x: int, y: int) -> Unit:
         '''Deletes the unit at the given cordinates.'''
@@ -662,6 +971,7 @@ class GameManager():
         unit2.can_capture = False
         unit2.can_attack = False
         unit2.can_move = False
+        self.touch(x2, y2)
         self.unit_remove(x, y)
         return unit2
 
@@ -695,6 +1005,7 @@ class GameManager():
             self.resupply_unit(unit)
         unit = self.unit_remove(x, y)
         transport.status.cargo.append(unit)
+        self.touch(x2, y2)
         # For the moment, fuel cost is simplified, Manhatten distance.
         unit.can_move = False
         unit.can_attack = False
@@ -720,8 +1031,9 @@ class GameManager():
         if len(transport.status.cargo) == 0:
             raise Exception('cargo is empty')
         unit = transport.status.cargo[index]
-        target_tile = self.tile_get(x2, y2)
-        if movement_cost[target_tile.mapTile.type][unit.status.cls.value] == INF:
+        self.tile_get(x2, y2)
+        costs = self.cost_grid(unit.status.cls)
+        if costs[x2 + y2 * self.board.width] == INF:
             raise Exception('unit cannot unload to tile')
         unit = transport.status.cargo.pop(index)
         self.unit_place(unit, x2, y2)
@@ -729,4 +1041,5 @@ class GameManager():
         self.can_attack = False
         transport.can_move = False
         transport.can_attack = False
+        self.touch(x, y)
         return unit
@@ -1,7 +1,11 @@
 '''[This sets up map and methods for map tiles ]'''
 
+import hashlib
+import json
+from array import array
 from dataclasses import dataclass
-from typing import List
+from functools import lru_cache
+from typing import List, Tuple
 from enum import Enum
 
 from army import Army
@@ -93,7 +97,7 @@ class MapType(Enum):
 # WOOD,CITY,WOOD,CITY,MOUNTAIN,MOUNTAIN,PLAIN*3,CITY,PLAIN*5,RIVER_VERT,PLAIN*2,WOOD
 # '''
 
-MAP1 = '''RED,BLUE
+MAP_19X18 = '''RED,BLUE
 PORT:RED,BEACH_W,SEA*2,BEACH_S*3,SEA*3,BEACH_E,WOOD,AIRPORT:RED,WOOD,CITY,MOUNTAIN,CITY,MOUNTAIN*2
 SEA*2,BEACH_S,BEACH_SE,MOUNTAIN,CITY,MOUNTAIN,BEACH_SW,BEACH_S,SEA,BEACH_E,WOOD*5,MOUNTAIN*3
 SEA,BEACH_SE,CITY:RED,MOUNTAIN*5,CITY,SEA,BEACH_E,PORT,WOOD*2,FACTORY:RED,ROAD_VERT,WOOD,MOUNTAIN,CITY
@@ -115,7 +119,7 @@ MOUNTAIN*2,CITY,MOUNTAIN,CITY,WOOD,AIRPORT:BLUE,WOOD,BEACH_W,SEA*3,BEACH_N*3,SEA
 '''
 
 # Scorpion Operation
-MAP1 = '''RED,BLUE
+MAP_SCORPION = '''RED,BLUE
 PLAIN,WOOD,RIVER_VERT,MOUNTAIN,ROAD_VERT,WOOD,PLAIN,PLAIN,CITY,PLAIN,PLAIN,WOOD,PLAIN,MOUNTAIN,RIVER_VERT,MOUNTAIN,PLAIN,CITY,PLAIN,WOOD,ROAD_VERT,PLAIN,PLAIN,CITY,MOUNTAIN
 MOUNTAIN,FACTORY,RIVER_VERT,MOUNTAIN,ROAD_SW,ROAD_HORT,ROAD_NE,WOOD,PLAIN,WOOD,PLAIN,PLAIN,AIRPORT,WOOD,HBridge,FACTORY:BLUE,ROAD_NW,ROAD_SE,PLAIN,PLAIN,CITY,PLAIN,WOOD,ROAD_VERT,PLAIN
 WOOD,PLAIN,RIVER_SW,RIVER_NW,WOOD,PLAIN,ROAD_VERT,WOOD,MOUNTAIN,PLAIN,BASE_TOWER_1:BLUE,PLAIN,PLAIN,RIVER_NE,RIVER_SE,ROAD_NW,ROAD_SE,WOOD,PLAIN,PLAIN,ROAD_VERT,WOOD,MOUNTAIN,ROAD_VERT,PLAIN
@@ -144,9 +148,10 @@ CRoad,ROAD_HORT,ROAD_HORT,ROAD_HORT,ROAD_HORT,ROAD_HORT,ROAD_HORT
 '''
 
 
-@dataclass
+@dataclass(frozen=True)
 class MapTile():
-    '''Gameboard tile class.'''
+    '''Gameboard tile class.  Tiles are immutable and shared between
+       boards, see map_tile(), so changing a tile means replacing it.'''
     type: MapType
     army: Army = None
 
@@ -217,7 +222,7 @@ class Map():
                     if not multiplier:
                         multiplier = 1
                     for i in range(multiplier):
-                        tile = MapTile(type, army)
+                        tile = map_tile(type, army)
                         tiles.append(tile)
                         row_count += 1
                 if not height:
@@ -229,6 +234,48 @@ class Map():
         return Map(width, height, tiles, turn_order)
 
 
+@lru_cache(maxsize=None)
+def map_tile(type: MapType, army: Army = None) -> MapTile:
+    '''Returns the one shared tile for the terrain type and owner.'''
+    return MapTile(type, army)
+
+
+# maps by name, see compile_map()
+MAPS = {
+    'MAP1': MAP1,
+    'MAP_19X18': MAP_19X18,
+    'SCORPION': MAP_SCORPION,
+}
+
+
+@lru_cache(maxsize=64)
+def compile_map(map_data: str) -> Map:
+    '''Returns the map parsed once per map text.  The map is shared so
+       must not be modified.'''
+    map = Map.parse(map_data)
+    return Map(map.width, map.height, tuple(map.tiles),
+               tuple(map.turn_order))
+
+
+# terrain of every map a board was created from, by terrain_key()
+map_terrain = {}
+
+
+def terrain_key(width: int, height: int, terrain: list) -> str:
+    '''Returns the content hash of the terrain.'''
+    text = json.dumps([width, height, terrain], separators=(',', ':'))
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def map_key(map: Map) -> str:
+    '''Returns the terrain key of the map and keeps its terrain in
+       map_terrain for the terrain stores.'''
+    terrain = [tile.type.value for tile in map.tiles]
+    key = terrain_key(map.width, map.height, terrain)
+    map_terrain.setdefault(key, (map.width, map.height, terrain))
+    return key
+
+
 terrain_star = {
     MapType.PLAIN: 1,
     MapType.WOOD: 2,
@@ -363,3 +410,14 @@ movement_cost = {
     MapType.HBridge: [1, 1, 1, INF, 1, INF, 1, INF],
     MapType.VBridge: [1, 1, 1, INF, 1, INF, 1, INF],
 }
+
+
+@lru_cache(maxsize=64)
+def compile_cost_grids(terrain: Tuple[MapType, ...]) -> Tuple[array, ...]:
+    '''Returns one flat movement cost grid per unit class (indexed by
+       UnitClass.value) for the terrain given in row order.  The grids are
+       shared between every board with the same terrain so must not be
+       modified.'''
+    classes = len(movement_cost[MapType.PLAIN])
+    return tuple(array('l', [movement_cost[type][cls] for type in terrain])
+                 for cls in range(classes))
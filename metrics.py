@@ -0,0 +1,188 @@
+'''[This module keeps the rpc latency metrics served on /metrics]
+
+Each rpc wrapped by Metrics.timed records its run time, and the time spent
+in each phase of it, in histograms per method.  The phases (load, decode,
+engine, encode, commit, broadcast) are timed by phase(name) blocks where
+the work is done.  A phase started inside another pauses it, so each phase
+counts only its own time, and time in no phase is counted as other.  The
+times of the running call are kept per thread.  Counters are added to as
+things happen and collected values are read from a callback when scraped.
+render() returns them all in the Prometheus text format.
+'''
+
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# upper bounds in seconds of the histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram():
+    '''Count of observations per bucket and their sum.'''
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+
+class Timings():
+    '''The phase times of a running call.'''
+    __slots__ = ('times', 'stack', 'since')
+
+    def __init__(self):
+        self.times = {}
+        self.stack = []
+        self.since = 0.0
+
+    def split(self, now: float):
+        '''Adds the time since the last split to the running phase.'''
+        if self.stack:
+            name = self.stack[-1]
+            self.times[name] = self.times.get(name, 0.0) + now - self.since
+        self.since = now
+
+
+def labels(**values) -> str:
+    '''Returns the Prometheus label set of the values.'''
+    return '{' + ','.join(f'{name}="{value}"'
+                          for name, value in values.items()) + '}'
+
+
+def histogram_lines(name: str, label: dict, counts: list,
+                    seconds: float) -> list:
+    '''Returns the cumulative bucket, sum and count lines of a histogram.'''
+    lines = []
+    total = 0
+    for bound, count in zip(BUCKETS + ('+Inf',), counts):
+        total += count
+        lines.append(f'{name}_bucket{labels(**label, le=bound)} {total}')
+    lines.append(f'{name}_sum{labels(**label)} {seconds}')
+    lines.append(f'{name}_count{labels(**label)} {total}')
+    return lines
+
+
+class Metrics():
+    '''Rpc histograms, counters and collected values.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.requests = {}
+        self.phases = {}
+        self.errors = {}
+        self.counters = {}
+        self.collected = {}
+        self.help = {}
+
+    def timed(self, fn):
+        '''Wraps the rpc to record its times under the name of fn less the
+           _rpc suffix.  It times the call, not the wait for its game.'''
+        method = fn.__name__
+        if method.endswith('_rpc'):
+            method = method[:-len('_rpc')]
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            local = self._local
+            outer = getattr(local, 'timings', None)
+            timings = local.timings = Timings()
+            start = timings.since = time.perf_counter()
+            failed = True
+            try:
+                result = fn(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                elapsed = time.perf_counter() - start
+                local.timings = outer
+                self._record(method, elapsed, timings.times, failed)
+        return wrapper
+
+    @contextmanager
+    def phase(self, name: str):
+        '''Times the block as the phase of the running rpc, if any.'''
+        timings = getattr(self._local, 'timings', None)
+        if timings is None:
+            yield
+            return
+        timings.split(time.perf_counter())
+        timings.stack.append(name)
+        try:
+            yield
+        finally:
+            timings.split(time.perf_counter())
+            timings.stack.pop()
+
+    def _record(self, method: str, elapsed: float, times: dict,
+                failed: bool):
+        other = elapsed - sum(times.values())
+        with self._lock:
+            hist = self.requests.get(method)
+            if hist is None:
+                hist = self.requests[method] = Histogram()
+            hist.observe(elapsed)
+            for name, seconds in (*times.items(), ('other', other)):
+                hist = self.phases.get((method, name))
+                if hist is None:
+                    hist = self.phases[(method, name)] = Histogram()
+                hist.observe(seconds)
+            if failed:
+                self.errors[method] = self.errors.get(method, 0) + 1
+
+    def counter(self, name: str, help: str):
+        '''Declares a counter added to by count().'''
+        self.help[name] = help
+        self.counters[name] = 0
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def collect(self, name: str, kind: str, help: str, fn):
+        '''Declares a counter or gauge whose value fn() returns when
+           scraped.'''
+        self.help[name] = help
+        self.collected[name] = (kind, fn)
+
+    def render(self) -> str:
+        '''Returns the metrics in the Prometheus text format.'''
+        with self._lock:
+            requests = {method: (list(hist.counts), hist.sum)
+                        for method, hist in self.requests.items()}
+            phases = {key: (list(hist.counts), hist.sum)
+                      for key, hist in self.phases.items()}
+            errors = dict(self.errors)
+            counters = dict(self.counters)
+        lines = ['# HELP aw_rpc_seconds Time spent running each rpc.',
+                 '# TYPE aw_rpc_seconds histogram']
+        for method, (counts, seconds) in sorted(requests.items()):
+            lines += histogram_lines('aw_rpc_seconds', {'method': method},
+                                     counts, seconds)
+        lines += ['# HELP aw_rpc_phase_seconds Time spent in each phase '
+                  'of an rpc.',
+                  '# TYPE aw_rpc_phase_seconds histogram']
+        for (method, name), (counts, seconds) in sorted(phases.items()):
+            lines += histogram_lines('aw_rpc_phase_seconds',
+                                     {'method': method, 'phase': name},
+                                     counts, seconds)
+        lines += ['# HELP aw_rpc_errors_total Rpc calls that failed.',
+                  '# TYPE aw_rpc_errors_total counter']
+        for method, count in sorted(errors.items()):
+            lines.append(f'aw_rpc_errors_total{labels(method=method)} '
+                         f'{count}')
+        for name, value in counters.items():
+            lines += [f'# HELP {name} {self.help[name]}',
+                      f'# TYPE {name} counter', f'{name} {value}']
+        for name, (kind, fn) in self.collected.items():
+            lines += [f'# HELP {name} {self.help[name]}',
+                      f'# TYPE {name} {kind}', f'{name} {fn()}']
+        return '\n'.join(lines) + '\n'
@@ -1,7 +1,8 @@
 import datetime
+import json
 import secrets
 
-import jsons
+from sqlalchemy import inspect, text
 
 from app_core import db
 
@@ -12,14 +13,32 @@ class Game(db.Model):
     date = db.Column(db.DateTime())
     updated = db.Column(db.DateTime())
     board = db.Column(db.String())
+    # the board packed and compressed, used instead of board when
+    # BOARD_FORMAT is zlib, see codec.dumpb()
+    board_bin = db.Column(db.LargeBinary())
+    # board version of the saved board, see save_board()
+    version = db.Column(db.Integer, nullable=False, default=0)
 
-    def __init__(self, board, token=None):
+    def __init__(self, board, token=None, version=0):
         if not token:
             token = secrets.token_urlsafe(4)
         self.token = token
         self.date = datetime.datetime.now()
-        self.update = self.date
-        self.board = jsons.dumps(board)
+        self.updated = self.date
+        self.board, self.board_bin = self.columns(board)
+        self.version = version
+
+    @property
+    def data(self):
+        '''The saved board in whichever format it was saved.'''
+        return self.board_bin if self.board_bin is not None else self.board
+
+    @staticmethod
+    def columns(board):
+        '''Returns the (board, board_bin) column values for the board.'''
+        if isinstance(board, bytes):
+            return None, board
+        return board, None
 
     @classmethod
     def from_id(cls, session, id):
@@ -28,3 +47,100 @@ class Game(db.Model):
     @classmethod
     def from_token(cls, session, token):
         return session.query(cls).filter(cls.token == token).first()
+
+    @classmethod
+    def save_board(cls, session, token, board, version):
+        '''Compare and swap: writes the board only if the saved board is
+           not newer, so a late or stale write never replaces a newer board.
+        :return: [true if the board was written]'''
+        text, binary = cls.columns(board)
+        count = session.query(cls).filter(
+            cls.token == token, cls.version <= version).update(
+            {cls.board: text, cls.board_bin: binary, cls.version: version,
+             cls.updated: datetime.datetime.now()},
+            synchronize_session=False)
+        session.commit()
+        return count > 0
+
+
+class MapTerrain(db.Model):
+    '''The terrain of a map, stored once for every game on the map and
+       keyed by a hash of its contents, see codec.TerrainStore.'''
+    __tablename__ = 'maps'
+    id = db.Column(db.String(40), primary_key=True)
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    terrain = db.Column(db.String(), nullable=False)
+    date = db.Column(db.DateTime())
+
+    def __init__(self, id, width, height, terrain):
+        self.id = id
+        self.width = width
+        self.height = height
+        self.terrain = terrain
+        self.date = datetime.datetime.now()
+
+    @classmethod
+    def from_id(cls, session, id):
+        return session.query(cls).filter(cls.id == id).first()
+
+
+class GameAction(db.Model):
+    '''An action applied to a game, replayed on top of the last
+       saved board to restore the game.  (token, seq) is unique so two
+       workers can not both append the next action of a game.'''
+    __table_args__ = (db.UniqueConstraint('token', 'seq'),)
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.String(), nullable=False, index=True)
+    seq = db.Column(db.Integer, nullable=False)
+    method = db.Column(db.String(), nullable=False)
+    args = db.Column(db.String())
+    seed = db.Column(db.BigInteger())
+    date = db.Column(db.DateTime())
+
+    def __init__(self, token, seq, method, args, seed):
+        self.token = token
+        self.seq = seq
+        self.method = method
+        self.args = json.dumps(args)
+        self.seed = seed
+        self.date = datetime.datetime.now()
+
+    @classmethod
+    def after(cls, session, token, seq):
+        '''Returns the actions for the game after seq in order.'''
+        return session.query(cls).filter(
+            cls.token == token, cls.seq > seq).order_by(cls.seq).all()
+
+    @classmethod
+    def delete_all(cls, session, token):
+        session.query(cls).filter(cls.token == token).delete()
+
+
+def schema_upgrade(engine) -> list:
+    '''Creates the missing tables and adds the columns that tables made by
+       older versions lack, which create_all() leaves alone.  A new NOT
+       NULL column gets its default for the existing rows.
+    :return: [the columns added, as table.column]'''
+    db.metadata.create_all(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    added = []
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in db.metadata.sorted_tables:
+            existing = {column['name']
+                        for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                sql = (f'ALTER TABLE {quote(table.name)} ADD COLUMN '
+                       f'{quote(column.name)} '
+                       f'{column.type.compile(dialect=engine.dialect)}')
+                if not column.nullable:
+                    if column.default is None:
+                        raise Exception(f'can not add {table.name}.'
+                                        f'{column.name} without a default')
+                    sql += f' NOT NULL DEFAULT {column.default.arg!r}'
+                connection.execute(text(sql))
+                added.append(f'{table.name}.{column.name}')
+    return added
@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+
+'''[Headless self-play runner for the game engine]
+
+    python3 selfplay.py [--games N] [--maps MAP1,SCORPION] [--workers W]
+                        [--days D] [--budget MS] [--seed S]
+
+Plays complete games between two CPU opponents (ai.py) on GameManager
+boards without Flask, Socket.IO or a database, spread over a process
+pool.  Each game has its own seed for the damage rolls so a run can be
+repeated.  A game is won by capturing the enemy HQ and drawn when it runs
+past the day limit.  Reports games/sec, actions/sec, turn length and the
+time spent ending turns and path finding, and the win rates per map.
+'''
+
+import argparse
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import ai
+from config import rules
+from gameboard import GameBoard
+from manager import GameManager
+from mapping import MAPS
+
+
+def timed(fn, stats: dict, key: str):
+    '''Wraps fn to add its run time in seconds to stats[key].'''
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            stats[key] += time.perf_counter() - start
+    return wrapper
+
+
+def play_game(map_name: str, seed: int, days: int = 30,
+              budget_ms: int = 1000) -> dict:
+    '''Plays a game between two bots and returns its result and timings.'''
+    rng = random.Random(seed)
+    mngr = GameManager(rules, GameBoard.from_map(MAPS[map_name]))
+    stats = {'end_turn': 0.0, 'path': 0.0}
+    mngr.army_end_turn = timed(mngr.army_end_turn, stats, 'end_turn')
+    mngr.unit_reachable = timed(mngr.unit_reachable, stats, 'path')
+
+    def act(method, *args):
+        return mngr.apply(method, list(args), rng.getrandbits(31))
+
+    board = mngr.board
+    turns = actions = 0
+    start = time.perf_counter()
+    while board.game_active and board.days <= days:
+        result = ai.play_turn(mngr, board.current_turn.name, budget_ms, act)
+        turns += 1
+        actions += result['actions']
+    elapsed = time.perf_counter() - start
+    return {
+        'map': map_name,
+        'seed': seed,
+        'winner': None if board.game_active else board.current_turn.name,
+        'days': board.days,
+        'turns': turns,
+        'actions': actions,
+        'seconds': elapsed,
+        'end_turn_seconds': stats['end_turn'],
+        'path_seconds': stats['path'],
+    }
+
+
+def play_games(args: tuple) -> dict:
+    '''play_game(*args), the unit of work sent to the pool.'''
+    return play_game(*args)
+
+
+def summarize(results: list) -> dict:
+    '''Returns the totals and win rates per map of the game results.'''
+    maps = {}
+    for result in results:
+        summary = maps.setdefault(result['map'], {
+            'games': 0, 'turns': 0, 'actions': 0, 'days': 0,
+            'seconds': 0.0, 'end_turn_seconds': 0.0, 'path_seconds': 0.0,
+            'wins': {'RED': 0, 'BLUE': 0, None: 0}})
+        summary['games'] += 1
+        summary['wins'][result['winner']] = \
+            summary['wins'].get(result['winner'], 0) + 1
+        for key in ('turns', 'actions', 'days', 'seconds',
+                    'end_turn_seconds', 'path_seconds'):
+            summary[key] += result[key]
+    return maps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--maps', default=','.join(MAPS))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--budget', type=int, default=1000,
+                        help='ms each bot may plan a turn for')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    maps = args.maps.split(',')
+    for name in maps:
+        if name not in MAPS:
+            parser.error(f'unknown map {name}, one of {", ".join(MAPS)}')
+    games = [(maps[i % len(maps)], args.seed + i, args.days, args.budget)
+             for i in range(args.games)]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(args.workers) as pool:
+        results = list(pool.map(play_games, games, chunksize=4))
+    elapsed = time.perf_counter() - start
+    actions = sum(result['actions'] for result in results)
+    print(f'{len(results)} games in {elapsed:.1f}s  '
+          f'{len(results) / elapsed:.1f} games/sec  '
+          f'{actions / elapsed:.0f} actions/sec')
+    print()
+    print(f'{"map":<12} {"games":>6} {"red":>6} {"blue":>6} {"draw":>6} '
+          f'{"days":>6} {"turn ms":>8} {"end turn ms":>12} {"path ms":>8}')
+    for name, summary in summarize(results).items():
+        games, turns = summary['games'], summary['turns']
+        wins = summary['wins']
+        print(f'{name:<12} {games:>6} '
+              f'{wins["RED"] / games:>6.0%} {wins["BLUE"] / games:>6.0%} '
+              f'{wins[None] / games:>6.0%} '
+              f'{summary["days"] / games:>6.1f} '
+              f'{summary["seconds"] * 1000 / turns:>8.2f} '
+              f'{summary["end_turn_seconds"] * 1000 / turns:>12.3f} '
+              f'{summary["path_seconds"] * 1000 / turns:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+
+'''[Production entry point for the game server]
+
+    python3 server.py
+
+Runs the app without the debugger and reloader.  WORKER_MODE picks the
+server: eventlet (the default) or gevent serve every request and websocket
+on green threads, threading uses the Werkzeug server.  Falls back to
+threading when the green thread library is not installed.
+'''
+
+import logging
+import os
+
+mode = os.getenv('WORKER_MODE', 'eventlet')
+try:
+    if mode == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+    elif mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+except ImportError:
+    logging.warning(f'{mode} is not installed, using threading')
+    mode = 'threading'
+# app_core reads the mode when the app is imported
+os.environ['WORKER_MODE'] = mode
+
+from app import app, app_startup, setup_logging  # noqa: E402
+from app_core import socketio  # noqa: E402
+
+
+def main():
+    setup_logging(getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
+    app_startup()
+    # Bind to PORT if defined, otherwise default to 5000.
+    port = int(os.environ.get('PORT', 5000))
+    logging.info(f'binding to port: {port} worker mode: {mode}')
+    options = {}
+    if mode == 'threading':
+        options['allow_unsafe_werkzeug'] = True
+    socketio.run(app, host='0.0.0.0', port=port, debug=False,
+                 use_reloader=False, log_output=False, **options)
+
+
+if __name__ == '__main__':
+    main()
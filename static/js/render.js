@@ -47,6 +47,10 @@ setTimeout(function() {
         console.log('update: ' + msg);
         update();
     });
+    socket.on('delta', (msg) => {
+        console.log('delta: ' + msg.version);
+        applyDelta(msg);
+    });
     socket.on('message', (msg) => {
         console.log('message: ' + msg);
         var textareachat = document.getElementById('textareachat');
@@ -102,53 +106,78 @@ function update() {
     jsonrpc('game_board', {}, function(res) {
         // init globals
         board = res
-        if (two === null) {
-            // make an instance of two and place it on the page.
-            var elem = document.getElementById('draw');
-            var params = { type: Two.Types.canvas, width: board.width * TILESIZE, height: board.height * TILESIZE };
-            two = new Two(params).appendTo(elem);
-            // canvas mouse handling
-            var draw = document.getElementById('draw');
-            var canvas = draw.children[0];
-            canvas.onmousemove = canvasMove;
-            canvas.onclick = canvasClick;
-            canvas.ondblclick = canvasdblClick;
-        }
-        // render
-        two.clear();
-        createScene();
-        two.update();
-        // update info
-
-        var gamebox = document.getElementById('gamebox');
-        gamebox.innerText =
-                           `Game info:
-                             - Day: ${board.days}
-                             - Current Turn: ${board.current_turn}
-                             - Game Active: ${board.game_active}
-                             Blue:
-                             - Troops: ${board.total_blue_troops}
-                             - Income: ${board.total_blue_properties}
-                             - Funds: ${board.blue_funds}
-                            Red:
-                            - Troops: ${board.total_red_troops}
-                            - Income: ${board.total_red_properties}
-                            - Funds: ${board.red_funds}
-                            `;
-
-        var infobox = document.getElementById('infobox');
-        infobox.innerText =
-                        `Instructions:
-                        - Single click: move, attack
-                        -  + ctrl: load unit
-                        -  + alt: unload unit
-                        - Double click: capture, wait`;
-        // update code
-        var code = document.getElementById('code');
-        code.value = JSON.stringify(board, null, 2);
+        render();
     });
 }
 
+// apply the tiles changed by one action, fetching the whole board
+// if a version was missed
+function applyDelta(delta) {
+    if (board === null || delta.version <= board.version) {
+        return;
+    }
+    if (delta.version !== board.version + 1) {
+        update();
+        return;
+    }
+    for (const tile of delta.tiles) {
+        board.grid[tile.x + tile.y * board.width] = tile;
+    }
+    for (const key in delta) {
+        if (key !== 'tiles') {
+            board[key] = delta[key];
+        }
+    }
+    render();
+}
+
+function render() {
+    if (two === null) {
+        // make an instance of two and place it on the page.
+        var elem = document.getElementById('draw');
+        var params = { type: Two.Types.canvas, width: board.width * TILESIZE, height: board.height * TILESIZE };
+        two = new Two(params).appendTo(elem);
+        // canvas mouse handling
+        var draw = document.getElementById('draw');
+        var canvas = draw.children[0];
+        canvas.onmousemove = canvasMove;
+        canvas.onclick = canvasClick;
+        canvas.ondblclick = canvasdblClick;
+    }
+    // render
+    two.clear();
+    createScene();
+    two.update();
+    // update info
+
+    var gamebox = document.getElementById('gamebox');
+    gamebox.innerText =
+                       `Game info:
+                         - Day: ${board.days}
+                         - Current Turn: ${board.current_turn}
+                         - Game Active: ${board.game_active}
+                         Blue:
+                         - Troops: ${board.total_blue_troops}
+                         - Income: ${board.total_blue_properties}
+                         - Funds: ${board.blue_funds}
+                        Red:
+                        - Troops: ${board.total_red_troops}
+                        - Income: ${board.total_red_properties}
+                        - Funds: ${board.red_funds}
+                        `;
+
+    var infobox = document.getElementById('infobox');
+    infobox.innerText =
+                    `Instructions:
+                    - Single click: move, attack
+                    -  + ctrl: load unit
+                    -  + alt: unload unit
+                    - Double click: capture, wait`;
+    // update code
+    var code = document.getElementById('code');
+    code.value = JSON.stringify(board, null, 2);
+}
+
 function chat(ev) {
     if ('key' in ev && ev.key != 'Enter')
         return;
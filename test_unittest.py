@@ -1,9 +1,35 @@
 '''[This is a suite of tests using unittest ]'''
 
 import unittest
+from unittest import mock
 import app
+import os
 import random
-from app_core import app as _app, db
+import tempfile
+import threading
+import time
+import jsons
+
+import ai
+import benchmark
+import codec
+import selfplay
+from array_board import ArrayBoard
+from app_core import app as _app, db, engine_options
+from army import Army
+from config import Config, load_rules
+from dijkstra import shortest_path, INF
+from game_cache import GameCache
+from game_queue import GameQueue
+from gameboard import GameBoard
+from manager import GameManager
+from mapping import Map, MapType, MAP1, map_tile
+from metrics import Metrics
+from models import Game, GameAction, MapTerrain, schema_upgrade
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+from unit import UnitClass, UnitType
 
 
 print('Running unit tests....')
@@ -52,6 +78,972 @@ class Test_RPC_unit_create(unittest.TestCase):
             app.game_delete_rpc(game)
 
 
+''' Test the heap based path finding.'''
+
+
+class Test_shortest_path(unittest.TestCase):
+
+    def setUp(self):
+        board = GameBoard.create(Map.parse(MAP1))
+        self.mngr = GameManager(Config(), board)
+        self.mngr.board.red_funds = 10000
+        self.mngr.unit_create('RED', 'INFANTRY', 0, 0)
+
+    def test_path_along_road(self):
+        print('Testing shortest path')
+        mngr = self.mngr
+        cost, path = shortest_path(mngr.board, mngr.tile_at(0, 0),
+                                   mngr.tile_at(0, 3))
+        self.assertEqual(cost, 3)
+        self.assertEqual(path, [(0, 0), (0, 1), (0, 2), (0, 3)])
+
+    def test_budget_cutoff(self):
+        print('Testing path budget cutoff')
+        mngr = self.mngr
+        cost, path = shortest_path(mngr.board, mngr.tile_at(0, 0),
+                                   mngr.tile_at(0, 5), 3)
+        self.assertEqual(cost, INF)
+        self.assertEqual(path, [])
+
+
+''' Test reachable tiles and selection.'''
+
+
+class Test_reachable_tiles(unittest.TestCase):
+
+    def setUp(self):
+        board = GameBoard.create(Map.parse(MAP1))
+        self.mngr = GameManager(Config(), board)
+        self.mngr.board.red_funds = 10000
+        self.mngr.unit_create('RED', 'INFANTRY', 0, 0)
+        self.mngr.unit_create('RED', 'TANK', 1, 0)
+        self.mngr.army_end_turn()
+        self.mngr.army_end_turn()
+
+    def test_reachable_matches_can_move_to(self):
+        print('Testing reachable tiles')
+        mngr = self.mngr
+        unit = mngr.unit_at(0, 0)
+        costs = {(t['x'], t['y']): t['cost']
+                 for t in mngr.reachable_tiles(0, 0)}
+        for tile in mngr.board.grid:
+            self.assertEqual((tile.x, tile.y) in costs,
+                             mngr.unit_can_move_to(unit, tile.x, tile.y))
+        self.assertEqual(costs[(0, 3)], 3)
+        self.assertNotIn((1, 0), costs)
+
+    def test_select_marks_reachable(self):
+        print('Testing unit select')
+        mngr = self.mngr
+        mngr.unit_select(0, 0)
+        moved = {(t.x, t.y) for t in mngr.board.grid if t.can_be_moved_to}
+        costs = {(t['x'], t['y']) for t in mngr.reachable_tiles(0, 0)}
+        self.assertEqual(moved, costs)
+
+    def test_terrain_changed(self):
+        print('Testing cost grids after a terrain change')
+        mngr = self.mngr
+        index = 0 + 1 * mngr.board.width
+        self.assertEqual(mngr.cost_grid(UnitClass.FOOT)[index], 1)
+        mngr.tile_at(0, 1).mapTile = map_tile(MapType.MOUNTAIN)
+        # the compiled grids are kept until told the terrain changed
+        self.assertEqual(mngr.cost_grid(UnitClass.FOOT)[index], 1)
+        mngr.terrain_changed()
+        self.assertEqual(mngr.cost_grid(UnitClass.FOOT)[index], 2)
+        costs = {(t['x'], t['y']): t['cost']
+                 for t in mngr.reachable_tiles(0, 0)}
+        self.assertEqual(costs[(0, 1)], 2)
+        self.assertEqual(costs[(0, 2)], 3)
+        self.assertNotIn((0, 3), costs)
+        mngr.tile_at(0, 1).mapTile = map_tile(MapType.SEA)
+        mngr.terrain_changed()
+        costs = {(t['x'], t['y']) for t in mngr.reachable_tiles(0, 0)}
+        self.assertNotIn((0, 1), costs)
+
+
+''' Test the army threat map.'''
+
+
+class Test_threat_map(unittest.TestCase):
+
+    def setUp(self):
+        board = GameBoard.create(Map.parse(MAP1))
+        self.mngr = GameManager(Config(), board)
+        self.mngr.board.red_funds = 10000
+        self.mngr.board.blue_funds = 10000
+        self.mngr.unit_create('RED', 'TANK', 0, 0)
+        self.mngr.army_end_turn()
+        self.mngr.unit_create('BLUE', 'INFANTRY', 0, 4)
+
+    def test_threat_map(self):
+        print('Testing threat map')
+        tiles = {(t['x'], t['y']): t for t in self.mngr.threat_map('red')}
+        # tank moves 6 along the road so threatens the infantry 4 tiles away
+        self.assertIn((0, 4), tiles)
+        self.assertGreater(tiles[(0, 4)]['damage'], 0)
+        self.assertEqual(tiles[(0, 1)]['damage'], 0)
+        self.assertNotIn((6, 6), tiles)
+
+    def test_recreated_game(self):
+        print('Testing threat map of a recreated game')
+        token = game + 'threat'
+        with _app.app_context():
+            db.create_all()
+            app.game_create_rpc(token)
+            app.army_end_turn_rpc(token)
+            app.army_end_turn_rpc(token)
+            app.unit_create_rpc(token, 'RED', 'INFANTRY', 3, 1)
+            self.assertTrue(app.threat_map_rpc(token, 'RED'))
+            app.game_delete_rpc(token)
+            # a new game at the same version has no red units
+            app.game_create_rpc(token)
+            for i in range(3):
+                app.army_end_turn_rpc(token)
+            self.assertEqual(app.threat_map_rpc(token, 'RED'), [])
+            app.game_delete_rpc(token)
+
+
+''' Test the unit position index.'''
+
+
+class Test_unit_index(unittest.TestCase):
+
+    def setUp(self):
+        board = GameBoard.create(Map.parse(MAP1))
+        self.mngr = GameManager(Config(), board)
+        self.mngr.board.red_funds = 10000
+
+    def test_index_follows_units(self):
+        print('Testing unit index')
+        mngr = self.mngr
+        mngr.unit_create('RED', 'INFANTRY', 0, 0)
+        mngr.unit_create('RED', 'APC', 0, 2)
+        self.assertEqual([u.id for u in mngr.army_units[Army.RED].values()],
+                         [0, 1])
+        mngr.army_end_turn()
+        mngr.army_end_turn()
+        mngr.unit_move(0, 2, 0, 3)
+        self.assertEqual(mngr.unit_positions[1], (0, 3))
+        mngr.unit_load(0, 0, 0, 3)
+        self.assertNotIn(0, mngr.unit_positions)
+        mngr.unit_unload(0, 3, 1, 3, 0)
+        self.assertEqual(mngr.tile_from_unit(mngr.unit_from_id(0)),
+                         mngr.tile_at(1, 3))
+        rebuilt = GameManager(mngr.config, mngr.board)
+        self.assertEqual(rebuilt.unit_positions, mngr.unit_positions)
+
+    def test_army_totals(self):
+        print('Testing army totals')
+        mngr = self.mngr
+        mngr.unit_create('RED', 'INFANTRY', 1, 3)
+        mngr.army_end_turn()
+        mngr.army_end_turn()
+        mngr.capture_tile(1, 3)
+        self.assertEqual(mngr.capture_sites, {22})
+        mngr.army_end_turn()
+        mngr.army_end_turn()
+        mngr.unit_move(1, 3, 1, 2)
+        self.assertEqual(mngr.capture_sites, set())
+        self.assertEqual(mngr.tile_at(1, 3).capture_hp, 20)
+        mngr.army_end_turn()
+        mngr.army_end_turn()
+        mngr.unit_move(1, 2, 1, 3)
+        for i in range(2):
+            mngr.army_end_turn()
+            mngr.army_end_turn()
+            mngr.capture_tile(1, 3)
+        self.assertIn(22, mngr.army_properties[Army.RED])
+        mngr.army_end_turn()
+        board = mngr.board
+        owned = [t.mapTile.army for t in board.grid if t.mapTile.army]
+        self.assertEqual(board.total_red_properties,
+                         1000 * owned.count(Army.RED))
+        self.assertEqual(board.total_blue_properties,
+                         1000 * owned.count(Army.BLUE))
+        self.assertEqual(board.total_red_troops, 1)
+        rebuilt = GameManager(mngr.config, board)
+        self.assertEqual(rebuilt.army_properties, mngr.army_properties)
+        self.assertEqual(rebuilt.capture_sites, mngr.capture_sites)
+
+
+''' Test the in-memory game cache.'''
+
+
+class Test_game_cache(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = []
+
+        def save(token, snapshot):
+            self.saved.append(snapshot)
+            return 10
+        self.cache = GameCache(save, max_games=2, save_interval=60)
+
+    def test_write_behind_and_eviction(self):
+        print('Testing game cache')
+        cache = self.cache
+        cache.put('a', 'game a')
+        cache.put('b', 'game b')
+        cache.mark_dirty('a', 'a1')
+        cache.mark_dirty('a', 'a2')
+        self.assertEqual(self.saved, [])
+        cache.get('a')
+        cache.put('c', 'game c')
+        # b was least recently used and clean so is dropped unsaved
+        self.assertNotIn('b', cache)
+        self.assertEqual(self.saved, [])
+        cache.put('d', 'game d')
+        # only the latest snapshot of a is written
+        self.assertEqual(self.saved, ['a2'])
+        cache.mark_dirty('d', 'd1')
+        cache.close()
+        self.assertEqual(self.saved, ['a2', 'd1'])
+        self.assertEqual(len(cache), 0)
+
+    def test_memory_limit(self):
+        print('Testing game cache memory limit')
+        mngr = GameManager(Config(), GameBoard.from_map(MAP1))
+        other = GameManager(Config(), GameBoard.from_map(MAP1))
+        size = mngr.memory_estimate()
+        cache = GameCache(lambda token, snapshot: None,
+                          max_bytes=size * 2 + 100, save_interval=60,
+                          sizeof=GameManager.memory_estimate)
+        cache.put('a', mngr)
+        cache.put('b', other)
+        self.assertIn('a', cache)
+        # a new unit is counted when the game is saved
+        mngr.board.red_funds = 10000
+        mngr.unit_create('RED', 'INFANTRY', 3, 1)
+        cache.mark_dirty('a', 'a1')
+        cache.put('b', other)
+        self.assertNotIn('a', cache)
+        self.assertIn('b', cache)
+        arrays = GameManager(Config(), ArrayBoard.from_board(mngr.board))
+        self.assertLess(arrays.memory_estimate(), mngr.memory_estimate())
+
+
+''' Test the per game queue.'''
+
+
+class Test_game_queue(unittest.TestCase):
+
+    def test_calls_do_not_overlap(self):
+        print('Testing game queue')
+        queue = GameQueue()
+        running = []
+        calls = []
+
+        def call(token, n):
+            running.append(token)
+            self.assertEqual(running.count(token), 1)
+            time.sleep(0.01)
+            calls.append((token, n))
+            running.remove(token)
+            return n
+        threads = [threading.Thread(target=queue.run,
+                                    args=(token, call, token, n))
+                   for n in range(4) for token in 'ab']
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 8)
+        self.assertEqual(len(queue), 0)
+        # a call made from a running call on the same game runs at once
+        self.assertEqual(queue.run('a', queue.run, 'a', call, 'a', 5), 5)
+        with self.assertRaises(ZeroDivisionError):
+            queue.run('a', lambda: 1 / 0)
+        self.assertEqual(len(queue), 0)
+
+    def test_own_thread_in_order(self):
+        print('Testing game queue order')
+        queue = GameQueue()
+        calls = []
+
+        def call(n):
+            calls.append((n, threading.get_ident()))
+        threads = []
+        with queue.hold('a'):
+            for n in range(4):
+                thread = threading.Thread(target=queue.run,
+                                          args=('a', call, n))
+                thread.start()
+                threads.append(thread)
+                # let it take its ticket before the next one starts
+                time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [(n, thread.ident)
+                                 for n, thread in enumerate(threads)])
+        self.assertEqual(len(queue), 0)
+
+
+''' Test old databases are upgraded at start up.'''
+
+
+class Test_schema_upgrade(unittest.TestCase):
+
+    def test_old_database(self):
+        print('Testing schema upgrade')
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine(f'sqlite:///{tmp}/old.db')
+            with engine.begin() as connection:
+                connection.execute(text(
+                    'CREATE TABLE game (id INTEGER PRIMARY KEY, '
+                    'token VARCHAR NOT NULL UNIQUE, date DATETIME, '
+                    'updated DATETIME, board VARCHAR)'))
+                connection.execute(text(
+                    "INSERT INTO game (token, board) VALUES ('old', '{}')"))
+            self.assertEqual(schema_upgrade(engine),
+                             ['game.board_bin', 'game.version'])
+            self.assertEqual(schema_upgrade(engine), [])
+            with Session(engine) as session:
+                saved = Game.from_token(session, 'old')
+                self.assertEqual((saved.version, saved.data), (0, '{}'))
+                self.assertEqual(GameAction.after(session, 'old', 0), [])
+                self.assertIsNone(MapTerrain.from_id(session, 'none'))
+            engine.dispose()
+
+
+''' Test the engine options suit each database.'''
+
+
+class Test_engine_options(unittest.TestCase):
+
+    def test_sqlite_memory(self):
+        print('Testing engine options')
+        self.assertEqual(engine_options('postgresql://db/aw')['pool_size'],
+                         int(os.getenv('DB_POOL_SIZE', 10)))
+        options = engine_options('sqlite://')
+        self.assertNotIn('pool_size', options)
+        engine = create_engine('sqlite://', poolclass=StaticPool, **options)
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute(text('SELECT 1')).scalar(), 1)
+        engine.dispose()
+
+
+''' Test saved boards are only replaced by newer ones.'''
+
+
+class Test_game_version(unittest.TestCase):
+
+    def test_compare_and_swap(self):
+        print('Testing game version')
+        with _app.app_context():
+            db.create_all()
+            db.session.add(Game('board 5', game, 5))
+            db.session.commit()
+            self.assertFalse(Game.save_board(db.session, game, 'board 4', 4))
+            self.assertTrue(Game.save_board(db.session, game, 'board 6', 6))
+            saved = Game.from_token(db.session, game)
+            self.assertEqual((saved.board, saved.version), ('board 6', 6))
+            db.session.delete(saved)
+            db.session.commit()
+
+
+''' Test boards are converted to the configured storage format.'''
+
+
+class Test_board_format(unittest.TestCase):
+
+    def setUp(self):
+        with _app.app_context():
+            db.create_all()
+            app.game_create_rpc(game)
+
+    def test_lazy_convert(self):
+        print('Testing board format conversion')
+        with _app.app_context():
+            app.unit_create_rpc(game, 'RED', 'INFANTRY', 3, 1)
+            board = app.game_board_rpc(game)
+            _app.config['BOARD_FORMAT'] = 'zlib'
+            try:
+                app.game_cache.evict(game, flush=False)
+                self.assertEqual(app.game_board_rpc(game), board)
+                app.game_cache.flush()
+                saved = Game.from_token(db.session, game)
+                db.session.refresh(saved)
+                self.assertIsNone(saved.board)
+                self.assertIsNotNone(saved.board_bin)
+                stats = app.board_storage_rpc(game)
+                self.assertEqual(stats['stored_bytes'], len(saved.board_bin))
+                self.assertLess(stats['zlib']['bytes'], stats['json']['bytes'])
+                app.game_cache.evict(game, flush=False)
+                self.assertEqual(app.game_board_rpc(game), board)
+            finally:
+                _app.config['BOARD_FORMAT'] = 'json'
+
+    def tearDown(self):
+        with _app.app_context():
+            app.game_delete_rpc(game)
+
+
+''' Test games changed by other workers are dropped from the cache.'''
+
+
+class Test_game_bus(unittest.TestCase):
+
+    def setUp(self):
+        with _app.app_context():
+            db.create_all()
+            app.game_create_rpc(game)
+        app.game_bus.subscribe(app.game_invalidate)
+
+    def test_invalidate(self):
+        print('Testing game bus')
+        version = app.game_cache.peek(game).board.version
+        # own and older changes are ignored
+        app.game_publish(game, version + 1)
+        app.game_bus.publish({'worker': 'other', 'token': game,
+                              'version': version})
+        self.assertIn(game, app.game_cache)
+        app.game_bus.publish({'worker': 'other', 'token': game,
+                              'version': version + 1})
+        self.assertNotIn(game, app.game_cache)
+
+    def test_invalidate_during_rpc(self):
+        print('Testing game bus alongside an rpc')
+        errors = []
+        evict = app.game_cache.evict
+
+        def slow_evict(*args, **kwargs):
+            time.sleep(0.05)
+            return evict(*args, **kwargs)
+
+        def listen():
+            # as the bus listener thread, outside any app context
+            try:
+                app.game_invalidate({'worker': 'other', 'token': game,
+                                     'version': 10 ** 9})
+            except Exception as ex:
+                errors.append(ex)
+        listener = threading.Thread(target=listen)
+        with mock.patch.object(app.game_cache, 'evict', slow_evict):
+            listener.start()
+            time.sleep(0.01)
+            # queued while the listener holds the game
+            with _app.app_context():
+                self.assertEqual(app.army_end_turn_rpc(game), 'BLUE')
+        listener.join()
+        self.assertEqual(errors, [])
+        with _app.app_context():
+            self.assertEqual(app.game_load(game).board.current_turn,
+                             Army.BLUE)
+
+    def tearDown(self):
+        app.game_bus.unsubscribe(app.game_invalidate)
+        with _app.app_context():
+            app.game_delete_rpc(game)
+
+
+''' Test new boards are copied from a shared template.'''
+
+
+class Test_map_registry(unittest.TestCase):
+
+    def test_template_copy(self):
+        print('Testing map registry')
+        board = GameBoard.from_map(MAP1)
+        self.assertEqual(jsons.dump(board),
+                         jsons.dump(GameBoard.create(Map.parse(MAP1))))
+        other = GameBoard.from_map(MAP1)
+        self.assertIs(board.grid[0].mapTile, other.grid[0].mapTile)
+        mngr = GameManager(Config(), board)
+        mngr.unit_create('RED', 'INFANTRY', 1, 3)
+        for i in range(2):
+            mngr.army_end_turn()
+            mngr.army_end_turn()
+            mngr.capture_tile(1, 3)
+        # copy on write, the other boards still have the neutral city
+        self.assertEqual(mngr.tile_get(1, 3).mapTile.army, Army.RED)
+        self.assertIsNone(other.grid[22].mapTile.army)
+        self.assertIsNone(GameBoard.from_map(MAP1).grid[22].mapTile.army)
+
+
+''' Test the struct of arrays board plays like the GameBoard.'''
+
+
+class Test_array_board(unittest.TestCase):
+
+    def test_same_game(self):
+        print('Testing array board')
+        boards = [GameBoard.from_map(MAP1) for i in range(2)]
+        for board in boards:
+            board.red_funds = 10000
+        mngrs = [GameManager(Config(), boards[0]),
+                 GameManager(Config(), ArrayBoard.from_board(boards[1]))]
+        actions = [('unit_create', 'RED', 'INFANTRY', 1, 3),
+                   ('unit_create', 'RED', 'TANK', 3, 1),
+                   ('army_end_turn',),
+                   ('unit_create', 'BLUE', 'INFANTRY', 2, 2),
+                   ('army_end_turn',),
+                   ('capture_tile', 1, 3),
+                   ('unit_select', 3, 1),
+                   ('unit_move', 3, 1, 2, 1),
+                   ('unit_attack', 2, 1, 2, 2),
+                   ('army_end_turn',),
+                   ('army_end_turn',),
+                   ('capture_tile', 1, 3)]
+        for action in actions:
+            for mngr in mngrs:
+                mngr.apply(action[0], list(action[1:]), 7)
+            self.assertEqual(jsons.dump(mngrs[1].board),
+                             jsons.dump(mngrs[0].board))
+        for mngr in mngrs:
+            with self.assertRaises(Exception):
+                mngr.unit_command(1, 3, [1, 2], 'attack', [0, 0])
+        self.assertIsInstance(mngrs[1].board, ArrayBoard)
+        self.assertEqual(codec.encode_board(mngrs[1].board),
+                         codec.encode_board(mngrs[0].board))
+
+
+''' Test the attack forecast.'''
+
+
+class Test_attack_forecast(unittest.TestCase):
+
+    def setUp(self):
+        self.mngr = GameManager(Config(), GameBoard.from_map(MAP1))
+        board = self.mngr.board
+        board.red_funds = board.blue_funds = 20000
+        self.mngr.unit_create('RED', 'TANK', 2, 1)
+        self.mngr.unit_create('RED', 'ARTILLERY', 3, 1)
+        self.mngr.army_end_turn()
+        self.mngr.unit_create('BLUE', 'INFANTRY', 2, 2)
+        self.mngr.army_end_turn()
+
+    def test_forecast(self):
+        print('Testing attack forecast')
+        mngr = self.mngr
+        before = jsons.dump(mngr.board)
+        forecast = mngr.attack_forecast(2, 1)
+        self.assertEqual([(f['x'], f['y']) for f in forecast], [(2, 2)])
+        # no counterattack on an indirect attack
+        indirect = mngr.attack_forecast(3, 1)
+        self.assertEqual(indirect[0]['attacker'],
+                         {'min': 100, 'max': 100, 'expected': 100})
+        self.assertEqual(jsons.dump(mngr.board), before)
+        attacker, defender = forecast[0]['attacker'], forecast[0]['defender']
+        self.assertLess(defender['max'], 100)
+        self.assertLessEqual(attacker['min'], attacker['expected'])
+        self.assertLessEqual(attacker['expected'], attacker['max'])
+        # every attack lands inside the forecast
+        for seed in range(20):
+            board = codec.decode_board(codec.encode_board(mngr.board),
+                                       mngr.config)
+            copy = GameManager(mngr.config, board)
+            copy.apply('unit_attack', [2, 1, 2, 2], seed)
+            hp = copy.unit_at(2, 1).status.hp
+            self.assertTrue(attacker['min'] <= hp <= attacker['max'])
+            target = copy.unit_at(2, 2)
+            hp = target.status.hp if target else 0
+            self.assertTrue(defender['min'] <= hp <= defender['max'])
+        estimate = mngr.damage_estimate(2, 1, 2, 2)
+        self.assertEqual(estimate, (round(attacker['expected']),
+                                    round(defender['expected'])))
+        self.assertEqual(jsons.dump(mngr.board), before)
+
+    def test_damage_rolls(self):
+        print('Testing damage rolls')
+        mngr = self.mngr
+        tank, infantry = mngr.unit_at(2, 1), mngr.unit_at(2, 2)
+        infantry.status.hp = 64
+        tile = mngr.board.grid[2 * mngr.board.width + 2]
+        rolls = tank.damage_rolls(infantry, tile)
+        self.assertEqual([int(tank.damage_roll(infantry, tile, roll))
+                          for roll in range(10)], list(rolls))
+        rng = random.Random(1)
+        for _ in range(20):
+            self.assertIn(tank.attack_damage(infantry, tile, rng), rolls)
+        self.assertEqual(tank.expected_damage(infantry, tile),
+                         sum(min(damage, 64) for damage in rolls) / 10)
+        # the threat map and the forecast agree on the same attack
+        defender = mngr.attack_forecast(2, 1)[0]['defender']
+        threat = {(t['x'], t['y']): t['damage']
+                  for t in mngr.threat_map('RED')}
+        self.assertEqual(threat[(2, 2)], round(64 - defender['expected'], 1))
+
+
+''' Test the CPU opponent.'''
+
+
+class Test_ai(unittest.TestCase):
+
+    def setUp(self):
+        self.mngr = GameManager(Config(), GameBoard.from_map(MAP1))
+        board = self.mngr.board
+        board.red_funds = board.blue_funds = 20000
+        self.mngr.unit_create('RED', 'TANK', 2, 1)
+        self.mngr.army_end_turn()
+        self.mngr.unit_create('BLUE', 'INFANTRY', 2, 2)
+        self.mngr.army_end_turn()
+
+    def test_play_turn(self):
+        print('Testing ai turn')
+        mngr = self.mngr
+        result = ai.play_turn(mngr, 'red', 1000)
+        self.assertEqual(mngr.board.current_turn, Army.BLUE)
+        self.assertGreater(result['actions'], 1)
+        target = mngr.unit_at(2, 2)
+        self.assertTrue(target is None or target.status.hp < 100)
+        with self.assertRaises(Exception):
+            ai.play_turn(mngr, 'red', 1000)
+        actions = []
+
+        def act(method, *args):
+            actions.append(method)
+            return mngr.apply(method, list(args), 7)
+        ai.play_turn(mngr, 'blue', 1000, act)
+        self.assertEqual(actions[-1], 'army_end_turn')
+
+    def test_move_then_wait(self):
+        print('Testing ai wait')
+        mngr = self.mngr
+        x2, y2 = next(iter(mngr.unit_reachable(mngr.unit_at(2, 1))))
+        actions = []
+
+        def act(method, *args):
+            actions.append(method)
+            return mngr.apply(method, list(args), 7)
+        self.assertTrue(ai.carry_out(mngr, ai.Play(10, 2, 1, x2, y2, 'wait'),
+                                     act))
+        self.assertEqual(actions, ['unit_move', 'unit_wait'])
+        unit = mngr.unit_at(x2, y2)
+        self.assertFalse(unit.can_move or unit.can_attack or
+                         unit.can_capture)
+
+    def test_budget(self):
+        print('Testing ai budget')
+        mngr = self.mngr
+        ai.play_turn(mngr, 'red', 0)
+        self.assertEqual(mngr.board.current_turn, Army.BLUE)
+        self.assertEqual(mngr.unit_at(2, 1).type, UnitType.TANK)
+        self.assertEqual(mngr.unit_at(2, 2).status.hp, 100)
+
+    def test_remote_plan(self):
+        print('Testing ai remote plan')
+        mngr = self.mngr
+        positions = [(2, 1)]
+        deadline = time.monotonic() + 5
+        self.assertEqual(
+            ai.plan_remote(codec.encode_board(mngr.board), 'RED',
+                           positions, 5),
+            ai.plan_units(mngr, Army.RED, positions, deadline))
+
+
+''' Test the self-play runner.'''
+
+
+class Test_selfplay(unittest.TestCase):
+
+    def test_seeded_game(self):
+        print('Testing self-play')
+        results = [selfplay.play_game('MAP1', 5, days=4) for i in range(2)]
+        keys = ('winner', 'days', 'turns', 'actions')
+        self.assertEqual([results[0][key] for key in keys],
+                         [results[1][key] for key in keys])
+        self.assertGreater(results[0]['turns'], 1)
+        summary = selfplay.summarize(results)['MAP1']
+        self.assertEqual(summary['games'], 2)
+        self.assertEqual(sum(summary['wins'].values()), 2)
+
+
+''' Test the engine benchmark suite.'''
+
+
+class Test_benchmark(unittest.TestCase):
+
+    def test_suite(self):
+        print('Testing benchmark suite')
+        board = Map.parse(benchmark.synthetic_map(12, 10))
+        self.assertEqual((board.width, board.height), (12, 10))
+        self.assertEqual(board.tiles[6 + 5 * 12].type, MapType.MISSILE_SILO)
+        results = benchmark.run_suite({'MAP1': MAP1}, (0.2,), 0.001)
+        metrics = results['cases']['MAP1 20%']
+        self.assertEqual(len(metrics), 8)
+        self.assertTrue(all(ms > 0 for ms in metrics.values()))
+        slower = {'cases': {'MAP1 20%': dict(
+            metrics, dijkstra_ms=metrics['dijkstra_ms'] * 2)}}
+        rows = benchmark.compare(results, slower, 0.25)
+        self.assertEqual([row[1] for row in rows if row[5]], ['dijkstra_ms'])
+
+
+''' Test units share the stats of their type.'''
+
+
+class Test_unit_status(unittest.TestCase):
+
+    def test_shared_stats(self):
+        print('Testing unit status')
+        mngr = GameManager(Config(), GameBoard.from_map(MAP1))
+        mngr.board.red_funds = 10000
+        mngr.unit_create('RED', 'INFANTRY', 1, 3)
+        mngr.unit_create('RED', 'INFANTRY', 3, 1)
+        unit1, unit2 = mngr.unit_at(1, 3), mngr.unit_at(3, 1)
+        self.assertIs(unit1.status.config, unit2.status.config)
+        unit1.status.hp -= 30
+        self.assertEqual(unit2.status.hp, 100)
+        self.assertEqual(unit1.status.config.hp, 100)
+        status = jsons.dump(unit1)['status']
+        self.assertEqual(status['cls'], 'FOOT')
+        self.assertEqual(status['hp'], 70)
+        self.assertEqual(status['move'], unit1.status.move)
+        self.assertEqual(status['cargo'], [])
+        board = codec.loads(jsons.dumps(mngr.board), Config())
+        self.assertEqual(board.grid[22].unit, unit1)
+
+
+''' Test the rules compiled from config.ini.'''
+
+
+class Test_rules(unittest.TestCase):
+
+    def test_reload(self):
+        print('Testing rules reload')
+        with open('config.ini') as f:
+            text = f.read()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'config.ini')
+            with open(path, 'w') as f:
+                f.write(text)
+            rules = Config(path)
+            self.assertEqual(rules.income, 1000)
+            self.assertEqual(rules.units['TANK'].cost, 7000)
+            self.assertIs(rules.stats[UnitType.TANK.value],
+                          rules.units['TANK'])
+            self.assertIn(UnitClass.AIR, rules.repair[MapType.AIRPORT])
+            self.assertEqual(rules.repair[MapType.PLAIN], frozenset())
+            self.assertFalse(rules.reload())
+            with open(path, 'w') as f:
+                f.write(text.replace('income = 1000', 'income = 2000'))
+            os.utime(path, (rules.mtime + 1, rules.mtime + 1))
+            self.assertTrue(rules.reload())
+            self.assertEqual(rules.income, 2000)
+            self.assertFalse(rules.reload())
+            self.assertEqual(load_rules.cache_info().currsize, 1)
+
+
+''' Test the board codec.'''
+
+
+class Test_codec(unittest.TestCase):
+
+    def test_round_trip(self):
+        print('Testing board codec')
+        mngr = GameManager(Config(), GameBoard.create(Map.parse(MAP1)))
+        mngr.board.red_funds = 10000
+        mngr.unit_create('RED', 'APC', 0, 2)
+        mngr.unit_create('RED', 'INFANTRY', 0, 0)
+        mngr.army_end_turn()
+        mngr.army_end_turn()
+        mngr.unit_load(0, 0, 0, 2)
+        mngr.unit_select(0, 2)
+        board = codec.loads(codec.dumps(mngr.board), mngr.config)
+        self.assertEqual(jsons.dump(board), jsons.dump(mngr.board))
+        legacy = codec.loads(jsons.dumps(mngr.board), mngr.config)
+        self.assertEqual(jsons.dump(legacy), jsons.dump(mngr.board))
+
+    def test_legacy_rules(self):
+        print('Testing legacy board rules')
+        mngr = GameManager(Config(), GameBoard.create(Map.parse(MAP1)))
+        mngr.board.red_funds = 10000
+        mngr.unit_create('RED', 'APC', 0, 2)
+        mngr.unit_create('RED', 'INFANTRY', 0, 0)
+        mngr.army_end_turn()
+        mngr.army_end_turn()
+        mngr.unit_load(0, 0, 0, 2)
+        with open('config.ini') as f:
+            text = f.read()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'config.ini')
+            with open(path, 'w') as f:
+                f.write(text)
+            config = Config(path)
+        board = codec.loads(jsons.dumps(mngr.board), config)
+        apc = GameManager(config, board).unit_at(0, 2)
+        self.assertIs(apc.status.config, config.units['APC'])
+        self.assertIs(apc.status.cargo[0].status.config,
+                      config.units['INFANTRY'])
+        with self.assertRaises(Exception):
+            jsons.load(jsons.dump(mngr.board), GameBoard)
+
+    def test_binary(self):
+        print('Testing packed board')
+        mngr = GameManager(Config(), GameBoard.create(Map.parse(MAP1)))
+        mngr.unit_create('RED', 'INFANTRY', 0, 0)
+        data = codec.dumpb(mngr.board)
+        self.assertLess(len(data), len(codec.dumps(mngr.board)))
+        board = codec.loads(data, mngr.config)
+        self.assertEqual(jsons.dump(board), jsons.dump(mngr.board))
+
+    def test_terrain_store(self):
+        print('Testing terrain store')
+        store = codec.TerrainStore()
+        boards = [GameBoard.create(Map.parse(MAP1)) for i in range(2)]
+        texts = [codec.dumps(board, store) for board in boards]
+        # both games share the one stored map
+        self.assertEqual(len(store), 1)
+        self.assertEqual(boards[0].map_id, boards[1].map_id)
+        boards[0].grid[0].mapTile = map_tile(MapType.EMPTY_SILO)
+        text = codec.dumps(boards[0], store)
+        self.assertEqual(len(store), 1)
+        self.assertLess(len(text), len(codec.dumps(boards[0])))
+        board = codec.loads(text, Config(), store)
+        self.assertEqual(jsons.dump(board), jsons.dump(boards[0]))
+        board = codec.loads(texts[1], Config(), store)
+        self.assertEqual(jsons.dump(board), jsons.dump(boards[1]))
+
+    def test_encode_leaves_board(self):
+        print('Testing encode does not change the board')
+        board = GameBoard.from_map(MAP1)
+        self.assertTrue(board.map_id)
+        # a new store finds the terrain of the map the board was made from
+        saved = []
+        store = codec.TerrainStore(
+            save=lambda key, *terrain: saved.append(key))
+        text = codec.dumps(board, store)
+        self.assertEqual(saved, [board.map_id])
+        self.assertEqual(jsons.dump(codec.loads(text, Config(), store)),
+                         jsons.dump(board))
+        # a board without a map keeps none after it is encoded
+        board.map_id = ''
+        data = codec.encode_board(board, codec.TerrainStore())
+        self.assertEqual(board.map_id, '')
+        self.assertTrue(data['map'])
+
+
+''' Test restoring a game from the action log.'''
+
+
+class Test_action_log(unittest.TestCase):
+
+    def setUp(self):
+        with _app.app_context():
+            db.create_all()
+            app.game_create_rpc(game)
+
+    def test_replay(self):
+        with _app.app_context():
+            print('Testing action log replay')
+            app.unit_create_rpc(game, 'RED', 'INFANTRY', 3, 1)
+            app.army_end_turn_rpc(game)
+            app.unit_create_rpc(game, 'BLUE', 'INFANTRY', 3, 2)
+            app.army_end_turn_rpc(game)
+            app.unit_attack_rpc(game, 3, 1, 3, 2)
+            board = app.game_board_rpc(game)
+            # drop the cached game so it is restored from the database
+            app.game_cache.evict(game, flush=False)
+            self.assertEqual(app.game_board_rpc(game), board)
+
+    def tearDown(self):
+        with _app.app_context():
+            app.game_delete_rpc(game)
+
+
+''' Test the rpc metrics.'''
+
+
+class Test_metrics(unittest.TestCase):
+
+    def test_phases(self):
+        print('Testing metrics phases')
+        metrics = Metrics()
+
+        @metrics.timed
+        def work_rpc():
+            with metrics.phase('engine'):
+                time.sleep(0.002)
+                with metrics.phase('commit'):
+                    time.sleep(0.01)
+
+        work_rpc()
+        engine = metrics.phases[('work', 'engine')]
+        commit = metrics.phases[('work', 'commit')]
+        self.assertTrue(0.002 <= engine.sum < 0.01)
+        self.assertGreaterEqual(commit.sum, 0.01)
+        self.assertEqual(sum(metrics.requests['work'].counts), 1)
+        self.assertGreaterEqual(metrics.requests['work'].sum,
+                                engine.sum + commit.sum)
+
+    def test_scrape(self):
+        print('Testing metrics endpoint')
+        token = game + 'metrics'
+        with _app.app_context():
+            db.create_all()
+            app.game_create_rpc(token)
+            app.unit_create_rpc(token, 'RED', 'INFANTRY', 3, 1)
+            with self.assertRaises(Exception):
+                app.unit_create_rpc(token, 'RED', 'INFANTRY', 3, 1)
+            app.game_delete_rpc(token)
+        text = _app.test_client().get('/metrics').get_data(as_text=True)
+        for line in ('aw_rpc_seconds_count{method="unit_create"}',
+                     'aw_rpc_phase_seconds_count{method="unit_create",'
+                     'phase="engine"}',
+                     'aw_rpc_phase_seconds_count{method="unit_create",'
+                     'phase="commit"}',
+                     'aw_rpc_phase_seconds_count{method="unit_create",'
+                     'phase="encode"}',
+                     'aw_rpc_errors_total{method="unit_create"}',
+                     'aw_board_written_bytes_total',
+                     'aw_game_cache_hits_total', 'aw_active_rooms'):
+            self.assertIn('\n' + line + ' ', text)
+
+
+''' Test the board deltas sent to clients.'''
+
+
+class Test_board_delta(unittest.TestCase):
+
+    def test_move_delta(self):
+        print('Testing board delta')
+        mngr = GameManager(Config(), GameBoard.create(Map.parse(MAP1)))
+        mngr.unit_create('RED', 'INFANTRY', 3, 1)
+        mngr.army_end_turn()
+        mngr.army_end_turn()
+        mngr.pop_changes()
+        mngr.unit_move(3, 1, 3, 2)
+        delta = app.board_delta(mngr)
+        tiles = {(t['x'], t['y']): t for t in delta['tiles']}
+        self.assertIsNone(tiles[(3, 1)]['unit'])
+        self.assertEqual(tiles[(3, 2)]['unit']['id'], 0)
+        # the unit is selected again after moving
+        self.assertEqual(delta['selected']['unit']['id'], 0)
+        self.assertEqual(app.board_delta(mngr)['tiles'], [])
+
+
+''' Test the move then act command.'''
+
+
+class Test_unit_command(unittest.TestCase):
+
+    def setUp(self):
+        board = GameBoard.create(Map.parse(MAP1))
+        self.mngr = GameManager(Config(), board)
+        self.mngr.unit_create('RED', 'INFANTRY', 3, 1)
+        self.mngr.army_end_turn()
+        self.mngr.unit_create('BLUE', 'INFANTRY', 1, 3)
+        self.mngr.army_end_turn()
+
+    def test_move_and_attack(self):
+        print('Testing unit command attack')
+        mngr = self.mngr
+        tile = mngr.unit_command(3, 1, [[3, 1], [2, 1], [1, 1], [1, 2]],
+                                 'attack', [1, 3])
+        self.assertEqual((tile.x, tile.y), (1, 2))
+        self.assertLess(mngr.unit_at(1, 3).status.hp, 100)
+        self.assertFalse(tile.unit.can_move)
+
+    def test_failed_action_leaves_board(self):
+        print('Testing unit command rollback')
+        mngr = self.mngr
+        before = jsons.dump(mngr.board)
+        with self.assertRaises(Exception):
+            # no unit to attack at the target
+            mngr.unit_command(3, 1, [3, 2], 'attack', [4, 2])
+        self.assertEqual(jsons.dump(mngr.board), before)
+        self.assertEqual(mngr.unit_positions[0], (3, 1))
+
+
 ''' Test capture rpc call. '''
 
 
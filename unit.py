@@ -3,7 +3,10 @@ import math
 
 from dataclasses import dataclass
 from enum import Enum
-import uuid
+from functools import lru_cache
+
+import jsons
+
 from mapping import terrain_star
 from army import Army
 from typing import List
@@ -95,6 +98,43 @@ DAMAGE_TABLE = {
                      85, 15, 55, 85, 85, 0, 1, 40, 55]),
 }
 
+# unit types by fuel use, checked for every unit at the start of a turn
+SEA_TYPES = frozenset({UnitType.LANDER, UnitType.BLACKBOAT, UnitType.CARRIER,
+                       UnitType.BATTLESHIP, UnitType.CRUISER})
+COPTER_TYPES = frozenset({UnitType.TCOPTER, UnitType.BCOPTER})
+AIR_TYPES = frozenset({UnitType.FIGHTER, UnitType.BOMBER, UnitType.BLACKBOMB})
+DAILY_FUEL_TYPES = frozenset({UnitType.STEALTH, UnitType.SUB}) | SEA_TYPES \
+    | COPTER_TYPES | AIR_TYPES
+# unit types by attack, which decides the counterattack
+DIRECT_TYPES = frozenset({UnitType.INFANTRY, UnitType.MECH, UnitType.TANK,
+                          UnitType.MEGATANK, UnitType.NEOTANK,
+                          UnitType.MEDIUMTANK, UnitType.BCOPTER,
+                          UnitType.CRUISER, UnitType.FIGHTER, UnitType.RECON,
+                          UnitType.SUB, UnitType.ANTIAIR, UnitType.BOMBER})
+INDIRECT_TYPES = frozenset({UnitType.ARTILLERY, UnitType.BATTLESHIP,
+                            UnitType.MISSILE, UnitType.ROCKET,
+                            UnitType.CARRIER, UnitType.PIPERUNNER})
+
+
+def roll_damage(damage_const: int, def_const: int, atk_hp: int,
+                def_hp: int, roll: float) -> float:
+    '''Returns the unrounded damage of an attack for the random roll (0-9)
+       from the base damage, the terrain stars of the defender and the
+       displayed HP (1-10) of both units.'''
+    attack_term = damage_const + roll
+    hp_term = atk_hp / 10
+    defense_term = (100 - def_const * def_hp) / 100
+    return attack_term * hp_term * defense_term
+
+
+@lru_cache(maxsize=None)
+def damage_rolls(damage_const: int, def_const: int, atk_hp: int,
+                 def_hp: int) -> tuple:
+    '''Returns the damage of an attack for each random roll 0-9.'''
+    return tuple(int(roll_damage(damage_const, def_const, atk_hp, def_hp,
+                                 roll))
+                 for roll in range(10))
+
 
 class UnitClass(Enum):
     BOOTS = 0
@@ -107,9 +147,10 @@ class UnitClass(Enum):
     PIPE = 7
 
 
-@dataclass
+@dataclass(frozen=True)
 class UnitConfig:
-    '''Attributes of a unit.'''
+    '''Fixed attributes of a unit type, shared by every unit of the type.
+       fuel, hp and ammo are the starting (maximum) values.'''
     cls: UnitClass
     cost: int
     move: int
@@ -119,48 +160,110 @@ class UnitConfig:
     vision: int
     hp: int
     ammo: int
-    cargo: List['Unit']
 
 
-@dataclass
+class UnitStatus:
+    '''The changing state of a unit.  The fixed attributes of its type are
+       read through to the shared UnitConfig.'''
+    __slots__ = ('config', 'hp', 'fuel', 'ammo', 'cargo')
+
+    def __init__(self, config: UnitConfig, hp: int, fuel: int, ammo: int,
+                 cargo: List['Unit']):
+        self.config = config
+        self.hp = hp
+        self.fuel = fuel
+        self.ammo = ammo
+        self.cargo = cargo
+
+    def __eq__(self, other):
+        return (isinstance(other, UnitStatus) and
+                self.config == other.config and self.hp == other.hp and
+                self.fuel == other.fuel and self.ammo == other.ammo and
+                self.cargo == other.cargo)
+
+    def __repr__(self):
+        return (f'UnitStatus(hp={self.hp}, fuel={self.fuel}, '
+                f'ammo={self.ammo}, cargo={self.cargo})')
+
+    @classmethod
+    def create(cls, config: UnitConfig):
+        '''Returns the status of a new unit of the type.'''
+        return cls(config, config.hp, config.fuel, config.ammo, [])
+
+    @property
+    def cls(self) -> UnitClass:
+        return self.config.cls
+
+    @property
+    def cost(self) -> int:
+        return self.config.cost
+
+    @property
+    def move(self) -> int:
+        return self.config.move
+
+    @property
+    def rangemin(self) -> int:
+        return self.config.rangemin
+
+    @property
+    def rangemax(self) -> int:
+        return self.config.rangemax
+
+    @property
+    def vision(self) -> int:
+        return self.config.vision
+
+
+@dataclass(slots=True)
 class Unit:
     '''Type and status of a unit.'''
     army: Army
     type: UnitType
-    status: UnitConfig
-    id: str
+    status: UnitStatus
+    id: int
     can_move: bool
     can_attack: bool
     can_capture: bool
 
-    def attack_damage(self, target, tile):
+    def attack_damage(self, target, tile, rng=random):
         '''Returns the attack damamge from the attacker to the defender
             taking into account the terrain.'''
-        damage_const = DAMAGE_TABLE[self.type][target.type.value]
-        def_const = terrain_star[tile.mapTile.type]
-        atk_hp = math.ceil(self.status.hp / 10)
-        # The displayed HP of the defender, from 1 through 10.
-        def_hp = math.ceil(target.status.hp / 10)
-        attack_term = damage_const + random.randrange(10)
-        hp_term = atk_hp / 10
-        defense_term = (100 - def_const * def_hp) / 100
-        result = attack_term * hp_term * defense_term
-        return int(result)
+        return int(self.damage_roll(target, tile, rng.randrange(10)))
+
+    def expected_damage(self, target, tile):
+        '''Returns the average attack damage over every random roll, as
+           the attack deals it, so no more than the target's hp.'''
+        hp = target.status.hp
+        return sum(min(damage, hp)
+                   for damage in self.damage_rolls(target, tile)) / 10
+
+    def damage_roll(self, target, tile, roll):
+        '''Returns the attack damage for the given random roll (0-9).'''
+        return roll_damage(DAMAGE_TABLE[self.type][target.type.value],
+                           terrain_star[tile.mapTile.type],
+                           math.ceil(self.status.hp / 10),
+                           math.ceil(target.status.hp / 10), roll)
+
+    def damage_rolls(self, target, tile) -> tuple:
+        '''Returns the attack damage to the target on the tile for each
+           random roll 0-9.'''
+        return damage_rolls(DAMAGE_TABLE[self.type][target.type.value],
+                            terrain_star[tile.mapTile.type],
+                            math.ceil(self.status.hp / 10),
+                            math.ceil(target.status.hp / 10))
+
+    def has_weapon(self):
+        '''Returns true if the unit can damage any unit type.'''
+        return any(DAMAGE_TABLE[self.type])
 
     def is_indirect(self):
         '''Returns true if the unit is an indirect unit.'''
-        return self.type in ({UnitType.ARTILLERY, UnitType.BATTLESHIP,
-                              UnitType.MISSILE, UnitType.ROCKET,
-                              UnitType.CARRIER, UnitType.PIPERUNNER})
+        return self.type in INDIRECT_TYPES
 
     def is_direct(self):
         '''Returns true if the unit is an direct unit.'''
-        return self.type in ({UnitType.INFANTRY, UnitType.MECH, UnitType.TANK,
-                              UnitType.MEGATANK, UnitType.NEOTANK,
-                              UnitType.MEDIUMTANK, UnitType.BCOPTER,
-                              UnitType.CRUISER, UnitType.FIGHTER,
-                              UnitType.RECON, UnitType.SUB,
-                              UnitType.ANTIAIR, UnitType.BOMBER})
+        return self.type in DIRECT_TYPES
 
     def is_attackable(self, defender):
         '''Returns true if the unit is able to attack this type of unit.'''
@@ -168,9 +271,7 @@ class Unit:
 
     def is_sea_unit(self):
         '''Returns true if the unit is a sea unit.'''
-        return self.type in ({UnitType.LANDER, UnitType.BLACKBOAT,
-                              UnitType.CARRIER, UnitType.BATTLESHIP,
-                              UnitType.CRUISER})
+        return self.type in SEA_TYPES
 
     def is_stealth_sea(self):
         '''Returns true if the unit is an stealth sea unit.'''
@@ -178,12 +279,11 @@ class Unit:
 
     def is_copter_unit(self):
         '''Returns true if the unit is a copter unit.'''
-        return self.type in {UnitType.TCOPTER, UnitType.BCOPTER}
+        return self.type in COPTER_TYPES
 
     def is_air_unit(self):
         '''Returns true if the unit is an air unit.'''
-        return self.type in ({UnitType.FIGHTER, UnitType.BOMBER,
-                              UnitType.BLACKBOMB})
+        return self.type in AIR_TYPES
 
     def is_land_unit(self):
         '''Returns true if the unit is an air unit.'''
@@ -199,16 +299,11 @@ class Unit:
 
     def is_stealth_air(self):
         '''Returns true if the unit is an stealth air unit.'''
-        return self.type in {UnitType.STEALTH}
+        return self.type is UnitType.STEALTH
 
     def fuel_daily_use(self):
         '''Returns true if the unit consumes fuel every day.'''
-        return self.type in ({UnitType.STEALTH, UnitType.FIGHTER,
-                              UnitType.BOMBER, UnitType.BLACKBOMB,
-                              UnitType.TCOPTER, UnitType.BCOPTER, UnitType.SUB,
-                              UnitType.LANDER, UnitType.BLACKBOAT,
-                              UnitType.CARRIER, UnitType.BATTLESHIP,
-                              UnitType.CRUISER})
+        return self.type in DAILY_FUEL_TYPES
 
     def fuel_use(self):
         '''Returns the daily fuel use for the unit type.'''
@@ -257,7 +352,29 @@ class Unit:
             return True
 
     @classmethod
-    def create(cls, army: Army, unit_type: UnitType, unit_config: UnitConfig):
-        '''Creates the unit.'''
-        return Unit(army, unit_type, unit_config,
-                    uuid.uuid4(), False, False ,True)
+    def create(cls, army: Army, unit_type: UnitType, unit_config: UnitConfig,
+               id: int):
+        '''Creates the unit with the given per-game ID.'''
+        return Unit(army, unit_type, UnitStatus.create(unit_config),
+                    id, False, False ,True)
+
+
+def dump_status(status: UnitStatus, **kwargs) -> dict:
+    '''jsons serializer giving a status the shape clients expect: the type's
+       fixed attributes with the unit's own hp, fuel, ammo and cargo.'''
+    config = status.config
+    return {
+        'cls': config.cls.name,
+        'cost': config.cost,
+        'move': config.move,
+        'rangemin': config.rangemin,
+        'rangemax': config.rangemax,
+        'fuel': status.fuel,
+        'vision': config.vision,
+        'hp': status.hp,
+        'ammo': status.ammo,
+        'cargo': jsons.dump(status.cargo, **kwargs),
+    }
+
+
+jsons.set_serializer(dump_status, UnitStatus)